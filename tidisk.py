@@ -1,43 +1,163 @@
 #!/usr/bin/python3
 
+import argparse
+import array
+import bisect
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import fnmatch
+import glob
+import hashlib
+import io
+import json
+import mmap
 import os
+import pickle
+import re
+import struct
 import sys
+import tarfile
+import time
+import traceback
+import zipfile
+
+
+# Diagnostics are recorded as (code, arg, ...) tuples on the object they are about, and only formatted (see
+# formatMessage) when they are printed or written. The disk keeps the objects that have messages and the number of
+# messages of each code (see TIDisk.addGlobalMessage). Whether a message is an error or a warning depends on where it
+# is added: errors make an object's data untrustworthy, warnings don't.
+MESSAGES = {
+    # DDR and VIB
+    'badMagic': 'invalid magic: %s',
+    'badName': 'invalid name: %s',
+    'tooManyFiles': 'too many files: %s',
+    'tooManySubdirs': 'too many subdirectories: %s',
+    'badFDIRAU': 'invalid FDIR AU: %s',
+    'badParentDDRAU': 'invalid parent DDR AU: %s',
+    'parentDDRMismatch': 'parent DDR mismatch: %s/%s',
+    'subdirAfterZero': 'ignored non-zero subdir AU after zero at byte %s: %s',
+    'subdirCountMismatch': 'subdir count mismatch: %s/%s',
+    'FDIRFileCountMismatch': 'file count mismatch with FDIR: %s/%s',
+    'badSubdirAU': 'invalid subdir AU: %s',
+    'subdirLoop': 'subdir AU %s loops back to %s %s',
+    'tooDeep': 'subdirs not parsed: deeper than %s levels',
+    # FDIR
+    'FDIRParentMismatch': 'parent DDR mismatch: DDR=%s parentAU=%s',
+    'FDRAfterZero': 'ignored non-zero FDR AU after zero at byte %s: %s',
+    'badFDRAU': 'invalid FDR AU at byte %s: %s',
+    'DDRFileCountMismatch': 'DDR/FDIR file count mismatch: DDR=%s FDIR=%s',
+    # FDR
+    'prevFDRAUWithOffset': 'has prevFDRAU=%s with non-zero sectorOffset=%s',
+    'prevFDRAUMismatch': 'previous FDR AU mismatch: %s/%s',
+    'badNextFDRAU': 'invalid next FDR AU: %s',
+    'FDIRAUMismatch': 'FDIR AU mismatch: %s/%s',
+    'prevSectorOffsetMismatch': 'previous FDR AU sector offset mismatch: %s/%s',
+    'badPrevSectorOffset': 'previous FDR AU sector offset invalid: AU=%s sector=%s',
+    'badNextSectorOffset': 'next FDR AU sector offset invalid: AU=%s sector=%s',
+    'badDataChain': 'data chain at byte %s: invalid: start=%s, end=%s',
+    'dataChainAfterZero': 'ignored non-zero data chain AU after zero at byte %s: [%s,%s]',
+    'invalidDataChain': 'invalid data chain at byte %s: [%s,%s]',
+    'allocatedAUMismatch': 'allocated AU mismatch: %s/%s',
+    'programRecordLength': 'logical record length is %s, expected 0 for PROGRAM type',
+    'programRecordsPerSector': 'records per sector is %s, expected 0 for PROGRAM type',
+    'programLevel3Records': 'number of level 3 records is %s, expected 0 for PROGRAM type',
+    'noRecordLength': 'logical record length is 0, expected non-zero for non-PROGRAM type',
+    'variableLevel3Records': 'number of sectors with data (L3 records) %s > total allocated sectors %s',
+    'noRecordsPerSector': 'records per sector is 0, expected non-zero for FIXED type',
+    'fixedLevel3Records': 'L3 records is %s but max allocated records is %s',
+    'sectorsInUse': 'sectors in use %s > sectors allocated %s',
+    'FDRChainLoop': 'next FDR AU %s sector %s loops back into the FDR chain',
+    'FDRChainTooLong': 'next FDR AU %s not parsed: chain longer than %s FDRs',
+    'conflict': '%s conflicts with %s %s (%s)',
+    # Volume
+    'parseStopped': 'parse stopped after %s %s, the rest of the tree is not parsed',
+    'remapped': 'remapped %s from %s for %s %s (%s) to %s for %s %s (%s)',
+    'badBitmapTotals': 'Invalid Bitmap: Total=%s Allocated=%s Free=%s',
+    'bitmapAUFree': 'Invalid Bitmap: VIB/ABM AU %s marked as free',
+    'AUNotInTree': 'AU %s allocated in volume bitmap but not in tree',
+    'AUsNotInTree': 'AUs %s-%s allocated in volume bitmap but not in tree',
+    'dataChainAUFree': 'data chain AU %s marked as free in volume bitmap',
+    'dataChainAUsFree': 'data chain AUs %s-%s marked as free in volume bitmap',
+    'markedFree': 'marked as free in volume bitmap',
+}
+
+SEVERITIES = ['warning', 'error']
+
+# Messages of one code listed per object and per volume before the rest are summed up as "and N more"
+MAX_MESSAGES_PER_CODE = 1000
+
+def formatMessage(msg):
+    return MESSAGES[msg[0]] % msg[1:]
+
+def formatMessages(msgs, maxPerCode=None, counts=None):
+    # The first maxPerCode messages of each code (None or 0: all of them), then a line for each code with more. The
+    # number of messages of each code is counted from msgs unless given.
+    lines = []
+    shown = {}
+    for msg in msgs:
+        numShown = shown.get(msg[0], 0)
+        if (not maxPerCode or numShown < maxPerCode):
+            lines.append(formatMessage(msg))
+        shown[msg[0]] = numShown + 1
+    return lines + formatOmitted(shown if counts is None else counts, maxPerCode)
+
+def formatOmitted(counts, maxPerCode):
+    lines = []
+    if (maxPerCode):
+        for code in counts:
+            if (counts[code] > maxPerCode):
+                lines.append('and ' + str(counts[code] - maxPerCode) + ' more: ' +
+                             MESSAGES[code] % (('*',) * MESSAGES[code].count('%s')))
+    return lines
 
 
 class TIBase:
+    # There is a TIFile per FDR and a TIAURange per data chain cluster, so these and the base class keep their
+    # attributes in slots. The errors and warnings lists only exist once there is a message, and the sector address
+    # is made when it is asked for.
+    __slots__ = ('disk', 'au', 'type', 'mapType', 'errors', 'warnings', 'fullPath', 'ownerId')
+
     def __init__(self, disk, au, type, mapType):
         self.disk = disk
         self.au = au
         self.type = type
         self.mapType = mapType
-        self.hasErrors = False
-        self.errors = []
-        self.hasWarnings = False
-        self.warnings = []
+        self.errors = ()
+        self.warnings = ()
         self.fullPath = ""
-        self.sectorAddress = TISectorAddress(disk, logicalSector=(au * disk.sectorsPerAU))
+        self.ownerId = 0
+
+    @property
+    def hasErrors(self):
+        return bool(self.errors)
+
+    @property
+    def hasWarnings(self):
+        return bool(self.warnings)
+
+    @property
+    def sectorAddress(self):
+        return TISectorAddress(self.disk, logicalSector=(self.au * self.disk.sectorsPerAU))
+
+    def getSlotState(self):
+        # The slot attributes for pickling, in the (dict, slots) state form pickle restores without a __setstate__
+        slots = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if (hasattr(self, name)):
+                    slots[name] = getattr(self, name)
+        return slots
 
     def bytesToString(self, bytes):
-        s = ''
-        for b in bytes:
-            if (b >= 32 and b < 127):
-                s += chr(b)
-            else:
-                s += '\\x' + hex(b).lstrip('0x').zfill(2)
-        return s
+        return str(bytes, 'latin-1').translate(BYTE_ESCAPES)
 
-    def isValidName(self, bytes, asciiOnly=False):
-        seenSpace = False
-        for b in bytes:
-            if (b == 0 or b == ord('.')):
-                return False
-            elif (asciiOnly and (b < 32 or b > 127)):
-                return False
-            elif (b == ord(' ')):
-                seenSpace = True
-            elif (seenSpace):
-                return False
-        return (bytes[0] != ord(' '))
+    def isValidName(self, name, asciiOnly=False):
+        # No NUL or '.', spaces only as padding at the end, and with asciiOnly only bytes 32-127
+        name = bytes(name)
+        if (b'\0' in name or b'.' in name or name[0:1] == b' ' or b' ' in name.rstrip(b' ')):
+            return False
+        return (not asciiOnly or not name.translate(None, ASCII_NAME_BYTES))
 
     def wordToInt(self, bytes):
         return int(bytes[0]) * 256 + int(bytes[1])
@@ -45,9 +165,19 @@ class TIBase:
     def littleEndianWordToInt(self, bytes):
         return int(bytes[1]) * 256 + int(bytes[0])
 
+    def intToWord(self, val):
+        return bytes([(val >> 8) & 0xff, val & 0xff])
+
+    def intToLittleEndianWord(self, val):
+        return bytes([val & 0xff, (val >> 8) & 0xff])
+
     def dateTimeToString(self, bytes):
-        time = self.wordToInt(bytes[0:2])
-        date = self.wordToInt(bytes[2:4])
+        return self.dateTimeIntToString(int.from_bytes(bytes[0:4], 'big'))
+
+    def dateTimeIntToString(self, dateTime):
+        # The 4-byte time and date as one big-endian integer (see FDR_LAYOUT)
+        time = dateTime >> 16
+        date = dateTime & 0xffff
         if (time == 0 and date == 0):
             return '                 '
         else:
@@ -60,32 +190,69 @@ class TIBase:
             return str(year).zfill(2) + '-' + str(mon).zfill(2) + '-' + str(day).zfill(2) + ' ' + \
                    str(hour).zfill(2) + ':' + str(min).zfill(2) + ':' + str(sec).zfill(2)
 
+    def dateTimeToBytes(self, t=None):
+        # Inverse of dateTimeToString, for a time.struct_time (default: now)
+        if (t is None):
+            t = time.localtime()
+        return (self.intToWord((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)) +
+                self.intToWord(((t.tm_year % 100) << 9) | (t.tm_mon << 5) | t.tm_mday))
+
     def export(self, dirPath):
         pass
 
     def printVal(self, label, val, just=30):
         print(label.ljust(just, ' ') + str(val))
 
-    def addError(self, error):
-        self.hasErrors = True
-        self.errors.append(error)
-        self.disk.addGlobalError(self, error)
+    def getRef(self):
+        # How records (see TIRecordWriter) refer to this object
+        return {'type': self.type, 'au': self.au, 'path': self.fullPath}
+
+    def addError(self, code, *args):
+        # Returns the message as recorded
+        msg = (code,) + args
+        if (not self.errors):
+            self.errors = []
+        self.errors.append(msg)
+        self.disk.addGlobalMessage(self.disk.globalErrors, self.disk.errorCounts, self, code)
+        return msg
+
+    def removeError(self, msg):
+        self.errors.remove(msg)
+        self.disk.removeGlobalMessage(self.disk.globalErrors, self.disk.errorCounts, self, msg[0], self.errors)
+
+    def getErrors(self):
+        return formatMessages(self.errors, self.disk.maxMessages)
 
     def printErrors(self, prefix=''):
-        if (self.hasErrors):
+        errors = self.getErrors()
+        if (errors):
             print(prefix + 'ERRORS:')
-            for error in self.errors:
+            for error in errors:
                 print(prefix + '  ' + error)
 
-    def addWarning(self, warning):
-        self.hasWarnings = True
-        self.warnings.append(warning)
-        self.disk.addGlobalWarning(self, warning)
+    def addWarning(self, code, *args):
+        # Returns the message as recorded, or None when only errors are recorded (see TIDisk.minSeverity)
+        if (not self.disk.recordWarnings):
+            return None
+        msg = (code,) + args
+        if (not self.warnings):
+            self.warnings = []
+        self.warnings.append(msg)
+        self.disk.addGlobalMessage(self.disk.globalWarnings, self.disk.warningCounts, self, code)
+        return msg
+
+    def removeWarning(self, msg):
+        self.warnings.remove(msg)
+        self.disk.removeGlobalMessage(self.disk.globalWarnings, self.disk.warningCounts, self, msg[0], self.warnings)
+
+    def getWarnings(self):
+        return formatMessages(self.warnings, self.disk.maxMessages)
 
     def printWarnings(self, prefix=''):
-        if (self.hasWarnings):
+        warnings = self.getWarnings()
+        if (warnings):
             print(prefix + 'WARNINGS:')
-            for warning in self.warnings:
+            for warning in warnings:
                 print(prefix + '  ' + warning)
 
 
@@ -126,6 +293,594 @@ class TISectorAddress:
         return str(self.logicalSector).rjust(5) + ' C:' + str(self.cylinder).zfill(3) + \
                ' H:' + str(self.head) + ' S:' + str(self.trackSector).zfill(2)
 
+    def getRecord(self):
+        return {'sector': self.logicalSector, 'cylinder': self.cylinder, 'head': self.head,
+                'trackSector': self.trackSector}
+
+
+# Bitmap byte to one byte (0 or 1) per AU, most significant bit first
+BITMAP_BITS = [bytes([(b >> (7 - i)) & 0x01 for i in range(0, 8)]) for b in range(0, 256)]
+
+
+# Names and magic strings read from the image: printable ASCII as is, any other byte escaped as \xNN
+BYTE_ESCAPES = dict([(b, '\\x' + hex(b)[2:].zfill(2)) for b in list(range(0, 32)) + list(range(127, 256))])
+ASCII_NAME_BYTES = bytes(range(32, 128))
+
+
+# Sector layouts (see the DDR, FDIR and FDR descriptions below), each decoded with one unpack_from call. All words
+# are big-endian, except the FDR's level 3 record count.
+# VIB and DDR: name, total AUs, sectors per track, magic, hard disk parameters (VIB), creation date/time, files,
+# subdirectories, FDIR AU, parent DDR AU (DSK1 emulation on the VIB), 114 subdirectory AUs
+DDR_LAYOUT = struct.Struct('>10sHB3sH4sBBHH114H')
+DDR_SUBDIRS = 10
+# FDIR: 127 FDR AUs, parent DDR AU
+FDIR_LAYOUT = struct.Struct('>127HH')
+# FDR up to the data chain: name, extended record length, flags, records per sector, sectors allocated, EOF offset,
+# logical record length, level 3 records (byte-swapped), creation and update date/time (time word, date word), magic,
+# previous FDR AU, next FDR AU, allocated AUs, FDIR AU, extended information
+FDR_LAYOUT = struct.Struct('>10sHBBHBBHII2sHHHHH')
+# The first n (start, end) data chain clusters of an FDR, at offset 40
+DATA_CHAIN_LAYOUTS = [struct.Struct('>' + str(2 * n) + 'H') for n in range(0, 55)]
+
+
+def getNumUsedWords(words):
+    # Number of words up to the last non-zero one, in the raw bytes of a zero-padded pointer array
+    return (len(bytes(words).rstrip(b'\0')) + 1) // 2
+
+
+# Fill patterns of AUs that were never written or could not be read when the image was made
+BAD_DATA_PATTERNS = [0xe5e5, 0xdead, 0xd7a5]
+
+def parseBadPattern(text):
+    # Fill pattern word given in hex on the command line
+    try:
+        pattern = int(text, 16)
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a hex word: ' + text)
+    if (pattern < 0 or pattern > 0xffff):
+        raise argparse.ArgumentTypeError('not a 16-bit word (0 to ffff): ' + text)
+    return pattern
+
+
+# Parse limits. A corrupt image can point a DDR back at a directory above it or loop an FDR chain, which is always
+# detected, but it can also nest directories, chain FDRs or cross-link DDRs without end. The limits bound the parse of
+# any image (None is no limit):
+#   maxDepth     directory levels below the root
+#   maxFDRChain  FDRs in the chain of one file (each holds 54 data chain clusters)
+#   maxObjects   DDRs, FDIRs and FDRs parsed in one pass (the first parse, or one reanalyze). The default of one per
+#                sector of the volume can only be reached by a cross-linked tree.
+#   maxSeconds   time spent parsing in one pass
+MAX_DIR_DEPTH = 64
+MAX_FDR_CHAIN = 512
+
+class TIParseLimits:
+    def __init__(self, maxDepth=MAX_DIR_DEPTH, maxFDRChain=MAX_FDR_CHAIN, maxObjects=None, maxSeconds=None):
+        self.maxDepth = maxDepth
+        self.maxFDRChain = maxFDRChain
+        self.maxObjects = maxObjects
+        self.maxSeconds = maxSeconds
+
+
+# Byte translation tables for the candidate FDR/DDR prefilter (1 = match)
+def matchTable(values):
+    return bytes([1 if b in values else 0 for b in range(0, 256)])
+
+CANDIDATE_NAME_START = matchTable([b for b in range(33, 128) if b != ord('.')])
+MATCH_D = matchTable([ord('D')])
+MATCH_I = matchTable([ord('I')])
+MATCH_R = matchTable([ord('R')])
+MATCH_F = matchTable([ord('F')])
+MATCH_ZERO = matchTable([0])
+
+
+# Sector ownership map
+# The disk keeps ownership as a sorted list of non-overlapping sector extents (disk.extents), each with a type code
+# and an owner id into a small owner table (disk.owners).  Sectors that are not in any extent are free (' ') or
+# unknown allocated ('?') depending on the volume bitmap.  Owner id 0 means the owner is implicit and is only created
+# when looked up:
+# 'B'  Volume bitmap
+# '.'  Unused sector
+# TILogicalMap and TIOwnerMap give list-like access to the map with the implicit entries resolved.
+#
+# Lookups are O(log n) bisects over the extent starts.  insert() and delete() find the overlapping extents in
+# O(log n) but then splice the parallel arrays, which moves every extent after the splice point: O(n) per update,
+# O(n^2) to build a map in the worst case.  The move is a memmove of 13 bytes per extent, and the parser maps
+# sectors roughly in ascending order so most splices land near the tail; 100,000 single-sector extents take about
+# 0.5s to build in ascending order and about 2s in descending order.
+
+class TIExtentMap:
+    def __init__(self):
+        self.starts = array.array('I')
+        self.ends = array.array('I')
+        self.types = bytearray()
+        self.ownerIds = array.array('I')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for i in range(0, len(self.starts)):
+            yield (self.starts[i], self.ends[i], chr(self.types[i]), self.ownerIds[i])
+
+    def find(self, sector):
+        # Index of the extent containing sector, or -1
+        i = bisect.bisect_right(self.starts, sector) - 1
+        if (i >= 0 and self.ends[i] >= sector):
+            return i
+        return -1
+
+    def overlapping(self, start, end):
+        # Range of indexes of the extents overlapping sectors [start, end]
+        lo = bisect.bisect_right(self.starts, start) - 1
+        if (lo < 0 or self.ends[lo] < start):
+            lo += 1
+        hi = bisect.bisect_right(self.starts, end, lo)
+        return range(lo, hi)
+
+    def insert(self, start, end, mapType, ownerId):
+        # Map sectors [start, end], replacing whatever was there. Returns the (start, end, type, ownerId) pieces that
+        # were replaced.
+        overlap = self.overlapping(start, end)
+        lo = overlap.start
+        hi = overlap.stop
+        replaced = []
+        for i in overlap:
+            replaced.append((max(self.starts[i], start), min(self.ends[i], end), chr(self.types[i]), self.ownerIds[i]))
+
+        pieces = []
+        if (lo < hi and self.starts[lo] < start):
+            pieces.append([self.starts[lo], start - 1, self.types[lo], self.ownerIds[lo]])
+        pieces.append([start, end, ord(mapType), ownerId])
+        if (lo < hi and self.ends[hi - 1] > end):
+            pieces.append([end + 1, self.ends[hi - 1], self.types[hi - 1], self.ownerIds[hi - 1]])
+
+        # Coalesce with adjacent extents of the same type and owner
+        if (lo > 0 and self.ends[lo - 1] + 1 == start):
+            lo -= 1
+            pieces.insert(0, [self.starts[lo], self.ends[lo], self.types[lo], self.ownerIds[lo]])
+        if (hi < len(self.starts) and self.starts[hi] == end + 1):
+            pieces.append([self.starts[hi], self.ends[hi], self.types[hi], self.ownerIds[hi]])
+            hi += 1
+        merged = [pieces[0]]
+        for piece in pieces[1:]:
+            last = merged[-1]
+            if (last[1] + 1 == piece[0] and last[2] == piece[2] and last[3] == piece[3]):
+                last[1] = piece[1]
+            else:
+                merged.append(piece)
+
+        self.starts[lo:hi] = array.array('I', [piece[0] for piece in merged])
+        self.ends[lo:hi] = array.array('I', [piece[1] for piece in merged])
+        self.types[lo:hi] = bytes([piece[2] for piece in merged])
+        self.ownerIds[lo:hi] = array.array('I', [piece[3] for piece in merged])
+        return replaced
+
+    def delete(self, start, end):
+        # Unmap sectors [start, end]
+        overlap = self.overlapping(start, end)
+        lo = overlap.start
+        hi = overlap.stop
+        if (lo == hi):
+            return
+        pieces = []
+        if (self.starts[lo] < start):
+            pieces.append([self.starts[lo], start - 1, self.types[lo], self.ownerIds[lo]])
+        if (self.ends[hi - 1] > end):
+            pieces.append([end + 1, self.ends[hi - 1], self.types[hi - 1], self.ownerIds[hi - 1]])
+
+        self.starts[lo:hi] = array.array('I', [piece[0] for piece in pieces])
+        self.ends[lo:hi] = array.array('I', [piece[1] for piece in pieces])
+        self.types[lo:hi] = bytes([piece[2] for piece in pieces])
+        self.ownerIds[lo:hi] = array.array('I', [piece[3] for piece in pieces])
+
+
+class TILogicalMap:
+    def __init__(self, disk):
+        self.disk = disk
+
+    def __len__(self):
+        return self.disk.totalSectors
+
+    def __getitem__(self, sector):
+        if (isinstance(sector, slice)):
+            return str(self)[sector]
+        extents = self.disk.extents
+        i = extents.find(sector)
+        if (i >= 0):
+            return chr(extents.types[i])
+        if (self.disk.testBitmap(sector // self.disk.sectorsPerAU)):
+            return '?'
+        return ' '
+
+    def __iter__(self):
+        return iter(str(self))
+
+    def __str__(self):
+        disk = self.disk
+        pieces = []
+        sector = 0
+        for (start, end, mapType, ownerId) in disk.extents:
+            if (start > sector):
+                pieces.append(self.unmapped(sector, start - 1))
+            pieces.append(mapType * (end - start + 1))
+            sector = end + 1
+        if (sector < disk.totalSectors):
+            pieces.append(self.unmapped(sector, disk.totalSectors - 1))
+        return ''.join(pieces)
+
+    def unmapped(self, start, end):
+        disk = self.disk
+        fills = [' ' * disk.sectorsPerAU, '?' * disk.sectorsPerAU]
+        fill = ''.join(map(fills.__getitem__, disk.bitmap[start // disk.sectorsPerAU:end // disk.sectorsPerAU + 1]))
+        offset = (start // disk.sectorsPerAU) * disk.sectorsPerAU
+        return fill[start - offset:end + 1 - offset]
+
+    def runs(self):
+        # Run-length encoded map: (type, ownerId, start sector, number of sectors) for every sector, in order.
+        # Unmapped sectors come as ' ' and '?' runs with owner id 0 (see TIDisk.getOwner for the mapped types).
+        disk = self.disk
+        sector = 0
+        for (start, end, mapType, ownerId) in disk.extents:
+            if (start > sector):
+                yield from self.unmappedRuns(sector, start - 1)
+            yield (mapType, ownerId, start, end - start + 1)
+            sector = end + 1
+        if (sector < disk.totalSectors):
+            yield from self.unmappedRuns(sector, disk.totalSectors - 1)
+
+    def unmappedRuns(self, start, end):
+        disk = self.disk
+        startAU = start // disk.sectorsPerAU
+        for match in re.finditer(b'\x00+|\x01+', disk.bitmap[startAU:end // disk.sectorsPerAU + 1]):
+            runStart = max(start, (startAU + match.start()) * disk.sectorsPerAU)
+            runEnd = min(end, (startAU + match.end()) * disk.sectorsPerAU - 1)
+            yield ('?' if match.group(0)[0] else ' ', 0, runStart, runEnd - runStart + 1)
+
+    def summary(self, ausPerChar):
+        # Scaled down map with one character per ausPerChar AUs, showing the type covering most of their sectors
+        disk = self.disk
+        sectorsPerChar = ausPerChar * disk.sectorsPerAU
+        chars = []
+        counts = {}
+        for (mapType, ownerId, start, length) in self.runs():
+            sector = start
+            end = start + length
+            while (sector < end):
+                charEnd = (sector // sectorsPerChar + 1) * sectorsPerChar
+                if (not counts and sector % sectorsPerChar == 0 and end >= charEnd):
+                    n = (end - sector) // sectorsPerChar
+                    chars.append(mapType * n)
+                    sector += n * sectorsPerChar
+                    continue
+                n = min(end, charEnd) - sector
+                counts[mapType] = counts.get(mapType, 0) + n
+                sector += n
+                if (sector == charEnd or sector == disk.totalSectors):
+                    chars.append(max(counts, key=counts.get))
+                    counts = {}
+        return ''.join(chars)
+
+
+class TIOwnerMap:
+    def __init__(self, disk):
+        self.disk = disk
+
+    def __len__(self):
+        return self.disk.totalSectors
+
+    def __getitem__(self, sector):
+        disk = self.disk
+        au = sector // disk.sectorsPerAU
+        i = disk.extents.find(sector)
+        if (i < 0):
+            if (disk.testBitmap(au)):
+                return TIUnknownAU(disk, au)
+            return TIFreeAU(disk, au)
+        return disk.getOwner(disk.extents.types[i], disk.extents.ownerIds[i], au)
+
+
+# Full path index of the directories and files of a volume (e.g. 'DIR.SUBDIR.FILE' -> TIFile)
+# Exact lookups are dictionary lookups. Prefix listings and glob matches bisect a sorted list of the paths, which is
+# rebuilt only after paths have been added.
+
+class TIPathIndex:
+    def __init__(self):
+        self.paths = {}
+        self.sortedPaths = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, obj):
+        if (obj.fullPath not in self.paths):
+            self.paths[obj.fullPath] = obj
+            self.sortedPaths = None
+
+    def remove(self, obj):
+        if (self.paths.get(obj.fullPath) is obj):
+            del self.paths[obj.fullPath]
+            self.sortedPaths = None
+
+    def lookup(self, path):
+        return self.paths.get(path)
+
+    def getSortedPaths(self):
+        if (self.sortedPaths is None):
+            self.sortedPaths = sorted(self.paths)
+        return self.sortedPaths
+
+    def listPrefix(self, prefix):
+        # Paths starting with prefix, in sorted order
+        sortedPaths = self.getSortedPaths()
+        paths = []
+        for i in range(bisect.bisect_left(sortedPaths, prefix), len(sortedPaths)):
+            if (not sortedPaths[i].startswith(prefix)):
+                break
+            paths.append(sortedPaths[i])
+        return paths
+
+    def glob(self, pattern):
+        # Paths matching a shell-style pattern ('*' also matches '.'). Only the paths sharing the pattern's literal
+        # prefix are tested.
+        literal = re.match(r'[^*?\[]*', pattern).group(0)
+        if (literal == pattern):
+            return [pattern] if pattern in self.paths else []
+        return [path for path in self.listPrefix(literal) if fnmatch.fnmatchcase(path, pattern)]
+
+
+# Columnar file catalog (see TIDisk.getCatalog): one row per file (its first FDR), with each field in an array of its
+# own, so that a query over all files is a scan of just the columns it tests.
+# files      First TIFile of each row, sorted by full path
+# sizes      Size in bytes: the program length of PROGRAM and DSK1EMU files, the sectors allocated of the others
+# types      Index in CATALOG_TYPES
+# created    Creation date and time as (date << 16) | time, which sorts in time order (see parseCatalogDate)
+# modified   Update date and time, likewise
+
+CATALOG_TYPES = ['PROGRAM', 'DSK1EMU', 'DIS/FIX', 'DIS/VAR', 'INT/FIX', 'INT/VAR']
+
+def parseCatalogDate(text):
+    # YY-MM-DD as the first catalog date and time of that day
+    match = re.fullmatch(r'(\d\d)-(\d\d)-(\d\d)', text)
+    if (match is None):
+        raise ValueError('expected YY-MM-DD: ' + text)
+    (year, mon, day) = [int(field) for field in match.groups()]
+    return ((year << 9) | (mon << 5) | day) << 16
+
+class TICatalog:
+    def __init__(self, files, sectorSize):
+        self.files = files
+        self.sizes = array.array('Q')
+        self.types = bytearray()
+        self.created = array.array('L')
+        self.modified = array.array('L')
+        for fdr in files:
+            if (fdr.isDSK1Emu or fdr.isProgram):
+                self.sizes.append(fdr.programLength)
+                self.types.append(1 if fdr.isDSK1Emu else 0)
+            else:
+                self.sizes.append(fdr.numSectorsAllocated * sectorSize)
+                self.types.append(2 + fdr.isInternal * 2 + fdr.isVariable)
+            self.created.append(((fdr.created & 0xffff) << 16) | (fdr.created >> 16))
+            self.modified.append(((fdr.modified & 0xffff) << 16) | (fdr.modified >> 16))
+
+    def __len__(self):
+        return len(self.files)
+
+    def select(self, types=None, minSize=None, maxSize=None, modifiedSince=None):
+        # Rows of the files matching every given condition (types: names from CATALOG_TYPES)
+        rows = range(0, len(self.files))
+        if (types is not None):
+            codes = set([CATALOG_TYPES.index(type) for type in types])
+            column = self.types
+            rows = [row for row in rows if column[row] in codes]
+        if (minSize is not None):
+            column = self.sizes
+            rows = [row for row in rows if column[row] >= minSize]
+        if (maxSize is not None):
+            column = self.sizes
+            rows = [row for row in rows if column[row] <= maxSize]
+        if (modifiedSince is not None):
+            column = self.modified
+            rows = [row for row in rows if column[row] >= modifiedSince]
+        return list(rows)
+
+    def getTotalSize(self, rows=None):
+        if (rows is None):
+            return sum(self.sizes)
+        sizes = self.sizes
+        return sum([sizes[row] for row in rows])
+
+
+# Free space index for writing (see TIDisk.getFreeExtents)
+# The free AUs (free in the volume bitmap and not in the tree) as maximal runs, kept sorted twice: by start AU for
+# first-fit allocation and for merging released AUs with their neighbours, and by (length, start) for best-fit
+# allocation. It is built from the bitmap once and then updated by each allocation and release.
+
+class TIFreeExtents:
+    def __init__(self, freeAUs):
+        # freeAUs has one byte (0 or 1) per AU
+        self.starts = []
+        self.lengths = {}
+        self.bySize = []
+        self.numFree = 0
+        for m in re.finditer(b'\x01+', freeAUs):
+            self.starts.append(m.start())
+            self.lengths[m.start()] = m.end() - m.start()
+            self.bySize.append((m.end() - m.start(), m.start()))
+            self.numFree += m.end() - m.start()
+        self.bySize.sort()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        # (startAU, endAU) of each free run, in disk order
+        for start in self.starts:
+            yield (start, start + self.lengths[start] - 1)
+
+    def addRun(self, start, length):
+        bisect.insort(self.starts, start)
+        self.lengths[start] = length
+        bisect.insort(self.bySize, (length, start))
+
+    def removeRun(self, start):
+        length = self.lengths.pop(start)
+        del self.starts[bisect.bisect_left(self.starts, start)]
+        del self.bySize[bisect.bisect_left(self.bySize, (length, start))]
+        return length
+
+    def findRun(self, numAUs, bestFit=False, beforeAU=None):
+        # Start of the first (or with bestFit, the shortest) run of at least numAUs AUs, or None. First-fit can be
+        # limited to the runs starting before beforeAU.
+        if (not self.bySize or self.bySize[-1][0] < numAUs):
+            return None
+        if (bestFit):
+            return self.bySize[bisect.bisect_left(self.bySize, (numAUs, 0))][1]
+        for start in self.starts:
+            if (beforeAU is not None and start >= beforeAU):
+                return None
+            if (self.lengths[start] >= numAUs):
+                return start
+
+    def allocate(self, numAUs, bestFit=False):
+        # Take numAUs contiguous AUs from the front of a run. Returns the start AU, or None if no run is long enough.
+        start = self.findRun(numAUs, bestFit)
+        if (start is not None):
+            length = self.removeRun(start)
+            if (length > numAUs):
+                self.addRun(start + numAUs, length - numAUs)
+            self.numFree -= numAUs
+        return start
+
+    def allocateExtents(self, numAUs, bestFit=False):
+        # Take numAUs AUs as (startAU, endAU) extents: a single extent if a run is long enough, else the longest runs
+        # first. Returns None, taking nothing, if there are not enough free AUs.
+        if (numAUs > self.numFree):
+            return None
+        extents = []
+        while (numAUs > 0):
+            length = min(numAUs, self.bySize[-1][0])
+            start = self.allocate(length, bestFit or length < numAUs)
+            extents.append((start, start + length - 1))
+            numAUs -= length
+        return extents
+
+    def copy(self):
+        freeExtents = TIFreeExtents(b'')
+        freeExtents.starts = list(self.starts)
+        freeExtents.lengths = dict(self.lengths)
+        freeExtents.bySize = list(self.bySize)
+        freeExtents.numFree = self.numFree
+        return freeExtents
+
+    def findRunContaining(self, startAU, endAU):
+        # Start of the run that AUs [startAU, endAU] are all in, or None if they are not all free
+        i = bisect.bisect_right(self.starts, startAU) - 1
+        if (i >= 0 and self.starts[i] + self.lengths[self.starts[i]] > endAU):
+            return self.starts[i]
+        return None
+
+    def take(self, startAU, endAU):
+        # Take AUs [startAU, endAU], which must all be free
+        start = self.findRunContaining(startAU, endAU)
+        if (start is None):
+            raise Exception('AUs ' + str(startAU) + '-' + str(endAU) + ' are not free')
+        length = self.removeRun(start)
+        if (start < startAU):
+            self.addRun(start, startAU - start)
+        if (start + length - 1 > endAU):
+            self.addRun(endAU + 1, start + length - 1 - endAU)
+        self.numFree -= endAU - startAU + 1
+
+    def release(self, startAU, endAU):
+        # Return AUs to the index, merging them with the adjacent runs
+        length = endAU - startAU + 1
+        self.numFree += length
+        i = bisect.bisect_left(self.starts, startAU)
+        if (i > 0 and self.starts[i - 1] + self.lengths[self.starts[i - 1]] == startAU):
+            startAU = self.starts[i - 1]
+            length += self.removeRun(startAU)
+        if (startAU + length in self.lengths):
+            length += self.removeRun(startAU + length)
+        self.addRun(startAU, length)
+
+
+# Defragmentation plan (see TIDisk.planDefrag and TIDisk.defrag)
+# One entry per file to make contiguous or to move out of the way, in the order they are moved:
+#   fdr       First FDR of the file
+#   FDRAU     AU of the first FDR afterwards (the FDIR is updated if it moves)
+#   startAU   Start of the file's data afterwards (numAUs AUs, a single data chain cluster)
+#   moves     (fromAU, toAU, numAUs) copies of the clusters (and FDR AU) that are not already in place, possibly into
+#             AUs that other clusters of the same file leave
+#   taken     (startAU, endAU) free AUs the moves fill
+#   released  (startAU, endAU) AUs freed afterwards: what the moved clusters and FDR AU leave outside the file's new
+#             place, and the AUs of the chained FDRs
+# Each entry is planned against the free space left by the entries before it, so a file can move into the AUs
+# another file has just left. The files in lifted are the exception: they are read, and their released AUs freed,
+# before any entry is carried out, so the entries before theirs can move other files into their old AUs.
+# skipped lists the files left fragmented, and reasons says why for each.
+
+class TIDefragPlan:
+    def __init__(self, disk, freeExtents):
+        self.disk = disk
+        self.writeCount = disk.writeCount
+        self.freeExtents = freeExtents
+        self.files = []
+        self.lifted = set()
+        self.skipped = []
+        self.reasons = {}
+        self.numCompacted = 0
+        self.numFragmented = 0
+        self.numClusters = 0
+        self.numAUsMoved = 0
+        self.numFDRsFreed = 0
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, fdr, FDRAU, startAU, numAUs, moves, taken, released, numFDRsFreed):
+        self.files.append((fdr, FDRAU, startAU, numAUs, moves, taken, released))
+        self.numAUsMoved += sum([numAUs for (fromAU, toAU, numAUs) in moves])
+        self.numFDRsFreed += numFDRsFreed
+
+    def skip(self, fdr, numAUs, after=''):
+        # Leave a file fragmented because no free run is long enough for it
+        maxAUs = self.freeExtents.bySize[-1][0] if (self.freeExtents.bySize) else 0
+        self.skipped.append(fdr)
+        self.reasons[fdr] = ('needs ' + str(numAUs) + ' contiguous AUs, the largest free run' + after + ' is ' +
+                             str(maxAUs))
+
+    def undoMove(self):
+        # Drop the last entry, a file moved only to make room, and give back its free space
+        (fdr, FDRAU, startAU, numAUs, moves, taken, released) = self.files.pop()
+        for (start, end) in released:
+            self.freeExtents.take(start, end)
+        for (start, end) in taken:
+            self.freeExtents.release(start, end)
+        self.numAUsMoved -= sum([numAUs for (fromAU, toAU, numAUs) in moves])
+        self.numCompacted -= 1
+
+    def printVals(self, prefix=''):
+        disk = self.disk
+        print(prefix + 'Defragmentation plan:')
+        disk.printVal(prefix + '  Fragmented files:', self.numFragmented)
+        disk.printVal(prefix + '  Data chain clusters:', self.numClusters)
+        disk.printVal(prefix + '  Files to defragment:', len(self.files) - self.numCompacted)
+        disk.printVal(prefix + '  Files to move for room:', self.numCompacted)
+        disk.printVal(prefix + '  Files without room:', len(self.skipped))
+        disk.printVal(prefix + '  AUs to move:', str(self.numAUsMoved) + ' (' +
+                      str(self.numAUsMoved * disk.auSize) + ' bytes)')
+        disk.printVal(prefix + '  FDRs to free:', self.numFDRsFreed)
+        for fdr in self.skipped:
+            print(prefix + '  No contiguous room for ' + fdr.fullPath + ': ' + self.reasons[fdr])
+
+    def getRecord(self):
+        return {'record': 'defragPlan', 'fragmented': self.numFragmented, 'clusters': self.numClusters,
+                'files': len(self.files) - self.numCompacted, 'compacted': self.numCompacted,
+                'skipped': [dict(fdr.getRef(), reason=self.reasons[fdr]) for fdr in self.skipped],
+                'AUsMoved': self.numAUsMoved, 'bytesMoved': self.numAUsMoved * self.disk.auSize,
+                'FDRsFreed': self.numFDRsFreed}
+
 
 # Parse Directory Descriptor Record (DDR)
 # 0-9   Directory name padded with spaces to the right
@@ -141,7 +896,8 @@ class TISectorAddress:
 # 28-255 Pointers to subdirectories (up to 114 AU pointers to DDRs, in alphabetical order)
 
 class TIDir(TIBase):
-    def __init__(self, disk, parent, au, ddr):
+    def __init__(self, disk, parent, au, ddr, inWalk=False):
+        # inWalk: created by the parseSubdirs of a directory above, which parses the subdirectories and maps the DDR
         magic = 'DIR'
         type = 'DDR'
         mapType = 'D'
@@ -153,67 +909,285 @@ class TIDir(TIBase):
         super().__init__(disk, au, type, mapType)
 
         self.parent = parent
+        self.depth = 0 if (parent == self) else parent.depth + 1
+        self.magic = magic
+        self.headerMessages = []
+        self.FDIRCountError = None
+        self._FDIR = None
+        self.FDIRParsed = False
+        self._subdirs = None
+        self.foundSubdirs = {}
 
         if (len(ddr) < disk.sectorSize):
-            self.hasErrors = True
             raise Exception('DDR AU ' + str(au) + ' invalid length: ' + str(len(ddr)))
-        if (self.bytesToString(ddr[13:16]) != magic):
-            self.addWarning('invalid magic: ' + self.bytesToString(ddr[13:16]))
-        if (not disk.testBitmap(au)):
-            self.addWarning('marked as free in volume bitmap')
 
-        name = ddr[0:10]
+        self.decodeHeader(ddr, not disk.lazy, inWalk)
+
+        if (not inWalk):
+            disk.mapAU(au, self)
+
+    def decodeHeader(self, ddr, parse, inWalk=False):
+        # Decode the DDR (or VIB) fields, parsing the FDIR and subdirectories if parse is set (otherwise they are
+        # parsed the first time they are accessed). The messages are remembered in headerMessages so that
+        # TIDisk.refreshDirHeader can decode the header again.
+        disk = self.disk
+        fields = DDR_LAYOUT.unpack_from(ddr)
+        (name, totalAUs, sectorsPerTrack, magic, hardDiskParams, creationDateTime, numFiles, numSubdirs, FDIRAU,
+         parentDDR) = fields[0:DDR_SUBDIRS]
+        if (self.bytesToString(magic) != self.magic):
+            self.addHeaderMessage(False, 'badMagic', self.bytesToString(magic))
+
         self.name = self.bytesToString(name).rstrip()
         if (not self.isValidName(name)):
-            self.addError('invalid name: ' + self.name)
+            self.addHeaderMessage(True, 'badName', self.name)
 
-        if (parent == disk):
+        if (self.parent == disk):
             self.fullPath = self.name
         else:
-            self.fullPath = parent.fullPath + '.' + self.name
+            self.fullPath = self.parent.fullPath + '.' + self.name
+        if (self != disk):
+            disk.pathIndex.add(self)
 
-        self.creationDateTime = self.dateTimeToString(ddr[18:22])
+        self.creationDateTime = self.dateTimeToString(creationDateTime)
 
-        self.numFiles = int(ddr[22])
+        self.numFiles = numFiles
         if (self.numFiles > 127):
-            self.addError('too many files: ' + str(self.numFiles()))
+            self.addHeaderMessage(True, 'tooManyFiles', self.numFiles)
 
-        self.numSubdirs = int(ddr[23])
+        self.numSubdirs = numSubdirs
         if (self.numSubdirs > 114):
-            self.addError('too many subdirectories: ' + str(self.numFiles()))
+            self.addHeaderMessage(True, 'tooManySubdirs', self.numSubdirs)
 
-        self.FDIRAU = self.wordToInt(ddr[24:26])
-        if (disk.isValidAU(self.FDIRAU)):
-            self.FDIR = TIFDIR(self.disk, self, self.FDIRAU, disk.getAU(self.FDIRAU))
-            if (self.numFiles != self.FDIR.numFiles):
-                self.addError('file count mismatch with FDIR: ' + str(self.numFiles) + '/' + str(self.FDIR.numFiles))
-        else:
-            self.addError('invalid FDIR AU: ', + str(self.FDIR))
-            self.FDIR = None
+        self.FDIRAU = FDIRAU
+        if (not disk.isValidAU(self.FDIRAU)):
+            self.addHeaderMessage(True, 'badFDIRAU', self.FDIRAU)
+            self.FDIRParsed = True
+        elif (parse):
+            self.parseFDIR()
 
-        self.parentDDR = self.wordToInt(ddr[26:28])
+        self.parentDDR = parentDDR
         if (not disk.isValidAU(self.parentDDR)):
-            self.addWarning('invalid parent DDR AU: ' + str(self.parentDDR))
-        elif (self.parentDDR != parent.au):
-            self.addWarning('parent DDR mismatch: ' + str(self.parentDDR) + '/' + str(parent.au))
+            self.addHeaderMessage(False, 'badParentDDRAU', self.parentDDR)
+        elif (self.parentDDR != self.parent.au):
+            self.addHeaderMessage(False, 'parentDDRMismatch', self.parentDDR, self.parent.au)
 
         self.subdirAUs = []
-        self.subdirs = []
         sawZero = False
-        for i in range(28, 256, 2):
-            subdirAU = self.wordToInt(ddr[i:i+2])
+        subdirAUs = fields[DDR_SUBDIRS:DDR_SUBDIRS + getNumUsedWords(ddr[28:256])]
+        for i in range(0, len(subdirAUs)):
+            subdirAU = subdirAUs[i]
             if (subdirAU == 0):
                 sawZero = True
             elif (sawZero):
-                self.addWarning('ignored non-zero subdir AU after zero at byte ' + str(i) + ': ' + str(subdirAU))
+                self.addHeaderMessage(False, 'subdirAfterZero', 28 + i * 2, subdirAU)
             else:
                 self.subdirAUs.append(subdirAU)
-                self.subdirs.append(TIDir(disk, self, subdirAU, disk.getAU(subdirAU)))
+        if (parse and not inWalk):
+            self.parseSubdirs()
 
-        if (self.numSubdirs != len(self.subdirs)):
-            self.addError('subdir count mismatch: ' + str(self.numSubdirs) + '/' + str(len(self.subdirs)))
+        if (not inWalk):
+            self.checkSubdirCount()
 
-        disk.mapAU(au, self)
+    def checkSubdirCount(self):
+        if (self.numSubdirs != len(self.subdirAUs)):
+            self.addHeaderMessage(True, 'subdirCountMismatch', self.numSubdirs, len(self.subdirAUs))
+
+    def addHeaderMessage(self, isError, code, *args):
+        msg = self.addError(code, *args) if isError else self.addWarning(code, *args)
+        if (msg is not None):
+            self.headerMessages.append((isError, msg))
+
+    def clearHeaderMessages(self):
+        for (isError, msg) in self.headerMessages:
+            if (isError):
+                self.removeError(msg)
+            else:
+                self.removeWarning(msg)
+        self.headerMessages = []
+
+    @property
+    def FDIR(self):
+        if (not self.FDIRParsed):
+            self.parseFDIR()
+        return self._FDIR
+
+    @property
+    def subdirs(self):
+        if (self._subdirs is None):
+            self.parseSubdirs()
+        return self._subdirs
+
+    def parseFDIR(self, oldFDRs=None):
+        self.FDIRParsed = True
+        if (self.disk.canParse()):
+            self._FDIR = TIFDIR(self.disk, self, self.FDIRAU, self.disk.getAU(self.FDIRAU), oldFDRs)
+        self.checkFDIRCount()
+
+    def checkFDIRCount(self):
+        # (Re)check the file count against the FDIR, on both sides
+        error = None
+        if (self._FDIR is not None):
+            self._FDIR.checkFileCount()
+            if (self.numFiles != self._FDIR.numFiles):
+                error = ('FDIRFileCountMismatch', self.numFiles, self._FDIR.numFiles)
+        if (error != self.FDIRCountError):
+            if (self.FDIRCountError is not None):
+                self.removeError(self.FDIRCountError)
+            if (error is not None):
+                self.addError(*error)
+            self.FDIRCountError = error
+
+    def parseSubdirs(self):
+        # Parse the subdirectories, and unless the disk is parsed lazily everything below them: depth first without
+        # recursion, each DDR checked and mapped after its subtree. pathAUs holds the DDR AUs from the root down to the
+        # directory being walked, so a subdirectory pointer that loops back is caught.
+        disk = self.disk
+        pathAUs = self.getPathAUs()
+        self._subdirs = []
+        stack = [(self, iter(self.subdirAUs))]
+        while (stack):
+            (dir, subdirAUs) = stack[-1]
+            subdirAU = next(subdirAUs, None)
+            if (subdirAU is None):
+                stack.pop()
+                if (dir != self):
+                    pathAUs.remove(dir.au)
+                    dir.checkSubdirCount()
+                    disk.mapAU(dir.au, dir)
+            elif (not dir.isParsableSubdir(subdirAU, pathAUs)):
+                continue
+            elif (disk.lazy and subdirAU in dir.foundSubdirs):
+                dir._subdirs.append(dir.foundSubdirs.pop(subdirAU))
+            elif (disk.lazy):
+                dir._subdirs.append(TIDir(disk, dir, subdirAU, disk.getAU(subdirAU)))
+            else:
+                subdir = TIDir(disk, dir, subdirAU, disk.getAU(subdirAU), True)
+                subdir._subdirs = []
+                dir._subdirs.append(subdir)
+                pathAUs.add(subdirAU)
+                stack.append((subdir, iter(subdir.subdirAUs)))
+
+    def getPathAUs(self):
+        pathAUs = set([self.au])
+        dir = self
+        while (dir != self.disk):
+            dir = dir.parent
+            pathAUs.add(dir.au)
+        return pathAUs
+
+    def isParsableSubdir(self, subdirAU, pathAUs):
+        # False if the subdirectory AU is outside the volume, loops back to a directory above or is deeper than the
+        # depth limit (with an error, once per directory), or the parse budget is used up
+        limits = self.disk.limits
+        if (self.disk.parseStopped is not None):
+            return False
+        elif (not self.disk.isValidAU(subdirAU)):
+            error = ('badSubdirAU', subdirAU)
+        elif (subdirAU in pathAUs):
+            dir = self
+            while (dir.au != subdirAU):
+                dir = dir.parent
+            error = ('subdirLoop', subdirAU, dir.type, dir.fullPath)
+        elif (limits.maxDepth is not None and self.depth >= limits.maxDepth):
+            error = ('tooDeep', limits.maxDepth)
+        else:
+            return self.disk.canParse()
+        if (error not in self.errors):
+            self.addHeaderMessage(True, *error)
+        return False
+
+    def getSubdir(self, name):
+        for subdir in self.subdirs:
+            if (subdir.name == name):
+                return subdir
+        return None
+
+    # Lookups on a lazily parsed disk (see TIDisk.lookup) only build the DDR or FDR that matches. The subdirectory
+    # AUs of a DDR and the FDR AUs of an FDIR are sorted by name, so the entry is found by a binary search that reads
+    # just the name of each DDR or FDR it probes. A directory found this way is kept in foundSubdirs, and a file in
+    # its FDIR's foundFDRs, until the whole directory is parsed and takes them over.
+
+    def findSubdir(self, name):
+        if (self._subdirs is not None):
+            return self.getSubdir(name)
+        i = self.findEntry(self.subdirAUs, name)
+        if (i < 0):
+            return None
+        subdirAU = self.subdirAUs[i]
+        if (subdirAU not in self.foundSubdirs):
+            if (not self.isParsableSubdir(subdirAU, self.getPathAUs())):
+                return None
+            self.foundSubdirs[subdirAU] = TIDir(self.disk, self, subdirAU, self.disk.getAU(subdirAU))
+        return self.foundSubdirs[subdirAU]
+
+    def findFile(self, name):
+        fdir = self.FDIR
+        if (fdir is None):
+            return None
+        if (fdir._FDRs is not None):
+            for fdr in fdir._FDRs:
+                if (fdr.name == name):
+                    return fdr
+            return None
+        i = self.findEntry(fdir.FDRAUs, name)
+        if (i < 0 or not self.disk.canParse()):
+            return None
+        return fdir.findFDR(fdir.FDRAUs[i])
+
+    def findEntry(self, aus, name):
+        # Index of the DDR or FDR AU in aus with this name, or -1. Falls back to reading every name if the binary
+        # search misses, in case the entries are out of order.
+        disk = self.disk
+        names = {}
+        def getName(i):
+            if (i not in names):
+                names[i] = bytes(disk.getSectorOfAU(aus[i], 0)[0:10]) if disk.isValidAU(aus[i]) else None
+            return names[i]
+
+        try:
+            key = name.encode('latin-1').ljust(10, b' ')
+        except UnicodeEncodeError:
+            key = None
+        (lo, hi) = (0, len(aus))
+        while (key is not None and lo < hi):
+            mid = (lo + hi) // 2
+            probe = getName(mid)
+            if (probe is None):
+                break
+            elif (probe == key):
+                return mid
+            elif (probe < key):
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(0, len(aus)):
+            if (getName(i) is not None and self.bytesToString(names[i]).rstrip() == name):
+                return i
+        return -1
+
+    def iterFiles(self):
+        # Every parsed FDR below this directory, including the chained FDRs of each file
+        dirs = [self]
+        while (dirs):
+            dir = dirs.pop()
+            if (dir.FDIRParsed and dir._FDIR is not None and dir._FDIR._FDRs is not None):
+                for fdr in dir._FDIR._FDRs:
+                    while (fdr is not None):
+                        yield fdr
+                        fdr = fdr._nextFDR
+            if (dir._subdirs is not None):
+                dirs.extend(dir._subdirs)
+
+    def parseAll(self):
+        # Parse everything below this directory that has not been parsed yet
+        dirs = [self]
+        while (dirs):
+            dir = dirs.pop()
+            if (dir.FDIR is not None):
+                for fdr in dir.FDIR.FDRs:
+                    while (fdr is not None):
+                        fdr = fdr.nextFDR
+            dirs.extend(reversed(dir.subdirs))
 
     def export(self, dirPath):
         dir = dirPath + '/' + self.name
@@ -223,6 +1197,76 @@ class TIDir(TIBase):
         for subdir in self.subdirs:
             subdir.export(dir)
 
+    def exportText(self, dirPath):
+        # Write every DIS/VAR file of the tree as FILE.txt, in the same directories as export uses
+        dirs = []
+        files = []
+        self.getExportTree(dirPath, dirs, files)
+        for dir in dirs:
+            os.makedirs(dir, exist_ok=True)
+        for (fdr, dir) in files:
+            if (fdr.isDisplayVariable()):
+                fdr.exportText(dir)
+
+    def exportParallel(self, dirPath, workers=None):
+        # Create the directory tree first, then export the files on a thread pool. Returns (fullPath, error) for
+        # every file that could not be exported, in tree order.
+        dirs = []
+        files = []
+        self.getExportTree(dirPath, dirs, files)
+        for dir in dirs:
+            os.mkdir(dir)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(exportFile, files))
+        return [(fdr.fullPath, error) for ((fdr, dir), error) in zip(files, results) if error is not None]
+
+    def exportArchive(self, fileobj, archiveFormat='tar'):
+        # Stream the tree as a tar (archiveFormat='tar' or 'tgz') or zip archive to fileobj, which does not need to be
+        # seekable. Files get TIFILES headers with the extended date/time fields and are read from the image buffer.
+        dirs = []
+        files = []
+        self.getExportTree('', dirs, files)
+        now = time.time()
+        if (archiveFormat == 'zip'):
+            archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+            dateTime = time.localtime(now)[0:6]
+            for dir in dirs:
+                archive.writestr(zipfile.ZipInfo(dir[1:] + '/', dateTime), b'')
+            for (fdr, dir) in files:
+                with archive.open(zipfile.ZipInfo(dir[1:] + '/' + fdr.name.replace('/', '.'), dateTime), 'w') as f:
+                    f.write(fdr.getHeader(True))
+                    for data in fdr.getDataViews():
+                        f.write(data)
+        elif (archiveFormat == 'tar' or archiveFormat == 'tgz'):
+            archive = tarfile.open(fileobj=fileobj, mode='w|gz' if archiveFormat == 'tgz' else 'w|')
+            for dir in dirs:
+                info = tarfile.TarInfo(dir[1:])
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = now
+                archive.addfile(info)
+            for (fdr, dir) in files:
+                header = fdr.getHeader(True)
+                views = [memoryview(header)] + fdr.getDataViews()
+                info = tarfile.TarInfo(dir[1:] + '/' + fdr.name.replace('/', '.'))
+                info.size = sum([len(v) for v in views])
+                info.mode = 0o644
+                info.mtime = now
+                archive.addfile(info, TIViewReader(views))
+        else:
+            raise Exception('Invalid archive format: ' + str(archiveFormat))
+        archive.close()
+
+    def getExportTree(self, dirPath, dirs, files):
+        # Directory paths to create and (file, directory path) pairs to export, parents before children
+        dir = dirPath + '/' + self.name
+        dirs.append(dir)
+        if (self.FDIR is not None):
+            for fdr in self.FDIR.FDRs:
+                files.append((fdr, dir))
+        for subdir in self.subdirs:
+            subdir.getExportTree(dir, dirs, files)
+
     def printVals(self, includeFiles=False, includeSubdirs=False, prefix=''):
         print(prefix + 'Directory at AU ' + str(self.au) + ':')
         self.printErrors(prefix + '  ')
@@ -236,24 +1280,76 @@ class TIDir(TIBase):
         self.printVal(prefix + '  Parent DDR AU:', str(self.parentDDR) + ' (' + str(self.parent.au) + ')')
         self.printVal(prefix + '  Subdirectory AUs:', self.subdirAUs)
 
-        self.FDIR.printVals(includeFiles, prefix + '  ')
+        if (self.FDIR is not None):
+            self.FDIR.printVals(includeFiles, prefix + '  ')
 
         if (includeSubdirs):
             for dir in self.subdirs:
                 dir.printVals(includeFiles, includeSubdirs, prefix + ' ')
 
+    def getRecord(self):
+        return {'record': 'dir', 'au': self.au, 'name': self.name, 'path': self.fullPath,
+                'created': self.creationDateTime.strip(), 'files': self.numFiles, 'subdirs': self.numSubdirs,
+                'FDIRAU': self.FDIRAU, 'parentDDRAU': self.parentDDR, 'subdirAUs': self.subdirAUs,
+                'FDIR': None if self.FDIR is None else self.FDIR.getRecord(),
+                'errors': self.getErrors(), 'warnings': self.getWarnings()}
+
+    def writeRecords(self, writer):
+        writer.write(self.getRecord())
+        if (self.FDIR is not None):
+            for fdr in self.FDIR.FDRs:
+                writer.write(fdr.getRecord())
+        for dir in self.subdirs:
+            dir.writeRecords(writer)
+
     def printSubdirs(self, prefix=''):
         for dir in self.subdirs:
             print(prefix + dir.name.ljust(10) + '      DIR     ' +
                   str(dir.numFiles + dir.numSubdirs).rjust(8) + '  ' + dir.creationDateTime)
 
-    def printTree(self, prefix=''):
+    def printTree(self, prefix='', recursive=True):
         print(prefix + self.fullPath + ':')
-        self.FDIR.printFiles(prefix + '  ')
+        if (self.FDIR is not None):
+            self.FDIR.printFiles(prefix + '  ')
         self.printSubdirs(prefix + '  ')
-        for dir in self.subdirs:
-            print()
-            dir.printTree(prefix + '  ')
+        if (recursive):
+            for dir in self.subdirs:
+                print()
+                dir.printTree(prefix + '  ')
+
+
+# Read-only stream over a list of memoryviews
+class TIViewReader(io.RawIOBase):
+    def __init__(self, views):
+        self.views = views
+        self.index = 0
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        n = 0
+        while (n < len(out) and self.index < len(self.views)):
+            view = self.views[self.index]
+            count = min(len(out) - n, len(view) - self.offset)
+            out[n:n+count] = view[self.offset:self.offset+count]
+            n += count
+            self.offset += count
+            if (self.offset >= len(view)):
+                self.index += 1
+                self.offset = 0
+        return n
+
+
+def exportFile(task):
+    (fdr, dirPath) = task
+    try:
+        fdr.export(dirPath)
+    except Exception as e:
+        return str(e)
+    return None
 
 
 # Parse File Descriptor Index Record (FDIR)
@@ -262,44 +1358,88 @@ class TIDir(TIBase):
 # Last entry (#128) always points back to associated DDR
 
 class TIFDIR(TIBase):
-    def __init__(self, disk, dir, au, fdir):
+    def __init__(self, disk, dir, au, fdir, oldFDRs=None):
+        # oldFDRs maps FDR AUs to already parsed files (see TIDisk.reanalyze) to keep instead of parsing them again
         super().__init__(disk, au, 'FDIR', 'I')
 
         self.dir = dir
         self.fullPath = dir.fullPath
+        self.isRecovered = False
 
         if (len(fdir) < disk.sectorSize):
             raise Exception('FDIR AU ' + str(au) + ' invalid length: ' + str(len(fdir)))
-        if (not disk.testBitmap(au)):
-            self.addWarning('marked as free in volume bitmap')
 
-        self.parentDDR = self.wordToInt(fdir[254:256])
+        FDRAUs = FDIR_LAYOUT.unpack_from(fdir)
+        self.parentDDR = FDRAUs[127]
         if (self.parentDDR != dir.au):
-            self.addError('parent DDR mismatch: DDR=' + str(self.parentDDR) + ' parentAU=' + str(parent.au))
+            self.addError('FDIRParentMismatch', self.parentDDR, dir.au)
 
         self.FDRAUs = []
-        self.FDRs = []
+        self._FDRs = None
+        self.foundFDRs = {}
         self.numFiles = 0
         sawZero = False
-        for i in range(0, 254, 2):
-            fdrAU = self.wordToInt(fdir[i:i+2])
+        for i in range(0, getNumUsedWords(fdir[0:254])):
+            fdrAU = FDRAUs[i]
             if (fdrAU):
                 if (sawZero):
-                    self.addWarning('ignored non-zero FDR AU after zero at byte ' + str(i) + ': ' + str(fdrAU))
+                    self.addWarning('FDRAfterZero', i * 2, fdrAU)
                 elif (disk.isValidAU(fdrAU)):
                     self.FDRAUs.append(fdrAU)
-                    self.FDRs.append(TIFile(disk, dir, self, None, 0, 0, fdrAU, 0, disk.getSectorOfAU(fdrAU, 0)))
                     self.numFiles += 1
                 else:
-                    self.addError('invalid FDR AU at byte ' + str(i) + ': ' + str(fdrAU))
+                    self.addError('badFDRAU', i * 2, fdrAU)
             else:
                 sawZero = True
+        if (not disk.lazy or oldFDRs is not None):
+            self.parseFDRs(oldFDRs)
 
-        if (self.numFiles != dir.numFiles):
-            self.addError('DDR/FDIR file count mismatch: DDR=' + str(dir.numFiles) + ' FDIR=' + str(self.numFiles))
+        self.countError = None
+        self.checkFileCount()
 
         disk.mapAU(au, self)
 
+    def checkFileCount(self):
+        error = None
+        if (self.numFiles != self.dir.numFiles):
+            error = ('DDRFileCountMismatch', self.dir.numFiles, self.numFiles)
+        if (error != self.countError):
+            if (self.countError is not None):
+                self.removeError(self.countError)
+            if (error is not None):
+                self.addError(*error)
+            self.countError = error
+
+    @property
+    def FDRs(self):
+        if (self._FDRs is None):
+            self.parseFDRs()
+        return self._FDRs
+
+    def findFDR(self, fdrAU):
+        # The file of one of FDRAUs, built on its own if the FDRs are not parsed yet (see TIDir.findFile)
+        if (fdrAU not in self.foundFDRs):
+            self.foundFDRs[fdrAU] = TIFile(self.disk, self.dir, self, None, 0, 0, fdrAU, 0,
+                                           self.disk.getSectorOfAU(fdrAU, 0))
+        return self.foundFDRs[fdrAU]
+
+    def parseFDRs(self, oldFDRs=None):
+        self._FDRs = []
+        for fdrAU in self.FDRAUs:
+            fdr = None if oldFDRs is None else oldFDRs.pop(fdrAU, None)
+            if (fdr is None):
+                fdr = self.foundFDRs.pop(fdrAU, None)
+            if (fdr is None):
+                if (not self.disk.canParse()):
+                    break
+                fdr = TIFile(self.disk, self.dir, self, None, 0, 0, fdrAU, 0, self.disk.getSectorOfAU(fdrAU, 0))
+            else:
+                chained = fdr
+                while (chained is not None):
+                    chained.fdir = self
+                    chained = chained._nextFDR
+            self._FDRs.append(fdr)
+
     def export(self, dirPath):
         for fdr in self.FDRs:
             fdr.export(dirPath)
@@ -315,6 +1455,10 @@ class TIFDIR(TIBase):
             for fdr in self.FDRs:
                 fdr.printVals(prefix + ' ')
 
+    def getRecord(self):
+        return {'au': self.au, 'files': self.numFiles, 'FDRAUs': self.FDRAUs,
+                'errors': self.getErrors(), 'warnings': self.getWarnings()}
+
     def printFiles(self, prefix=''):
         for fdr in self.FDRs:
             flags = ' '
@@ -329,6 +1473,42 @@ class TIFDIR(TIBase):
                   fdr.creationDateTime + '  ' + fdr.modificationDateTime)
 
 
+# Files recovered from orphan FDRs (see TIDisk.recoverFiles), grouped by the FDIR AU the FDRs claim.
+# Stands in for both the directory and the FDIR of the recovered files, and is not mapped on the disk.
+
+class TIRecoveredFDIR(TIFDIR):
+    def __init__(self, disk, au):
+        TIBase.__init__(self, disk, au, 'RCVR', 'I')
+
+        self.dir = self
+        self.name = 'FDIR' + str(au)
+        self.fullPath = 'RECOVERED.' + self.name
+        self.isRecovered = True
+        self.parentDDR = 0
+        self.FDRAUs = []
+        self._FDRs = []
+        self.numFiles = 0
+
+    def addFDR(self, fdrAU):
+        fdr = TIFile(self.disk, self, self, None, 0, 0, fdrAU, 0, self.disk.getSectorOfAU(fdrAU, 0))
+        self.FDRAUs.append(fdrAU)
+        self.FDRs.append(fdr)
+        self.numFiles += 1
+        return fdr
+
+    def export(self, dirPath):
+        dir = dirPath + '/' + self.name
+        os.mkdir(dir)
+        fileNames = set()
+        for fdr in self.FDRs:
+            fileName = fdr.name.replace('/', '.')
+            if (fileName in fileNames):
+                # Several deleted versions of a file may claim the same FDIR
+                fileName += '.' + str(fdr.au)
+            fileNames.add(fileName)
+            fdr.export(dir, fileName)
+
+
 # Parse File Descriptor Record (FDR)
 # 0-9   File name padded with spaces to the right
 # 10-11 Extended record length (if data file has a record length greater than 255 bytes)
@@ -379,188 +1559,269 @@ class TIFDIR(TIBase):
 # The number of contiguous AUs allocated by the cluster is the difference plus 1.
 
 class TIFile(TIBase):
+    __slots__ = ('dir', 'fdir', 'prevFDR', 'firstFDR', 'chainIndex', '_extents', '_sectorsInUse', '_nextFDR',
+                 'nextFDRParsed', 'sectorOffset', 'name', 'extendedRecordLength', 'flags', 'recordsPerSector',
+                 'numSectorsAllocated', 'EOFOffset', 'logicalRecordLength', 'numLevel3Records',
+                 'created', 'modified', 'prevFDRAU', 'nextFDRAU', 'numAllocatedAUs', 'FDIRAU', 'extendedInfo',
+                 'dataChainPointers')
+
     def __init__(self, disk, dir, fdir, prevFDR, prevFDRAU, prevFDRAUSectorOffset, au, sectorOffset, fdr):
         super().__init__(disk, au, 'FDR', 'F')
 
         self.dir = dir
         self.fdir = fdir
         self.prevFDR = prevFDR
-        self.nextFDR = None
+        self.firstFDR = self if prevFDR is None else prevFDR.firstFDR
+        self.chainIndex = 0 if prevFDR is None else prevFDR.chainIndex + 1
+        self._extents = None
+        self._sectorsInUse = None
+        self._nextFDR = None
+        self.nextFDRParsed = False
         self.sectorOffset = sectorOffset
-        self.b = fdr
 
-        if (sectorOffset > 0):
-            disk.mapSectorOfAU(au, sectorOffset, self)
-        else:
-            disk.mapAU(au, self)
+        # A recovered FDR that overlaps sectors already owned is reported and left unmapped. A chained FDR only
+        # owns its own sector, the first FDR of a file the whole AU.
+        startSector = au * disk.sectorsPerAU + sectorOffset
+        endSector = startSector if (sectorOffset > 0) else startSector + disk.sectorsPerAU - 1
+        if (not fdir.isRecovered or not self.findConflicts(startSector, endSector, 'FDR')):
+            if (sectorOffset > 0):
+                disk.mapSectorOfAU(au, sectorOffset, self)
+            else:
+                disk.mapAU(au, self)
 
         if (len(fdr) < disk.sectorSize):
             raise Exception('FDR AU ' + str(au) + ' invalid length: ' + str(len(fdr)))
 
-        if ((self.bytesToString(fdr[28:30]) != 'FI') and (self.wordToInt(fdr[28:30]) != 0)):
-            self.addWarning('invalid magic: ' + self.bytesToString(fdr[28:30]))
+        (name, self.extendedRecordLength, self.flags, self.recordsPerSector, self.numSectorsAllocated, self.EOFOffset,
+         self.logicalRecordLength, numLevel3Records, self.created, self.modified, magic, self.prevFDRAU,
+         self.nextFDRAU, self.numAllocatedAUs, self.FDIRAU, self.extendedInfo) = FDR_LAYOUT.unpack_from(fdr)
 
-        if (not disk.testBitmap(au)):
-            self.addWarning('marked as free in volume bitmap')
+        if (magic != b'FI' and magic != b'\0\0'):
+            self.addWarning('badMagic', self.bytesToString(magic))
 
         if (sectorOffset and prevFDRAU == 0):
-            self.addError('has prevFDRAU=' + str(prevFDRAU) + ' with non-zero sectorOffset=' + str(sectorOffset))
+            self.addError('prevFDRAUWithOffset', prevFDRAU, sectorOffset)
 
-        name = fdr[0:10]
         self.name = self.bytesToString(name).rstrip()
         if (not self.isValidName(name)):
-            self.addError('invalid name: ' + self.name)
+            self.addError('badName', self.name)
 
         if (dir == disk):
             self.fullPath = self.name
         else:
             self.fullPath = dir.fullPath + '.' + self.name
+        if (prevFDR is None and not fdir.isRecovered):
+            disk.pathIndex.add(self)
 
-        self.extendedRecordLength = self.wordToInt(fdr[10:12])
-        self.flags = fdr[12]
-        self.isVariable = bool(self.flags & 0x80)
-        self.isDSK1Emu = bool(self.flags & 0x20)
-        self.isModifiedSinceBackup = bool(self.flags & 0x10)
-        self.isProtected = bool(self.flags & 0x08)
-        self.isInternal = bool(self.flags & 0x02)
-        self.isProgram = bool(self.flags & 0x01)
+        self.numLevel3Records = ((numLevel3Records & 0xff) << 8) | (numLevel3Records >> 8)
 
-        self.recordsPerSector = int(fdr[13])
-        self.numSectorsAllocated = self.wordToInt(fdr[14:16])
-
-        self.EOFOffset = int(fdr[16])
-        self.logicalRecordLength = int(fdr[17])
-
-        self.recordLength = self.logicalRecordLength
-        if ((not self.isProgram or self.isDSK1Emu) and (self.logicalRecordLength == 0)):
-            self.recordLength = self.extendedRecordLength
-
-        self.numLevel3Records = self.littleEndianWordToInt(fdr[18:20])
-
-        self.creationDateTime = self.dateTimeToString(fdr[20:24])
-        self.modificationDateTime = self.dateTimeToString(fdr[24:28])
-
-        self.prevFDRAU = self.wordToInt(fdr[30:32])
         if (self.prevFDRAU != prevFDRAU):
-            self.addError('previous FDR AU mismatch: ' + str(self.prevFDRAU) + '/' + str(prevFDRAU))
+            self.addError('prevFDRAUMismatch', self.prevFDRAU, prevFDRAU)
 
-        self.nextFDRAU = self.wordToInt(fdr[32:34])
         if (not disk.isValidAU(self.nextFDRAU)):
-            self.addError('invalid next FDR AU: ' + str(self.nextFDRAU))
-
-        self.numAllocatedAUs = self.wordToInt(fdr[34:36])
+            self.addError('badNextFDRAU', self.nextFDRAU)
 
-        self.FDIRAU = self.wordToInt(fdr[36:38])
         if (self.FDIRAU != fdir.au):
-            self.addError('FDIR AU mismatch: ' + str(self.FDIRAU) + '/' + str(fdir.au))
+            self.addError('FDIRAUMismatch', self.FDIRAU, fdir.au)
 
-        self.extendedInfo = self.wordToInt(fdr[38:40])
         self.numSectorsAllocated += int((self.extendedInfo >> 12) & 0x0f) * 65536
         if (self.isVariable):
             self.numLevel3Records += int((self.extendedInfo >> 8) & 0x0f) * 65536
-        self.prevFDRAUSectorOffset = int((self.extendedInfo >> 4) & 0x0f)
-        self.nextFDRAUSectorOffset = int(self.extendedInfo & 0x0f)
 
         if (self.prevFDRAUSectorOffset != prevFDRAUSectorOffset):
-            self.addError('previous FDR AU sector offset mismatch: ' +
-                          str(self.prevFDRAUSectorOffset) + '/' + str(prevFDRAUSectorOffset))
+            self.addError('prevSectorOffsetMismatch', self.prevFDRAUSectorOffset, prevFDRAUSectorOffset)
 
         if (not disk.isValidSectorOfAU(self.prevFDRAU, self.prevFDRAUSectorOffset)):
-            self.addError('previous FDR AU sector offset invalid: AU=' + str(prevFDRAU) +
-                          ' sector=' + str(prevFDRAUSectorOffset))
-
-        self.programLength = 0
-        if (self.isProgram):
-            if (self.EOFOffset > 0):
-                self.programLength = (self.numSectorsAllocated - 1) * disk.sectorSize + self.EOFOffset
-            else:
-                self.programLength = self.numSectorsAllocated * disk.sectorSize
-
+            self.addError('badPrevSectorOffset', prevFDRAU, prevFDRAUSectorOffset)
 
         self.dataChainPointers = []
         allocatedAUs = 0
         sawZero = False
-        for i in range(40, 256, 4):
-            start = self.wordToInt(fdr[i:i+2])
-            end = self.wordToInt(fdr[i+2:i+4])
+        clusters = DATA_CHAIN_LAYOUTS[(getNumUsedWords(fdr[40:256]) + 1) // 2].unpack_from(fdr, 40)
+        for i in range(40, 40 + len(clusters) * 2, 4):
+            start = clusters[(i - 40) // 2]
+            end = clusters[(i - 40) // 2 + 1]
             if ((end < start) or ((start == 0) and (end != 0))):
-                self.addError('data chain at byte ' + str(i) + ': invalid: start=' + str(start) + ', end=' + str(end))
+                self.addError('badDataChain', i, start, end)
             elif (start == 0):
                 sawZero = True
             elif (sawZero):
-                self.addWarning('ignored non-zero data chain AU after zero at byte ' + str(i) + ': [' +
-                                str(start) + ',' + str(end) + ']')
+                self.addWarning('dataChainAfterZero', i, start, end)
             elif (not self.hasErrors):
                 # don't bother mapping the data chain if there are errors with this FDR as the chain is likely garbage
                 dataChain = TIAURange(disk, self, start, end)
                 if (dataChain.isValid()):
                     self.dataChainPointers.append(dataChain)
-                    for dataAU in range(start, end+1):
-                        disk.mapAU(dataAU, dataChain)
-                        if (not disk.testBitmap(dataAU)):
-                            self.addWarning('data chain AU ' + str(dataAU) + ' marked as free in volume bitmap')
-
+                    if (not (fdir.isRecovered and
+                             self.findConflicts(start * disk.sectorsPerAU, (end + 1) * disk.sectorsPerAU - 1,
+                                                'data chain [' + str(start) + ',' + str(end) + ']'))):
+                        disk.mapAURange(start, end, dataChain)
                     allocatedAUs += dataChain.getNumAUs()
                 else:
-                    self.addError('invalid data chain at byte ' + str(i) + ': [' + str(start) + ',' + str(end) + ']')
+                    self.addError('invalidDataChain', i, start, end)
 
         if (allocatedAUs != self.numAllocatedAUs):
-            self.addError('allocated AU mismatch: ' + str(allocatedAUs) + '/' + str(self.numAllocatedAUs))
+            self.addError('allocatedAUMismatch', allocatedAUs, self.numAllocatedAUs)
 
         # More logical validations
         if (self.isProgram):
             # Program files should have zeros for logical record length and records per sector
             if (self.logicalRecordLength != 0):
-                self.addWarning('logical record length is ' + str(self.logicalRecordLength) +
-                                ', expected 0 for PROGRAM type')
+                self.addWarning('programRecordLength', self.logicalRecordLength)
             if (self.recordsPerSector != 0):
-                self.addWarning('records per sector is ' + str(self.recordsPerSector) +
-                                ', expected 0 for PROGRAM type')
+                self.addWarning('programRecordsPerSector', self.recordsPerSector)
             if (self.numLevel3Records != 0):
-                self.addWarning('number of level 3 records is ' + str(self.numLevel3Records) +
-                                ', expected 0 for PROGRAM type')
+                self.addWarning('programLevel3Records', self.numLevel3Records)
         else:
             if (self.logicalRecordLength == 0):
-                self.addError('logical record length is 0, expected non-zero for non-PROGRAM type')
+                self.addError('noRecordLength')
             if (self.isVariable):
                 # level 3 records = number of sectors within file with data written to for VARIABLE data
                 if (self.numLevel3Records > self.numSectorsAllocated):
-                    self.addError('number of sectors with data (L3 records) ' + str(self.numLevel3Records) +
-                                  ' > total allocated sectors ' + str(self.numSectorsAllocated))
+                    self.addError('variableLevel3Records', self.numLevel3Records, self.numSectorsAllocated)
             else:
                 # level 3 records = number of records written for FIXED files
                 if (self.recordsPerSector == 0):
-                    self.addError('records per sector is 0, expected non-zero for FIXED type')
+                    self.addError('noRecordsPerSector')
                 elif (self.numLevel3Records > (self.recordsPerSector * self.numSectorsAllocated)):
-                    self.addError('L3 records is ' + str(self.numLevel3Records) + ' but max allocated records is ' +
-                                  str(self.recordsPerSector * self.numSectorsAllocated))
-
-        if (self.nextFDRAU != 0):
-            if (disk.isValidSectorOfAU(self.nextFDRAU, self.nextFDRAUSectorOffset)):
-                self.nextFDR = TIFile(disk, dir, fdir, self, au, sectorOffset,
-                                      self.nextFDRAU, self.nextFDRAUSectorOffset,
-                                      disk.getSectorOfAU(self.nextFDRAU, self.nextFDRAUSectorOffset))
-            else:
-                self.addError('next FDR AU sector offset invalid: AU=' + str(self.nextFDRAU) +
-                              ' sector=' + str(self.nextFDRAUSectorOffset))
+                    self.addError('fixedLevel3Records', self.numLevel3Records,
+                                  self.recordsPerSector * self.numSectorsAllocated)
+
+        if (self.nextFDRAU == 0):
+            self.nextFDRParsed = True
+        elif (not disk.isValidSectorOfAU(self.nextFDRAU, self.nextFDRAUSectorOffset)):
+            self.addError('badNextSectorOffset', self.nextFDRAU, self.nextFDRAUSectorOffset)
+            self.nextFDRParsed = True
+        elif (not disk.lazy and prevFDR is None):
+            self.parseChain()
 
         if (self.getFileSectorsInUse() > self.numSectorsAllocated):
-            self.addWarning('sectors in use ' + str(self.getFileSectorsInUse()) + ' > sectors allocated ' +
-                            str(self.numSectorsAllocated))
+            self.addWarning('sectorsInUse', self.getFileSectorsInUse(), self.numSectorsAllocated)
 
-    def getFirstFDR(self):
+    @property
+    def b(self):
+        # The FDR sector, as a view of the image
+        return self.disk.getSectorOfAU(self.au, self.sectorOffset)
+
+    @property
+    def isVariable(self):
+        return bool(self.flags & 0x80)
+
+    @property
+    def isDSK1Emu(self):
+        return bool(self.flags & 0x20)
+
+    @property
+    def isModifiedSinceBackup(self):
+        return bool(self.flags & 0x10)
+
+    @property
+    def isProtected(self):
+        return bool(self.flags & 0x08)
+
+    @property
+    def isInternal(self):
+        return bool(self.flags & 0x02)
+
+    @property
+    def isProgram(self):
+        return bool(self.flags & 0x01)
+
+    @property
+    def recordLength(self):
+        if ((not self.isProgram or self.isDSK1Emu) and (self.logicalRecordLength == 0)):
+            return self.extendedRecordLength
+        return self.logicalRecordLength
+
+    @property
+    def prevFDRAUSectorOffset(self):
+        return int((self.extendedInfo >> 4) & 0x0f)
+
+    @property
+    def nextFDRAUSectorOffset(self):
+        return int(self.extendedInfo & 0x0f)
+
+    @property
+    def programLength(self):
+        if (not self.isProgram):
+            return 0
+        elif (self.EOFOffset > 0):
+            return (self.numSectorsAllocated - 1) * self.disk.sectorSize + self.EOFOffset
+        else:
+            return self.numSectorsAllocated * self.disk.sectorSize
+
+    @property
+    def creationDateTime(self):
+        return self.dateTimeIntToString(self.created)
+
+    @property
+    def modificationDateTime(self):
+        return self.dateTimeIntToString(self.modified)
+
+    @property
+    def nextFDR(self):
+        if (not self.nextFDRParsed):
+            self.parseNextFDR()
+        return self._nextFDR
+
+    def parseChain(self):
+        # Parse the FDRs chained after this one, one after the other
+        visited = set([(self.au, self.sectorOffset)])
         fdr = self
-        while fdr.prevFDR is not None:
-            fdr = fdr.prevFDR
-        return fdr
+        while (not fdr.nextFDRParsed):
+            fdr.parseNextFDR(visited)
+            fdr = fdr._nextFDR
+            if (fdr is None):
+                break
+            visited.add((fdr.au, fdr.sectorOffset))
+
+    def parseNextFDR(self, visited=None):
+        # Parse the next FDR unless it loops back into the chain, the chain is too long or the parse budget is used
+        # up. visited holds the (AU, sector offset) of the FDRs up to this one, found by walking back if not given.
+        self.nextFDRParsed = True
+        disk = self.disk
+        maxFDRChain = disk.limits.maxFDRChain
+        if (visited is None):
+            visited = set()
+            fdr = self
+            while (fdr is not None):
+                visited.add((fdr.au, fdr.sectorOffset))
+                fdr = fdr.prevFDR
+        if ((self.nextFDRAU, self.nextFDRAUSectorOffset) in visited):
+            self.addError('FDRChainLoop', self.nextFDRAU, self.nextFDRAUSectorOffset)
+        elif (maxFDRChain is not None and self.chainIndex + 1 >= maxFDRChain):
+            self.addError('FDRChainTooLong', self.nextFDRAU, maxFDRChain)
+        elif (disk.canParse()):
+            self._nextFDR = TIFile(disk, self.dir, self.fdir, self, self.au, self.sectorOffset,
+                                   self.nextFDRAU, self.nextFDRAUSectorOffset,
+                                   disk.getSectorOfAU(self.nextFDRAU, self.nextFDRAUSectorOffset))
+
+    def findConflicts(self, startSector, endSector, what):
+        # Recovered files are only mapped where they don't overlap sectors that are already owned
+        owners = []
+        for owner in self.disk.getOwnersOfSectors(startSector, endSector):
+            if (owner not in owners):
+                owners.append(owner)
+                self.addError('conflict', what, owner.type, owner.au, owner.fullPath)
+        return (len(owners) > 0)
+
+    def getFirstFDR(self):
+        return self.firstFDR
 
     def getFileAllocatedSize(self):
         return getFirstFDR().numSectorsAllocated * self.disk.sectorSize
 
     def getFileSectorsInUse(self):
+        # Computed once per file, from the first FDR
         fdr = self.getFirstFDR()
+        if (fdr._sectorsInUse is None):
+            fdr._sectorsInUse = fdr.computeFileSectorsInUse()
+        return fdr._sectorsInUse
+
+    def computeFileSectorsInUse(self):
+        fdr = self
         if (fdr.isProgram):
-            numSectors = self.programLength // self.disk.sectorSize
+            numSectors = fdr.programLength // self.disk.sectorSize
             if (fdr.programLength % self.disk.sectorSize > 0):
                 numSectors += 1
             return numSectors
@@ -585,17 +1846,20 @@ class TIFile(TIBase):
                 sectorsPerRecord += 1
             return (fdr.numLevel3Records * sectorsPerRecord)
 
-    def containsDataInAU(self, au):
+    def getExtents(self):
+        # Extent table of the whole file (all FDRs of the chain), built once per file
         fdr = self.getFirstFDR()
-        lastRelativeSector = fdr.getFileSectorsInUse() - 1
-        relativeSector = 0
-        while ((fdr is not None) and (relativeSector <= lastRelativeSector)):
-            for dcp in fdr.dataChainPointers:
-                if (dcp.containsAU(au)):
-                    return True
-                relativeSector += dcp.getNumSectors()
-            fdr = fdr.nextFDR
-        return False
+        if (fdr._extents is None):
+            fdr._extents = TIFileExtents(fdr)
+        return fdr._extents
+
+    def containsDataInAU(self, au):
+        # True if any in-use sector of the file is in the AU
+        return self.getExtents().containsData(au * self.disk.sectorsPerAU, (au + 1) * self.disk.sectorsPerAU - 1,
+                                              self.getFileSectorsInUse())
+
+    def open(self):
+        return TIFileReader(self.getFirstFDR())
 
     def getFileType(self):
         if (self.isDSK1Emu):
@@ -612,9 +1876,18 @@ class TIFile(TIBase):
         else:
             return 'DIS/FIX ' + str(self.recordLength).rjust(8)
 
-    def export(self, dirPath):
+    def export(self, dirPath, fileName=None):
+        fdr = self.getFirstFDR()
+        if (fileName is None):
+            fileName = fdr.name.replace('/', '.')
+        f = open(dirPath + '/' + fileName, 'wb')
+        f.write(self.getHeader())
+        for data in self.getDataViews():
+            f.write(data)
+        f.close()
+
+    def getHeader(self, extended=False):
         fdr = self.getFirstFDR()
-        f = open(dirPath + '/' + fdr.name.replace('/', '.'), 'wb')
         header = bytearray(128)
         header[0] = 0x07                # TIFILES header
         header[1] = ord('T')
@@ -633,22 +1906,108 @@ class TIFile(TIBase):
         header[16:26] = fdr.b[0:10]     # Filename
         header[26] = 0x00               # MXT (not used)
         header[27] = 0x00               # Reserved (not used)
-#        header[28] = 0xff               # Extended header flag
-#        header[29] = 0xff               # Extended header flag
-#        header[30:38] = fdr.b[20:28]    # Creation and update date and time
-        f.write(header)
-
-        sectorNum = 0
-        while (fdr is not None):
-            for dcp in fdr.dataChainPointers:
-                for au in range(dcp.start, dcp.end +1 ):
-                    for sector in range(0, self.disk.sectorsPerAU):
-                        if (sectorNum < fdr.numSectorsAllocated):
-                            f.write(self.disk.getSectorOfAU(au, sector))
-                            sectorNum += 1
-            fdr = fdr.nextFDR
+        if (extended):
+            header[28] = 0xff               # Extended header flag
+            header[29] = 0xff               # Extended header flag
+            header[30:38] = fdr.b[20:28]    # Creation and update date and time
+        return header
+
+    def getDataViews(self, offset=0, length=None):
+        # Memoryviews of the image holding the file data from byte offset on (all of it if length is None), one per
+        # data chain cluster
+        return self.getExtents().getViews(offset, length)
+
+    # Record decoding. Records are memoryviews of the image (valid while it is open; copy with bytes() to keep them),
+    # decoded one sector at a time so memory use does not depend on the file size.
+    # FIXED      numLevel3Records records of recordLength bytes, as many as fit in each sector, or each starting on a
+    #            sector boundary and spanning several sectors if recordLength > sectorSize
+    # VARIABLE   numLevel3Records sectors, each holding records of a length byte followed by the data, then 0xff
+
+    def iterSectors(self, numSectors=None):
+        # Memoryviews of the file's sectors in file order, the first numSectors of them (default: all allocated)
+        extents = self.getExtents()
+        sectorSize = self.disk.sectorSize
+        if (numSectors is None):
+            numSectors = extents.numSectors
+        for i in range(0, len(extents)):
+            for sector in range(extents.sectors[i], extents.sectors[i] + extents.lengths[i]):
+                if (numSectors <= 0):
+                    return
+                numSectors -= 1
+                yield self.disk.view[sector * sectorSize:(sector + 1) * sectorSize]
+
+    def iterRecords(self):
+        fdr = self.getFirstFDR()
+        if (fdr.isProgram or fdr.isDSK1Emu):
+            raise Exception(fdr.fullPath + ': PROGRAM files have no records')
+        elif (fdr.isVariable):
+            return fdr.iterVariableRecords()
+        else:
+            return fdr.iterFixedRecords()
+
+    def iterVariableRecords(self):
+        sectorSize = self.disk.sectorSize
+        for sector in self.iterSectors(self.numLevel3Records):
+            i = 0
+            while (i < sectorSize and sector[i] != 0xff):
+                end = i + 1 + sector[i]
+                if (end > sectorSize):
+                    raise Exception(self.fullPath + ': record at sector offset ' + str(i) + ' runs past the sector')
+                yield sector[i+1:end]
+                i = end
+
+    def iterFixedRecords(self):
+        sectorSize = self.disk.sectorSize
+        recordLength = self.recordLength
+        if (recordLength == 0):
+            recordLength = 256
+        numRecords = self.numLevel3Records
+        if (recordLength <= sectorSize):
+            recordsPerSector = sectorSize // recordLength
+            for sector in self.iterSectors(self.getFileSectorsInUse()):
+                for i in range(0, min(recordsPerSector, numRecords) * recordLength, recordLength):
+                    yield sector[i:i+recordLength]
+                numRecords -= recordsPerSector
+        else:
+            sectorsPerRecord = (recordLength + sectorSize - 1) // sectorSize
+            extents = self.getExtents()
+            for record in range(0, numRecords):
+                offset = record * sectorsPerRecord * sectorSize
+                if (offset + recordLength > extents.size):
+                    return
+                views = extents.getViews(offset, recordLength)
+                if (len(views) == 1):
+                    yield views[0]
+                else:
+                    # The record crosses a data chain cluster boundary
+                    yield memoryview(b''.join(views))
 
-        f.close()
+    def isDisplayVariable(self):
+        fdr = self.getFirstFDR()
+        return (fdr.isVariable and not fdr.isInternal and not fdr.isProgram and not fdr.isDSK1Emu)
+
+    def writeText(self, f, bufferSize=65536):
+        # Write the records of a DIS/VAR file to the binary stream f as newline-terminated lines
+        if (not self.isDisplayVariable()):
+            raise Exception(self.fullPath + ': not a DIS/VAR file')
+        pieces = []
+        size = 0
+        for record in self.iterRecords():
+            pieces.append(record)
+            pieces.append(b'\n')
+            size += len(record) + 1
+            if (size >= bufferSize):
+                f.write(b''.join(pieces))
+                pieces = []
+                size = 0
+        f.write(b''.join(pieces))
+
+    def exportText(self, dirPath, fileName=None):
+        fdr = self.getFirstFDR()
+        if (fileName is None):
+            fileName = fdr.name.replace('/', '.') + '.txt'
+        with open(dirPath + '/' + fileName, 'wb') as f:
+            fdr.writeText(f)
 
 
     def printVals(self, prefix=''):
@@ -678,10 +2037,37 @@ class TIFile(TIBase):
         if (self.nextFDR is not None):
             self.nextFDR.printVals(prefix + '  ')
 
+    def getRecord(self):
+        # The continuation FDRs follow in chainedFDRs, in chain order, each without a chainedFDRs of its own
+        record = self.getFDRRecord()
+        record['chainedFDRs'] = []
+        fdr = self.nextFDR
+        while (fdr is not None):
+            record['chainedFDRs'].append(fdr.getFDRRecord())
+            fdr = fdr.nextFDR
+        return record
+
+    def getFDRRecord(self):
+        return {'record': 'file', 'au': self.au, 'sectorOffset': self.sectorOffset, 'name': self.name,
+                'path': self.fullPath, 'fileType': self.getFileType()[0:7],
+                'size': self.programLength if (self.isProgram or self.isDSK1Emu) else self.recordLength,
+                'flags': self.flags, 'needsBackup': self.isModifiedSinceBackup, 'protected': self.isProtected,
+                'recordsPerSector': self.recordsPerSector, 'sectorsAllocated': self.numSectorsAllocated,
+                'EOFOffset': self.EOFOffset, 'level3Records': self.numLevel3Records,
+                'created': self.creationDateTime.strip(), 'modified': self.modificationDateTime.strip(),
+                'prevFDRAU': self.prevFDRAU, 'prevFDRAUSectorOffset': self.prevFDRAUSectorOffset,
+                'nextFDRAU': self.nextFDRAU, 'nextFDRAUSectorOffset': self.nextFDRAUSectorOffset,
+                'allocatedAUs': self.numAllocatedAUs, 'FDIRAU': self.FDIRAU, 'extendedInfo': self.extendedInfo,
+                'dataChain': [[dcp.start, dcp.end] for dcp in self.dataChainPointers],
+                'errors': self.getErrors(), 'warnings': self.getWarnings()}
+
 
 class TIAURange(TIBase):
+    __slots__ = ('fdr', 'start', 'end')
+
     def __init__(self, disk, fdr, start, end):
         super().__init__(disk, fdr.au, 'DCPB', 'o')
+        self.fdr = fdr
         self.start = start
         self.end = end
         self.fullPath = fdr.fullPath
@@ -707,6 +2093,188 @@ class TIAURange(TIBase):
                 sector <= self.end * self.disk.sectorsPerAU)
 
 
+# Extent table of a file: maps file relative sectors to disk sectors across the whole FDR chain.
+# starts     File relative first sector of each extent (prefix sums of the extent lengths)
+# sectors    Disk sector of the first sector of each extent
+# lengths    Number of sectors of each extent, clamped to the number of sectors allocated (see TIFile.getDataViews)
+# The extents are also kept sorted by disk sector, with the running maximum of their ends, to find the extents
+# overlapping a disk sector range without a scan.
+
+class TIFileExtents:
+    def __init__(self, fdr):
+        disk = fdr.disk
+        self.disk = disk
+        self.starts = array.array('I')
+        self.sectors = array.array('I')
+        self.lengths = array.array('I')
+        sectorNum = 0
+        while (fdr is not None):
+            for dcp in fdr.dataChainPointers:
+                numSectors = min(dcp.getNumSectors(), fdr.numSectorsAllocated - sectorNum)
+                if (numSectors > 0):
+                    self.starts.append(sectorNum)
+                    self.sectors.append(dcp.start * disk.sectorsPerAU)
+                    self.lengths.append(numSectors)
+                    sectorNum += numSectors
+            fdr = fdr.nextFDR
+        self.numSectors = sectorNum
+        self.size = sectorNum * disk.sectorSize
+
+        self.byDiskSector = sorted(range(0, len(self.sectors)), key=self.sectors.__getitem__)
+        self.diskStarts = array.array('I', [self.sectors[i] for i in self.byDiskSector])
+        self.maxEnds = array.array('I')
+        maxEnd = 0
+        for i in self.byDiskSector:
+            maxEnd = max(maxEnd, self.sectors[i] + self.lengths[i] - 1)
+            self.maxEnds.append(maxEnd)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, relativeSector):
+        # Index of the extent holding a file relative sector, or -1
+        if (relativeSector < 0 or relativeSector >= self.numSectors):
+            return -1
+        return bisect.bisect_right(self.starts, relativeSector) - 1
+
+    def getDiskSector(self, relativeSector):
+        i = self.find(relativeSector)
+        if (i < 0):
+            return None
+        return self.sectors[i] + relativeSector - self.starts[i]
+
+    def containsData(self, start, end, sectorsInUse=None):
+        # True if disk sectors [start, end] hold any of the first sectorsInUse sectors of the file
+        if (sectorsInUse is None):
+            sectorsInUse = self.numSectors
+        j = bisect.bisect_right(self.diskStarts, end) - 1
+        while (j >= 0 and self.maxEnds[j] >= start):
+            i = self.byDiskSector[j]
+            if (self.sectors[i] + self.lengths[i] - 1 >= start):
+                firstSector = self.starts[i] + max(start - self.sectors[i], 0)
+                if (firstSector < sectorsInUse):
+                    return True
+            j -= 1
+        return False
+
+    def getViews(self, offset=0, length=None):
+        # Memoryviews of the image for file bytes [offset, offset + length)
+        sectorSize = self.disk.sectorSize
+        if (length is None or offset + length > self.size):
+            length = self.size - offset
+        views = []
+        i = self.find(offset // sectorSize)
+        while (length > 0 and i >= 0 and i < len(self.starts)):
+            extentOffset = offset - self.starts[i] * sectorSize
+            count = min(length, self.lengths[i] * sectorSize - extentOffset)
+            start = self.sectors[i] * sectorSize + extentOffset
+            views.append(self.disk.view[start:start + count])
+            offset += count
+            length -= count
+            i += 1
+        return views
+
+
+# Seekable read-only stream over the data of a file (all allocated sectors, as exported without the header)
+
+class TIFileReader(io.RawIOBase):
+    def __init__(self, fdr):
+        self.extents = fdr.getExtents()
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if (whence == io.SEEK_CUR):
+            offset += self.position
+        elif (whence == io.SEEK_END):
+            offset += self.extents.size
+        elif (whence != io.SEEK_SET):
+            raise ValueError('Invalid whence: ' + str(whence))
+        if (offset < 0):
+            raise ValueError('Negative seek position: ' + str(offset))
+        self.position = offset
+        return self.position
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        n = 0
+        for view in self.extents.getViews(self.position, len(out)):
+            out[n:n+len(view)] = view
+            n += len(view)
+        self.position += n
+        return n
+
+
+# Candidate FDR or DDR found by scanning the first sector of every AU (see TIDisk.findCandidates)
+# type          'DDR' if bytes 13-15 are "DIR", otherwise 'FDR'
+# FDIRAU        FDIR pointer claimed by the record (bytes 24-25 of a DDR, 36-37 of an FDR)
+# parentDDRAU   Parent DDR pointer of a DDR
+# dataChain     (start, end) data chain clusters of an FDR, up to the first zero entry
+# dataChainValid  True if every cluster is in range and they add up to the FDR's allocated AUs (None for a DDR)
+# inTree        True if the AU is already mapped as an FDR or DDR of the tree
+
+class TICandidate:
+    def __init__(self, disk, au, sectorBytes):
+        self.au = au
+        fields = FDR_LAYOUT.unpack_from(sectorBytes)
+        self.name = disk.bytesToString(fields[0]).rstrip()
+        mapType = disk.logicalMap[au * disk.sectorsPerAU]
+        self.inTree = (mapType == 'F' or mapType == 'D')
+        self.prevFDRAU = 0
+        self.nextFDRAU = 0
+        self.nextFDRAUSectorOffset = 0
+        self.parentDDRAU = 0
+        self.dataChain = []
+        self.dataChainValid = None
+        if (bytes(sectorBytes[13:16]) == b'DIR'):
+            self.type = 'DDR'
+            (self.FDIRAU, self.parentDDRAU) = DDR_LAYOUT.unpack_from(sectorBytes)[8:10]
+        else:
+            self.type = 'FDR'
+            (self.prevFDRAU, self.nextFDRAU, numAllocatedAUs, self.FDIRAU, extendedInfo) = fields[11:16]
+            self.nextFDRAUSectorOffset = extendedInfo & 0x0f
+            self.dataChainValid = True
+            allocatedAUs = 0
+            dataChain = DATA_CHAIN_LAYOUTS[(getNumUsedWords(sectorBytes[40:256]) + 1) // 2].unpack_from(sectorBytes, 40)
+            for i in range(0, len(dataChain), 2):
+                start = dataChain[i]
+                end = dataChain[i + 1]
+                if (start == 0 and end == 0):
+                    break
+                if ((start == 0) or (end < start) or not disk.isValidAU(end)):
+                    self.dataChainValid = False
+                    break
+                self.dataChain.append((start, end))
+                allocatedAUs += end - start + 1
+            if (allocatedAUs != numAllocatedAUs):
+                self.dataChainValid = False
+
+    def __str__(self):
+        s = self.type + ' at AU ' + str(self.au) + ': ' + self.name + '  FDIR ' + str(self.FDIRAU)
+        if (self.type == 'DDR'):
+            s += '  parent DDR ' + str(self.parentDDRAU)
+        else:
+            s += '  data chain ' + ('valid' if self.dataChainValid else 'invalid')
+        return s
+
+    def getRecord(self):
+        record = {'record': 'candidate', 'au': self.au, 'type': self.type, 'name': self.name, 'FDIRAU': self.FDIRAU}
+        if (self.type == 'DDR'):
+            record['parentDDRAU'] = self.parentDDRAU
+        else:
+            record['dataChain'] = self.dataChain
+            record['dataChainValid'] = self.dataChainValid
+        return record
+
+
 # Parse Volume Information Block (Sector 0)
 # 0-9   Volume name padded with spaces to the right
 # 10-11 Total number of AUs
@@ -731,19 +2299,37 @@ class TIAURange(TIBase):
 # ...etc...
 
 class TIDisk(TIDir):
-    def __init__(self, rawBytes):
+    def __init__(self, rawBytes, lazy=False, limits=None, minSeverity='warning'):
+        # rawBytes may be a bytearray, bytes, or mmap (see openImage). Sector accessors return memoryview slices of
+        # the image so that parsing and export never copy sector data. limits is a TIParseLimits.
         self.b = rawBytes
+        self.view = memoryview(rawBytes)
+        self.lazy = lazy
+        self.limits = TIParseLimits() if limits is None else limits
+        self.parseStopped = None
+        self.validated = False
+        self.pathIndex = TIPathIndex()
         self.bsize = len(self.b)
         self.sectorSize = 256
+        self.minSeverity = minSeverity
+        self.recordWarnings = (SEVERITIES.index(minSeverity) <= SEVERITIES.index('warning'))
+        self.maxMessages = MAX_MESSAGES_PER_CODE
         self.globalErrors = {}
         self.globalWarnings = {}
+        self.errorCounts = {}
+        self.warningCounts = {}
+        self.badDataPatterns = list(BAD_DATA_PATTERNS)
+        self.recovered = []
+        self.bitmapWarnings = []
+        self.freeExtents = None
+        self.writeCount = 0
 
         if (self.bsize < self.sectorSize * 32):
             raise Exception('Invalid VIB: len=' + str(self.bsize))
 
-        self.totalAUs = self.wordToInt(self.b[10:12])
-        self.sectorsPerTrack = int(self.b[12])
-        self.hardDiskParams = self.wordToInt(self.b[16:18])
+        VIB = DDR_LAYOUT.unpack_from(self.b)
+        (self.totalAUs, self.sectorsPerTrack) = VIB[1:3]
+        self.hardDiskParams = VIB[4]
         self.sectorsPerAU = int(self.hardDiskParams >> 12) + 1
         self.totalSectors = self.sectorsPerAU * self.totalAUs
         self.auSize = self.sectorsPerAU * self.sectorSize
@@ -751,49 +2337,366 @@ class TIDisk(TIDir):
         self.numberOfCylinders = self.totalSectors // (self.sectorsPerTrack * self.numberOfHeads)
         self.bufferedHeadStepping = bool(self.hardDiskParams & 0x80)
         self.writePrecompensation = int(self.hardDiskParams & 0x7f) * 16
-        self.DSK1Emu = self.wordToInt(self.b[26:28])
+        self.DSK1Emu = VIB[9]
         self.totalBytes = self.sectorSize * self.sectorsPerAU * self.totalAUs
-        self.logicalMap = ['#'] * self.totalSectors
-        self.ownerMap = [ None ] * self.totalSectors
+        self.extents = TIExtentMap()
+        self.owners = [None]
+        self.logicalMap = TILogicalMap(self)
+        self.ownerMap = TIOwnerMap(self)
 
         if (self.bsize < self.totalBytes):
             raise Exception('Disk file too small: Expected=' + str(self.totalBytes) + ' Actual=' + str(self.bsize))
 
-        self.allocatedAUs = 0
-        self.freeAUs = 0
-        for i in range(0, self.totalAUs):
-            if self.testBitmap(i):
-                self.allocatedAUs += 1
-                self.mapAU(i, TIUnknownAU(self, i))
-            else:
-                self.freeAUs += 1
-                self.mapAU(i, TIFreeAU(self, i))
+        self.bitmap = self.decodeBitmap()
+        self.allocatedAUs = self.bitmap.count(1)
+        self.freeAUs = self.bitmap.count(0)
 
         # Note - everything above needs to happen first before super is called, because super will access the disk maps
+        self.startParsePass()
         super().__init__(self, self, 0, self.b)
 
         # Fix the fields with different meanings in VIB vs DDR
         self.fullPath = self.name
         self.parentDDR = 0
 
-        self.logicalMap[0] = 'V'
-        self.ownerMap[0] = self
-        for i in range(1, 32):
-            self.logicalMap[i] = 'B'
-            self.ownerMap[i] = TIVolumeBitmapAU(self, i // self.sectorsPerAU)
-        for i in range(32, 64):
-            self.logicalMap[i] = '.'
-            self.ownerMap[i] = TIUnusedAU(self, i // self.sectorsPerAU)
+        self.extents.insert(0, 0, 'V', self.getOwnerId(self))
+        self.extents.insert(1, 31, 'B', 0)
+        self.extents.insert(32, 63, '.', 0)
 
-        if (self.freeAUs + self.allocatedAUs != self.totalAUs):
-            self.addWarning('Invalid Bitmap: Total=' + str(self.totalAUs) +
-                            ' Allocated=' + str(self.allocatedAUs) +
-                            ' Free=' + str(self.freeAUs))
+        self.checkBitmap()
 
-        for i in range(0, 32 // self.sectorsPerAU):
-            if (not self.testBitmap(i)):
-                self.addWarning('Invalid Bitmap: VIB/ABM AU ' + str(i) + ' marked as free')
+        if (not lazy):
+            self.validate()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['b']
+        del state['view']
+        return (state, self.getSlotState())
+
+    def iterParsedFDRs(self):
+        for fdr in self.iterFiles():
+            yield fdr
+        for group in self.recovered:
+            for fdr in group.FDRs:
+                while (fdr is not None):
+                    yield fdr
+                    fdr = fdr._nextFDR
+
+    def attachImage(self, rawBytes):
+        # Point a disk loaded from a parse cache (see loadCachedDisk) back at its image
+        self.b = rawBytes
+        self.view = memoryview(rawBytes)
+
+    def getMetadataSectors(self):
+        # The sectors parsing has read: the VIB and bitmap area, and the DDR, FDIR and FDR sectors of everything
+        # parsed so far. Nothing else affects the parse results.
+        sectors = list(range(0, 64))
+        dirs = [self]
+        while (dirs):
+            dir = dirs.pop()
+            if (dir != self):
+                sectors.append(dir.au * self.sectorsPerAU)
+            if (dir.FDIRParsed and dir._FDIR is not None):
+                sectors.append(dir._FDIR.au * self.sectorsPerAU)
+            if (dir._subdirs is not None):
+                dirs.extend(dir._subdirs)
+        for fdr in self.iterParsedFDRs():
+            sectors.append(fdr.au * self.sectorsPerAU + fdr.sectorOffset)
+        return array.array('I', sorted(set(sectors)))
+
+    def reanalyze(self, changedSectors, fullBitmapCheck=True):
+        # Bring a fully parsed disk (e.g. from the parse cache, or after a write) up to date after sectors changed in
+        # the image, then redo the bitmap checks. Files owning a changed sector are re-parsed, and so are changed
+        # FDIRs, keeping the files they still point to whose FDRs are unchanged. A changed DDR (or VIB) is decoded
+        # again, re-parsing only the FDIR and subdirectories whose AUs changed; a renamed directory is re-parsed with
+        # its subtree, as every path below it changes. Other sectors don't affect the parse.
+        # Without fullBitmapCheck only the re-parsed objects are checked against the bitmap, which is enough when
+        # nothing outside the tree changed (see commitWrite).
+        # Returns False if the disk needs a full parse instead: the volume geometry or name changed, files were
+        # recovered, or sectors are cross-linked (their owners and the remap errors depend on the mapping order).
+        if (self.recovered or self.hasRemappedSectors() or self.parseStopped is not None):
+            return False
+
+        self.startParsePass()
+        bitmapChanged = False
+        units = []
+        unitSet = set()
+        headers = []
+        for sector in sorted(changedSectors):
+            if (sector == 0):
+                if (not self.isSameVolume()):
+                    return False
+                headers.append(self)
+                continue
+            if (sector < 64):
+                bitmapChanged = True
+                continue
+            i = self.extents.find(sector)
+            if (i < 0 or not self.extents.ownerIds[i]):
+                continue
+            unit = self.owners[self.extents.ownerIds[i]]
+            if (isinstance(unit, TIFile)):
+                unit = unit.getFirstFDR()
+            elif (isinstance(unit, TIDir)):
+                if (self.bytesToString(self.getAU(unit.au)[0:10]).rstrip() == unit.name):
+                    if (unit not in headers):
+                        headers.append(unit)
+                    continue
+            elif (not isinstance(unit, TIFDIR)):
+                continue
+            if (unit not in unitSet):
+                units.append(unit)
+                unitSet.add(unit)
+        changedFiles = set([unit for unit in units if isinstance(unit, TIFile)])
+        units = [unit for unit in units if not self.isCoveredBy(unit, unitSet)]
+        unitSet = set(units)
+        headers = [dir for dir in headers if dir not in unitSet and not self.isCoveredBy(dir, unitSet)]
+
+        if (fullBitmapCheck):
+            self.clearBitmapWarnings()
+        numOwners = len(self.owners)
+        oldFDRs = {}
+        for unit in units:
+            if (isinstance(unit, TIFDIR) and unit._FDRs is not None):
+                oldFDRs[unit] = self.getReusableFDRs(unit, changedFiles)
+                self.unmapObject(unit)
+                for fdr in unit._FDRs:
+                    if (oldFDRs[unit].get(fdr.au) is not fdr):
+                        for obj in self.getParsedObjects(fdr):
+                            self.unmapObject(obj)
+            else:
+                for obj in self.getParsedObjects(unit):
+                    self.unmapObject(obj)
+
+        for unit in units:
+            if (isinstance(unit, TIFile)):
+                fdrs = unit.fdir._FDRs
+                fdrs[fdrs.index(unit)] = TIFile(self, unit.dir, unit.fdir, None, 0, 0, unit.au, 0,
+                                                self.getSectorOfAU(unit.au, 0))
+            elif (isinstance(unit, TIFDIR)):
+                unit.dir.parseFDIR(oldFDRs.get(unit))
+                # Files the new FDIR no longer points to
+                for fdr in oldFDRs.get(unit, {}).values():
+                    for obj in self.getParsedObjects(fdr):
+                        self.unmapObject(obj)
+            else:
+                subdirs = unit.parent._subdirs
+                subdirs[subdirs.index(unit)] = TIDir(self, unit.parent, unit.au, self.getAU(unit.au))
+
+        # Deepest first, so a directory dropped by its parent's new header is not refreshed after being unmapped
+        for dir in sorted(headers, key=self.getDepth, reverse=True):
+            if (self.isAttached(dir)):
+                self.refreshDirHeader(dir)
+
+        if (self.hasRemappedSectors() or self.parseStopped is not None):
+            return False
+
+        if (bitmapChanged):
+            self.bitmap = self.decodeBitmap()
+            self.allocatedAUs = self.bitmap.count(1)
+            self.freeAUs = self.bitmap.count(0)
+        if (fullBitmapCheck):
+            self.checkBitmap()
+            self.reconcileBitmap()
+        else:
+            # The bitmap warnings of unmapped objects went with them
+            self.bitmapWarnings = [(obj, msg) for (obj, msg) in self.bitmapWarnings if self.isMapped(obj)]
+            self.reconcileObjectBitmap(self.owners[numOwners:])
+        return True
 
+    def getReusableFDRs(self, FDIR, changedFiles):
+        # The files of a changed FDIR that its re-parse can keep: those it may still point to whose FDRs are unchanged
+        pointers = self.getAU(FDIR.au)
+        FDRAUs = set(FDIR_LAYOUT.unpack_from(pointers)[0:127])
+        reusable = {}
+        for fdr in FDIR._FDRs:
+            if (fdr.au in FDRAUs and fdr.au not in reusable and fdr not in changedFiles):
+                reusable[fdr.au] = fdr
+        return reusable
+
+    def isMapped(self, obj):
+        return (obj.ownerId and self.owners[obj.ownerId] is obj)
+
+    def isSameVolume(self):
+        # True if the VIB fields that the whole parse depends on are unchanged
+        VIB = DDR_LAYOUT.unpack_from(self.b)
+        return (self.bytesToString(VIB[0]).rstrip() == self.name and
+                VIB[1] == self.totalAUs and
+                VIB[2] == self.sectorsPerTrack and
+                VIB[4] == self.hardDiskParams)
+
+    def refreshDirHeader(self, dir):
+        # Decode the DDR (or VIB) of a parsed directory again, keeping its FDIR and the subdirectories whose AUs are
+        # unchanged
+        oldFDIRAU = dir.FDIRAU
+        oldSubdirs = {}
+        for subdir in dir.subdirs:
+            oldSubdirs[subdir.au] = subdir
+        oldFDIR = dir.FDIR
+
+        dir.clearHeaderMessages()
+        dir.decodeHeader(self.getAU(dir.au), False)
+        if (dir == self):
+            self.fullPath = self.name
+            self.parentDDR = 0
+            self.DSK1Emu = DDR_LAYOUT.unpack_from(self.b)[9]
+
+        if (dir.FDIRAU != oldFDIRAU):
+            if (oldFDIR is not None):
+                for obj in self.getParsedObjects(oldFDIR):
+                    self.unmapObject(obj)
+            dir._FDIR = None
+            dir.FDIRParsed = not self.isValidAU(dir.FDIRAU)
+            if (not dir.FDIRParsed):
+                dir.parseFDIR()
+        dir.checkFDIRCount()
+
+        subdirs = [oldSubdirs.pop(au, None) for au in dir.subdirAUs]
+        for subdir in oldSubdirs.values():
+            for obj in self.getParsedObjects(subdir):
+                self.unmapObject(obj)
+        pathAUs = dir.getPathAUs()
+        for i in range(0, len(subdirs)):
+            if (subdirs[i] is None and dir.isParsableSubdir(dir.subdirAUs[i], pathAUs)):
+                subdirs[i] = TIDir(self, dir, dir.subdirAUs[i], self.getAU(dir.subdirAUs[i]))
+        dir._subdirs = [subdir for subdir in subdirs if subdir is not None]
+
+    def getDepth(self, dir):
+        return dir.depth
+
+    def isAttached(self, dir):
+        # True if dir is still part of the tree
+        while (dir != self):
+            if (dir.parent._subdirs is None or dir not in dir.parent._subdirs):
+                return False
+            dir = dir.parent
+        return True
+
+    def hasRemappedSectors(self):
+        return bool(self.errorCounts.get('remapped'))
+
+    def isCoveredBy(self, unit, units):
+        # True if another unit's re-parse also re-parses unit
+        if (isinstance(unit, TIFile)):
+            if (unit.fdir in units):
+                return True
+            dir = unit.dir
+        elif (isinstance(unit, TIFDIR)):
+            dir = unit.dir
+        else:
+            dir = unit.parent
+        while (dir != self):
+            if (dir in units):
+                return True
+            dir = dir.parent
+        return False
+
+    def getParsedObjects(self, obj):
+        # obj and every object parsed below it, depth first
+        objs = [obj]
+        while (objs):
+            obj = objs.pop()
+            if (isinstance(obj, TIFile)):
+                fdr = obj
+                while (fdr is not None):
+                    yield fdr
+                    for dataChain in fdr.dataChainPointers:
+                        yield dataChain
+                    fdr = fdr._nextFDR
+            elif (isinstance(obj, TIFDIR)):
+                yield obj
+                objs.extend(reversed(obj._FDRs or []))
+            else:
+                yield obj
+                objs.extend(reversed(obj._subdirs or []))
+                if (obj.FDIRParsed and obj._FDIR is not None):
+                    objs.append(obj._FDIR)
+
+    def unmapObject(self, obj):
+        # Remove the sectors, diagnostics and path of an object. Only valid when nothing is cross-linked, so all the
+        # sectors obj mapped (including the unused rest of a DDR, FDIR or FDR AU) still belong to it.
+        if (obj.ownerId):
+            if (isinstance(obj, TIAURange)):
+                self.extents.delete(obj.start * self.sectorsPerAU, (obj.end + 1) * self.sectorsPerAU - 1)
+            elif (isinstance(obj, TIFile) and obj.sectorOffset):
+                self.extents.delete(obj.au * self.sectorsPerAU + obj.sectorOffset,
+                                    obj.au * self.sectorsPerAU + obj.sectorOffset)
+            else:
+                self.extents.delete(obj.au * self.sectorsPerAU, (obj.au + 1) * self.sectorsPerAU - 1)
+            self.owners[obj.ownerId] = None
+        self.dropGlobalMessages(self.globalErrors, self.errorCounts, obj, obj.errors)
+        self.dropGlobalMessages(self.globalWarnings, self.warningCounts, obj, obj.warnings)
+        self.pathIndex.remove(obj)
+
+    def getPathIndex(self):
+        # The index is filled in as the tree is parsed, so it is complete once everything has been parsed
+        if (self.lazy):
+            self.parseAll()
+        return self.pathIndex
+
+    def lookup(self, path):
+        # Find the directory or file at a full path ('' is the volume itself). On a lazily parsed disk that has not
+        # been indexed yet, only the directories along the path are parsed.
+        if (path == ''):
+            return self
+        obj = self.pathIndex.lookup(path)
+        if (obj is not None or not self.lazy):
+            return obj
+        dir = self
+        names = path.split('.')
+        for name in names[:-1]:
+            dir = dir.findSubdir(name)
+            if (dir is None):
+                return None
+        obj = dir.findSubdir(names[-1])
+        if (obj is None):
+            obj = dir.findFile(names[-1])
+        return obj
+
+    def listPath(self, prefix):
+        index = self.getPathIndex()
+        return [index.lookup(path) for path in index.listPrefix(prefix)]
+
+    def glob(self, pattern):
+        index = self.getPathIndex()
+        return [index.lookup(path) for path in index.glob(pattern)]
+
+    def getCatalog(self):
+        # A TICatalog of every file, built from the tree as it is now
+        if (self.lazy):
+            self.parseAll()
+        files = [fdr for fdr in self.iterFiles() if fdr.firstFDR is fdr]
+        files.sort(key=lambda fdr: fdr.fullPath)
+        return TICatalog(files, self.sectorSize)
+
+    def startParsePass(self):
+        # Parsing from here on gets a fresh object count and time budget (see TIParseLimits)
+        self.numParsedObjects = 0
+        self.parseDeadline = None
+        if (self.limits.maxSeconds is not None):
+            self.parseDeadline = time.monotonic() + self.limits.maxSeconds
+
+    def canParse(self):
+        # Count one more DDR, FDIR or FDR against the parse budget. Once it is used up nothing more is parsed, and the
+        # volume gets an error saying why.
+        if (self.parseStopped is None):
+            self.numParsedObjects += 1
+            maxObjects = self.totalSectors if self.limits.maxObjects is None else self.limits.maxObjects
+            if (self.numParsedObjects > maxObjects):
+                self.parseStopped = ('parseStopped', maxObjects, 'objects')
+            elif (self.parseDeadline is not None and time.monotonic() > self.parseDeadline):
+                self.parseStopped = ('parseStopped', self.limits.maxSeconds, 'seconds')
+            if (self.parseStopped is not None):
+                self.addError(*self.parseStopped)
+        return (self.parseStopped is None)
+
+    def validate(self):
+        # Full validation pass: parse the whole tree, then check it against the volume bitmap
+        if (not self.validated):
+            self.validated = True
+            self.parseAll()
+            self.reconcileBitmap()
 
     def isValidAU(self, au):
         return ((au >= 0) and (au < self.totalAUs))
@@ -804,98 +2707,984 @@ class TIDisk(TIDir):
     def isValidSectorOfAU(self, au, sector):
         return (self.isValidAU(au) and (sector >= 0) and (sector < self.sectorsPerAU))
 
+    def decodeBitmap(self):
+        # One byte (0 or 1) per AU, decoded from the bitmap in one pass
+        bitmapBytes = self.b[self.sectorSize:self.sectorSize + (self.totalAUs + 7) // 8]
+        return bytearray(b''.join(map(BITMAP_BITS.__getitem__, bitmapBytes))[:self.totalAUs])
+
     def testBitmap(self, au):
-        return bool((self.b[au // 8 + self.sectorSize] >> (7 - (au % 8))) & 0x01)
+        return bool(self.bitmap[au])
 
     def setBitmap(self, au, used):
         if used:
             self.b[au // 8 + self.sectorSize] |= (1 << (7 - (au % 8)))
         else:
             self.b[au // 8 + self.sectorSize] &= ~(1 << (7 - (au % 8)))
+        self.bitmap[au] = int(bool(used))
+
+    def getMappedAUs(self):
+        # One byte (0 or 1) per AU for the AUs with any mapped sector, and for those with an owned (not unused) sector
+        mapped = bytearray(self.totalAUs)
+        owned = bytearray(self.totalAUs)
+        for (start, end, mapType, ownerId) in self.extents:
+            startAU = start // self.sectorsPerAU
+            endAU = end // self.sectorsPerAU
+            mapped[startAU:endAU + 1] = b'\x01' * (endAU - startAU + 1)
+            if (mapType != '.'):
+                owned[startAU:endAU + 1] = b'\x01' * (endAU - startAU + 1)
+        return (mapped, owned)
+
+    def getBitmapMismatches(self):
+        # Compare the volume bitmap with the ownership map. Returns two lists of (startAU, endAU) ranges: AUs in the
+        # tree that are marked as free, and AUs marked as allocated that are not in the tree.
+        (mapped, owned) = self.getMappedAUs()
+        bitmap = int.from_bytes(self.bitmap, 'big')
+        ownedFree = (int.from_bytes(owned, 'big') & ~bitmap).to_bytes(self.totalAUs, 'big')
+        allocatedUnmapped = (bitmap & ~int.from_bytes(mapped, 'big')).to_bytes(self.totalAUs, 'big')
+        return ([(m.start(), m.end() - 1) for m in re.finditer(b'\x01+', ownedFree)],
+                [(m.start(), m.end() - 1) for m in re.finditer(b'\x01+', allocatedUnmapped)])
+
+    def addBitmapWarning(self, obj, code, *args):
+        # Bitmap warnings are remembered so that reanalyze can redo them after the tree or the bitmap changes
+        msg = obj.addWarning(code, *args)
+        if (msg is not None):
+            self.bitmapWarnings.append((obj, msg))
+
+    def clearBitmapWarnings(self):
+        for (obj, msg) in self.bitmapWarnings:
+            obj.removeWarning(msg)
+        self.bitmapWarnings = []
+
+    def checkBitmap(self):
+        if (self.freeAUs + self.allocatedAUs != self.totalAUs):
+            self.addBitmapWarning(self, 'badBitmapTotals', self.totalAUs, self.allocatedAUs, self.freeAUs)
 
-    def mapAU(self, au, obj):
-        if (obj is None):
-            obj = TIUnusedAU(self, au)
-
-        self.mapSectorOfAU(au, 0, obj)
+        for i in range(0, 32 // self.sectorsPerAU):
+            if (not self.testBitmap(i)):
+                self.addBitmapWarning(self, 'bitmapAUFree', i)
+
+    def reconcileBitmap(self):
+        (ownedFree, allocatedUnmapped) = self.getBitmapMismatches()
+        for (startAU, endAU) in ownedFree:
+            for i in self.extents.overlapping(startAU * self.sectorsPerAU, (endAU + 1) * self.sectorsPerAU - 1):
+                self.addOwnedFreeWarning(i, startAU, endAU)
+        for (startAU, endAU) in allocatedUnmapped:
+            if (startAU == endAU):
+                self.addBitmapWarning(self, 'AUNotInTree', startAU)
+            else:
+                self.addBitmapWarning(self, 'AUsNotInTree', startAU, endAU)
+
+    def addOwnedFreeWarning(self, i, startAU, endAU):
+        # Warn about the owner of extent i for AUs [startAU, endAU], marked as free in the volume bitmap
+        mapType = chr(self.extents.types[i])
+        if (mapType == 'o'):
+            dataChain = self.owners[self.extents.ownerIds[i]]
+            start = max(self.extents.starts[i] // self.sectorsPerAU, startAU)
+            end = min(self.extents.ends[i] // self.sectorsPerAU, endAU)
+            if (start == end):
+                self.addBitmapWarning(dataChain.fdr, 'dataChainAUFree', start)
+            else:
+                self.addBitmapWarning(dataChain.fdr, 'dataChainAUsFree', start, end)
+        elif (mapType != '.' and mapType != 'B'):
+            self.addBitmapWarning(self.owners[self.extents.ownerIds[i]], 'markedFree')
+
+    def reconcileObjectBitmap(self, objs):
+        # The warnings reconcileBitmap gives about the sectors of objects parsed after it ran. Every AU of an object's
+        # extents is owned, so the free AUs of each extent are the runs of free bits in the bitmap.
+        objs = [obj for obj in objs if obj is not None]
+        objs.sort(key=lambda obj: obj.start if isinstance(obj, TIAURange) else obj.au)
+        for obj in objs:
+            if (isinstance(obj, TIAURange)):
+                (start, end) = (obj.start * self.sectorsPerAU, (obj.end + 1) * self.sectorsPerAU - 1)
+            else:
+                (start, end) = (obj.au * self.sectorsPerAU, (obj.au + 1) * self.sectorsPerAU - 1)
+            for i in self.extents.overlapping(start, end):
+                if (self.extents.ownerIds[i] == obj.ownerId):
+                    startAU = self.extents.starts[i] // self.sectorsPerAU
+                    endAU = self.extents.ends[i] // self.sectorsPerAU
+                    for m in re.finditer(b'\x00+', self.bitmap[startAU:endAU + 1]):
+                        self.addOwnedFreeWarning(i, startAU + m.start(), startAU + m.end() - 1)
+
+    def getOwnerId(self, obj):
+        if (not obj.ownerId):
+            obj.ownerId = len(self.owners)
+            self.owners.append(obj)
+        return obj.ownerId
+
+    def getOwner(self, mapType, ownerId, au):
+        if (ownerId):
+            return self.owners[ownerId]
+        elif (mapType == 'B'):
+            return TIVolumeBitmapAU(self, au)
+        return TIUnusedAU(self, au)
+
+    def getOwnersOfAURange(self, startAU, endAU):
+        # Owner objects of all mapped sectors in AUs [startAU, endAU], in sector order
+        return self.getOwnersOfSectors(startAU * self.sectorsPerAU, (endAU + 1) * self.sectorsPerAU - 1)
+
+    def getOwnersOfSectors(self, start, end):
+        owners = []
+        for i in self.extents.overlapping(start, end):
+            owners.append(self.getOwner(chr(self.extents.types[i]), self.extents.ownerIds[i],
+                                        max(self.extents.starts[i], start) // self.sectorsPerAU))
+        return owners
 
-        if (obj.mapType == 'D' or obj.mapType == 'I' or obj.mapType == 'F'):
+    def mapAU(self, au, obj):
+        if (obj is not None and (obj.mapType == 'D' or obj.mapType == 'I' or obj.mapType == 'F')):
             # Additional sectors in the AU are unused for DDIR, FDIR, and FDR
-            obj = TIUnusedAU(self, au)
-        for i in range(1, self.sectorsPerAU):
-            self.mapSectorOfAU(au, i, obj)
+            self.mapSectorOfAU(au, 0, obj)
+            if (self.sectorsPerAU > 1):
+                self.mapSectors(au * self.sectorsPerAU + 1, (au + 1) * self.sectorsPerAU - 1, None, au)
+        else:
+            self.mapAURange(au, au, obj)
 
-    def mapSectorOfAU(self, au, sectorOffset, obj):
-        if (obj is None):
-            obj = TIUnusedAU(self, au)
+    def mapAURange(self, startAU, endAU, obj):
+        self.mapSectors(startAU * self.sectorsPerAU, (endAU + 1) * self.sectorsPerAU - 1, obj, startAU)
 
+    def mapSectorOfAU(self, au, sectorOffset, obj):
         sector = au * self.sectorsPerAU + sectorOffset
-        oldType = self.logicalMap[sector]
-        oldOwner = self.ownerMap[sector]
-        if ((oldType != '#') and (oldType != '?') and (oldType != ' ') and ((oldType != obj.mapType) or (oldOwner.au != obj.au))):
-            self.addGlobalError(self,
-                                'remapped sector ' + str(sector) + ' from ' + oldType + ' for ' + oldOwner.type +
-                                ' ' + str(oldOwner.au) + ' (' + oldOwner.fullPath + ') to ' + obj.mapType +
-                                ' for ' + obj.type + ' ' + str(obj.au) + ' (' + obj.fullPath + ')')
-
-        self.logicalMap[sector] = obj.mapType
-        self.ownerMap[sector] = obj
+        self.mapSectors(sector, sector, obj, au)
+
+    def mapSectors(self, start, end, obj, au):
+        # obj=None maps the sectors as unused without creating an owner object for them
+        mapType = '.' if obj is None else obj.mapType
+        ownerId = 0 if obj is None else self.getOwnerId(obj)
+        ownerAU = au if obj is None else obj.au
+
+        for (oldStart, oldEnd, oldType, oldOwnerId) in self.extents.insert(start, end, mapType, ownerId):
+            oldOwner = self.getOwner(oldType, oldOwnerId, oldStart // self.sectorsPerAU)
+            if ((oldType != mapType) or (oldOwner.au != ownerAU)):
+                if (oldStart == oldEnd):
+                    sectors = 'sector ' + str(oldStart)
+                else:
+                    sectors = 'sectors ' + str(oldStart) + '-' + str(oldEnd)
+                # Listed with the volume's errors, but not as an error of the volume itself (see getErrors)
+                self.addError('remapped', sectors, oldType, oldOwner.type, oldOwner.au, oldOwner.fullPath, mapType,
+                              'UNUS' if obj is None else obj.type, ownerAU, '' if obj is None else obj.fullPath)
 
     def getSector(self, sector):
         i = sector * self.sectorSize
-        return self.b[i:i+self.sectorSize]
+        return self.view[i:i+self.sectorSize]
 
     def getSectorOfAU(self, au, sectorOffset):
         i = au * self.auSize + sectorOffset * self.sectorSize
-        return self.b[i:i+self.sectorSize]
+        return self.view[i:i+self.sectorSize]
 
     def getAU(self, au):
         i = au * self.auSize
-        return self.b[i:i+self.auSize]
+        return self.view[i:i+self.auSize]
+
+    def flush(self):
+        if (isinstance(self.b, mmap.mmap)):
+            self.b.flush()
+
+    # Writing
+    # Files and directories are written the way they are parsed (see the DDR, FDIR and FDR layouts above), keeping the
+    # FDIR and the DDR subdirectory pointers in alphabetical order and the DDR counts in step. AUs are taken from the
+    # free extent index and marked in the volume bitmap with setBitmap. Each change ends with reanalyze, so lookups
+    # and reports see the new tree. The image must be writable (a bytearray, or memory-mapped with access 'write' or
+    # 'copy', see openImage); only a disk without cross-linked sectors is written to.
+
+    def getFreeExtents(self):
+        # Built on first use from the AUs that are free in the bitmap and not in the tree, then kept up to date by
+        # the writes
+        if (self.freeExtents is None):
+            (mapped, owned) = self.getMappedAUs()
+            used = int.from_bytes(self.bitmap, 'big') | int.from_bytes(mapped, 'big')
+            free = (used ^ int.from_bytes(b'\x01' * self.totalAUs, 'big')).to_bytes(self.totalAUs, 'big')
+            self.freeExtents = TIFreeExtents(free)
+        return self.freeExtents
+
+    def prepareWrite(self, planOnly=False):
+        # planOnly checks that a write can be planned (see planDefrag), on a read-only image too
+        if (self.view.readonly and not planOnly):
+            raise Exception('Image is read-only')
+        self.validate()
+        if (self.hasRemappedSectors()):
+            raise Exception('Cannot write to a disk with cross-linked sectors')
+        self.getFreeExtents()
+
+    def commitWrite(self, changedSectors):
+        # Bring the parse up to date after a write. The free extent index already reflects the write, unless reanalyze
+        # can't be used and the image is parsed again (which drops recovered files, so the index is rebuilt).
+        writeCount = self.writeCount
+        if (not self.reanalyze(changedSectors, False)):
+            self.__init__(self.b, self.lazy, self.limits, self.minSeverity)
+            self.validate()
+        self.writeCount = writeCount + 1
+
+    def getNewPath(self, path):
+        # The parent directory and the name of a file or directory to create
+        names = path.rsplit('.', 1)
+        dir = self if len(names) == 1 else self.lookup(names[0])
+        if (not isinstance(dir, TIDir)):
+            raise Exception('No such directory: ' + names[0])
+        name = names[-1]
+        if (len(name) > 10 or not name.isascii() or not self.isValidName(name.encode('ascii').ljust(10), True)):
+            raise Exception('Invalid name: ' + name)
+        if (self.lookup(path) is not None):
+            raise Exception('Already exists: ' + path)
+        return (dir, name)
+
+    def allocateExtents(self, numAUs, bestFit, allocated):
+        # Take (startAU, endAU) extents from the free extent index, adding them to allocated. If there is not enough
+        # free space, everything in allocated is released again.
+        extents = self.freeExtents.allocateExtents(numAUs, bestFit)
+        if (extents is None):
+            error = 'Disk full: ' + str(numAUs) + ' more AUs needed, ' + str(self.freeExtents.numFree) + ' free'
+            for (start, end) in allocated:
+                self.freeExtents.release(start, end)
+            raise Exception(error)
+        allocated.extend(extents)
+        return extents
+
+    def markAUs(self, extents, used, changedSectors):
+        for (start, end) in extents:
+            for au in range(start, end + 1):
+                self.setBitmap(au, used)
+            changedSectors.update(range(1 + start // 8 // self.sectorSize, 2 + end // 8 // self.sectorSize))
+
+    def writeAUs(self, extents, data):
+        # Write data across the extents' AUs, zero-filling the rest of them
+        offset = 0
+        for (start, end) in extents:
+            size = (end - start + 1) * self.auSize
+            self.view[start * self.auSize:(end + 1) * self.auSize] = bytes(data[offset:offset + size]).ljust(size, b'\0')
+            offset += size
+
+    def writeSectorOfAU(self, au, sectorOffset, data, changedSectors):
+        i = au * self.auSize + sectorOffset * self.sectorSize
+        self.view[i:i+self.sectorSize] = bytes(data).ljust(self.sectorSize, b'\0')
+        changedSectors.add(au * self.sectorsPerAU + sectorOffset)
+
+    def writeFDIR(self, dir, FDRAUs, changedSectors):
+        # Rewrite the FDR pointers of a directory's FDIR, and the file count in its DDR
+        fdir = bytearray(self.getSectorOfAU(dir.FDIRAU, 0))
+        fdir[0:254] = b''.join([self.intToWord(au) for au in FDRAUs]).ljust(254, b'\0')
+        self.writeSectorOfAU(dir.FDIRAU, 0, fdir, changedSectors)
+        ddr = bytearray(self.getSectorOfAU(dir.au, 0))
+        ddr[22] = len(FDRAUs)
+        self.writeSectorOfAU(dir.au, 0, ddr, changedSectors)
+
+    def writeSubdirs(self, dir, subdirAUs, changedSectors):
+        ddr = bytearray(self.getSectorOfAU(dir.au, 0))
+        ddr[23] = len(subdirAUs)
+        ddr[28:256] = b''.join([self.intToWord(au) for au in subdirAUs]).ljust(228, b'\0')
+        self.writeSectorOfAU(dir.au, 0, ddr, changedSectors)
+
+    def freeObject(self, obj, changedSectors):
+        # Free the AUs of a parsed file or directory and of everything below it
+        self.releaseAUs(self.getFreedAUs(list(self.getParsedObjects(obj))), changedSectors)
+
+    def releaseAUs(self, extents, changedSectors):
+        self.markAUs(extents, False, changedSectors)
+        for (start, end) in extents:
+            self.freeExtents.release(start, end)
+
+    def getFreedAUs(self, objs):
+        # The AUs of the objects, as (startAU, endAU) extents, except AUs shared with other owners
+        ownerIds = set([o.ownerId for o in objs if o.ownerId])
+        freed = set()
+        for o in objs:
+            if (not o.ownerId):
+                continue
+            if (isinstance(o, TIAURange)):
+                (start, end) = (o.start, o.end)
+            else:
+                (start, end) = (o.au, o.au)
+            for au in range(start, end + 1):
+                shared = False
+                for i in self.extents.overlapping(au * self.sectorsPerAU, (au + 1) * self.sectorsPerAU - 1):
+                    if (self.extents.ownerIds[i] and self.extents.ownerIds[i] not in ownerIds):
+                        shared = True
+                if (not shared):
+                    freed.add(au)
+        extents = []
+        for au in sorted(freed):
+            if (extents and extents[-1][1] == au - 1):
+                extents[-1] = (extents[-1][0], au)
+            else:
+                extents.append((au, au))
+        return extents
+
+    def makeFDR(self, name, flags, recordsPerSector, EOFOffset, recordLength, numLevel3Records, created, modified):
+        # An FDR sector with the fields that are the same in every FDR of a file's chain
+        fdr = bytearray(self.sectorSize)
+        fdr[0:10] = name.encode('ascii').ljust(10)
+        if (recordLength > 255):
+            fdr[10:12] = self.intToWord(recordLength)
+        else:
+            fdr[17] = recordLength
+        fdr[12] = flags
+        fdr[13] = recordsPerSector
+        fdr[16] = EOFOffset
+        fdr[18:20] = self.intToLittleEndianWord(numLevel3Records & 0xffff)
+        fdr[20:24] = self.dateTimeToBytes() if created is None else created
+        fdr[24:28] = self.dateTimeToBytes() if modified is None else modified
+        fdr[28:30] = b'FI'
+        if (flags & 0x80):
+            fdr[38:40] = self.intToWord(((numLevel3Records >> 16) & 0x0f) << 8)
+        return fdr
 
-    def findPossibleBadAUs(self):
+    def writeFile(self, dir, fdr, data, bestFit=False, oldFDR=None):
+        # Allocate and write a file's data and FDRs, then add it to the FDIR of dir, or put it in place of oldFDR.
+        # The first FDR goes before the data; more FDRs are chained when the data needs more clusters than one holds.
+        FDIR = dir.FDIR
+        if (FDIR is None):
+            raise Exception('No FDIR: ' + dir.fullPath)
+        if (oldFDR is None and len(FDIR.FDRAUs) >= 127):
+            raise Exception('Too many files: ' + dir.fullPath)
+        clustersPerFDR = (self.sectorSize - 40) // 4
+        numSectors = (len(data) + self.sectorSize - 1) // self.sectorSize
+        if (numSectors >= 0x100000):
+            raise Exception('File too large: ' + str(len(data)) + ' bytes')
+
+        allocated = []
+        fdrAUs = [start for (start, end) in self.allocateExtents(1, False, allocated)]
+        extents = self.allocateExtents((numSectors + self.sectorsPerAU - 1) // self.sectorsPerAU, bestFit, allocated)
+        numFDRs = max(1, (len(extents) + clustersPerFDR - 1) // clustersPerFDR)
+        for (start, end) in self.allocateExtents(numFDRs - 1, False, allocated):
+            fdrAUs.extend(range(start, end + 1))
+
+        changedSectors = set()
+        self.writeAUs(extents, data)
+        fdr[14:16] = self.intToWord(numSectors & 0xffff)
+        fdr[36:38] = self.intToWord(FDIR.au)
+        fdr[38] = (fdr[38] & 0x0f) | ((numSectors >> 16) << 4)
+        for i in range(0, numFDRs):
+            clusters = extents[i * clustersPerFDR:(i + 1) * clustersPerFDR]
+            sector = bytearray(fdr)
+            sector[30:32] = self.intToWord(fdrAUs[i - 1] if i > 0 else 0)
+            sector[32:34] = self.intToWord(fdrAUs[i + 1] if i + 1 < numFDRs else 0)
+            sector[34:36] = self.intToWord(sum([end - start + 1 for (start, end) in clusters]))
+            for j in range(0, len(clusters)):
+                sector[40 + j * 4:44 + j * 4] = self.intToWord(clusters[j][0]) + self.intToWord(clusters[j][1])
+            self.writeAUs([(fdrAUs[i], fdrAUs[i])], b'')
+            self.writeSectorOfAU(fdrAUs[i], 0, sector, changedSectors)
+        self.markAUs(allocated, True, changedSectors)
+
+        FDRAUs = list(FDIR.FDRAUs)
+        if (oldFDR is None):
+            FDRAUs.insert(bisect.bisect([f.name for f in FDIR.FDRs], self.bytesToString(fdr[0:10]).rstrip()),
+                          fdrAUs[0])
+        else:
+            FDRAUs[FDIR.FDRs.index(oldFDR)] = fdrAUs[0]
+            self.freeObject(oldFDR, changedSectors)
+        self.writeFDIR(dir, FDRAUs, changedSectors)
+        self.commitWrite(changedSectors)
+
+    def addFile(self, path, data, flags=0x01, recordsPerSector=0, recordLength=0, numLevel3Records=0,
+                EOFOffset=None, created=None, modified=None, bestFit=False):
+        # Create a file from its data (padded to whole sectors) and FDR fields. The defaults make a PROGRAM file;
+        # EOFOffset defaults to where the data ends in its last sector, created and modified (4-byte FDR date and time
+        # fields, see dateTimeToBytes) to now. bestFit takes the data from the shortest free run it fits in instead
+        # of the first one. Returns the new TIFile.
+        self.prepareWrite()
+        (dir, name) = self.getNewPath(path)
+        if (EOFOffset is None):
+            EOFOffset = len(data) % self.sectorSize
+        self.writeFile(dir, self.makeFDR(name, flags, recordsPerSector, EOFOffset, recordLength, numLevel3Records,
+                                         created, modified), data, bestFit)
+        return self.lookup(path)
+
+    def importFile(self, path, tifiles, bestFit=False):
+        # Create a file from a TIFILES file (see TIFile.getHeader)
+        if (bytes(tifiles[0:8]) != b'\x07TIFILES' or len(tifiles) < 128):
+            raise Exception('Not a TIFILES file: ' + path)
+        numSectors = self.wordToInt(tifiles[8:10])
+        created = None
+        modified = None
+        if (tifiles[28] == 0xff and tifiles[29] == 0xff):
+            created = bytes(tifiles[30:34])
+            modified = bytes(tifiles[34:38])
+        return self.addFile(path, tifiles[128:128 + numSectors * self.sectorSize], tifiles[10], tifiles[11],
+                            tifiles[13], self.littleEndianWordToInt(tifiles[14:16]), tifiles[12], created, modified,
+                            bestFit)
+
+    def replaceFile(self, path, data, flags=None, recordsPerSector=None, recordLength=None, numLevel3Records=None,
+                    EOFOffset=None, created=None, modified=None, bestFit=False):
+        # Like addFile for an existing file, keeping the FDR fields (and the creation date) that are not given. The
+        # new data is written before the old file's AUs are freed. Returns the new TIFile.
+        self.prepareWrite()
+        oldFDR = self.lookup(path)
+        if (not isinstance(oldFDR, TIFile)):
+            raise Exception('No such file: ' + path)
+        if (EOFOffset is None):
+            EOFOffset = len(data) % self.sectorSize
+        fdr = self.makeFDR(oldFDR.name,
+                           oldFDR.flags if flags is None else flags,
+                           oldFDR.recordsPerSector if recordsPerSector is None else recordsPerSector,
+                           EOFOffset,
+                           oldFDR.recordLength if recordLength is None else recordLength,
+                           oldFDR.numLevel3Records if numLevel3Records is None else numLevel3Records,
+                           bytes(oldFDR.b[20:24]) if created is None else created,
+                           modified)
+        self.writeFile(oldFDR.dir, fdr, data, bestFit, oldFDR)
+        return self.lookup(path)
+
+    def deleteFile(self, path):
+        self.prepareWrite()
+        fdr = self.lookup(path)
+        if (not isinstance(fdr, TIFile)):
+            raise Exception('No such file: ' + path)
+        changedSectors = set()
+        FDRAUs = list(fdr.fdir.FDRAUs)
+        del FDRAUs[fdr.fdir.FDRs.index(fdr)]
+        self.freeObject(fdr, changedSectors)
+        self.writeFDIR(fdr.dir, FDRAUs, changedSectors)
+        self.commitWrite(changedSectors)
+
+    def addDir(self, path, created=None):
+        # Create an empty directory (a DDR and its FDIR). Returns the new TIDir.
+        self.prepareWrite()
+        (dir, name) = self.getNewPath(path)
+        if (len(dir.subdirAUs) >= 114):
+            raise Exception('Too many subdirectories: ' + dir.fullPath)
+        allocated = []
+        (ddrAU, FDIRAU) = [au for (start, end) in self.allocateExtents(2, False, allocated)
+                           for au in range(start, end + 1)]
+
+        changedSectors = set()
+        ddr = bytearray(self.sectorSize)
+        ddr[0:10] = name.encode('ascii').ljust(10)
+        ddr[10:12] = self.intToWord(self.totalAUs)
+        ddr[12] = self.sectorsPerTrack
+        ddr[13:16] = b'DIR'
+        ddr[18:22] = self.dateTimeToBytes() if created is None else created
+        ddr[24:26] = self.intToWord(FDIRAU)
+        ddr[26:28] = self.intToWord(dir.au)
+        fdir = bytearray(self.sectorSize)
+        fdir[254:256] = self.intToWord(ddrAU)
+        self.writeAUs(allocated, b'')
+        self.writeSectorOfAU(ddrAU, 0, ddr, changedSectors)
+        self.writeSectorOfAU(FDIRAU, 0, fdir, changedSectors)
+        self.markAUs(allocated, True, changedSectors)
+
+        subdirAUs = list(dir.subdirAUs)
+        subdirAUs.insert(bisect.bisect([subdir.name for subdir in dir.subdirs], name), ddrAU)
+        self.writeSubdirs(dir, subdirAUs, changedSectors)
+        self.commitWrite(changedSectors)
+        return self.lookup(path)
+
+    def deleteDir(self, path, recursive=False):
+        # Delete a directory, which must be empty unless recursive is set
+        self.prepareWrite()
+        dir = self.lookup(path)
+        if (not isinstance(dir, TIDir) or dir == self):
+            raise Exception('No such directory: ' + path)
+        if (not recursive and (dir.subdirs or (dir.FDIR is not None and dir.FDIR.FDRs))):
+            raise Exception('Directory not empty: ' + path)
+        changedSectors = set()
+        subdirAUs = list(dir.parent.subdirAUs)
+        del subdirAUs[dir.parent.subdirs.index(dir)]
+        self.freeObject(dir, changedSectors)
+        self.writeSubdirs(dir.parent, subdirAUs, changedSectors)
+        self.commitWrite(changedSectors)
+
+    # Defragmentation
+    # Each fragmented file (several data chain clusters, or chained FDRs) gets one contiguous run of AUs, chosen to
+    # move as little as possible: lined up with one of its clusters when the gaps around the clusters that are then
+    # already in place are free, else the shortest free run the whole file fits in. The first FDR stays where it is
+    # and holds the single cluster; the chained FDRs are freed. Files are planned in disk order.
+    # When the free space is too scattered for some files, it is compacted just enough for them: contiguous files are
+    # moved, highest first, into the lowest free runs their FDR and data fit in (updating their FDIR), until the
+    # remaining files fit. If some still don't, the plan is made again with all free space compacted (see
+    # planFullCompaction), which is used if it leaves fewer files fragmented.
+
+    def planDefrag(self):
+        self.prepareWrite(True)
+        plan = TIDefragPlan(self, self.getFreeExtents().copy())
+        files = []
+        for fdr in self.iterFiles():
+            if (fdr.firstFDR is not fdr):
+                continue
+            clusters = []
+            chained = []
+            hasErrors = False
+            nextFDR = fdr
+            while (nextFDR is not None):
+                hasErrors = hasErrors or nextFDR.hasErrors
+                clusters.extend([(dataChain.start, dataChain.end) for dataChain in nextFDR.dataChainPointers])
+                if (nextFDR is not fdr):
+                    chained.append(nextFDR)
+                nextFDR = nextFDR._nextFDR
+            # The data chains of an FDR with errors may not all be mapped, so such files are left alone
+            if ((len(clusters) > 1 or chained) and not hasErrors):
+                files.append((fdr, clusters, chained))
+        files.sort(key=lambda file: file[1][0][0] if file[1] else file[0].au)
+        skipped = [file for file in files if not self.planFileDefrag(plan, *file)]
+        if (skipped):
+            skipped = self.planCompaction(plan, skipped)
+        for (fdr, clusters, chained) in skipped:
+            plan.skip(fdr, self.getClustersSize(clusters))
+        if (skipped):
+            fullPlan = self.planFullCompaction(files)
+            if (len(fullPlan.skipped) < len(plan.skipped)):
+                plan = fullPlan
+            else:
+                plan.reasons.update([(fdr, fullPlan.reasons[fdr]) for fdr in fullPlan.skipped if fdr in plan.reasons])
+        plan.numFragmented = len(files)
+        plan.numClusters = sum([len(clusters) for (fdr, clusters, chained) in files])
+        return plan
+
+    def getClustersSize(self, clusters):
+        return sum([end - start + 1 for (start, end) in clusters])
+
+    def getMovableFiles(self, excluded):
+        # The contiguous files, other than the excluded ones, that can move: a single FDR and cluster, no errors, and
+        # no AUs shared with other objects
+        movable = []
+        for fdr in self.iterFiles():
+            if (fdr.firstFDR is fdr and fdr not in excluded and fdr.nextFDRAU == 0 and not fdr.hasErrors and
+                    len(fdr.dataChainPointers) <= 1 and self.getFreedAUs([fdr]) == [(fdr.au, fdr.au)]):
+                movable.append(fdr)
+        return movable
+
+    def planCompaction(self, plan, files):
+        # Move contiguous files down until the files planFileDefrag found no room for fit. Returns those that don't.
+        planned = set([entry[0] for entry in plan.files] + [fdr for (fdr, clusters, chained) in files])
+        movable = self.getMovableFiles(planned)
+        movable.sort(key=lambda fdr: max([fdr.au] + [dataChain.end for dataChain in fdr.dataChainPointers]),
+                     reverse=True)
+
+        freeExtents = plan.freeExtents
+        sizes = dict([(fdr, self.getClustersSize(clusters)) for (fdr, clusters, chained) in files])
+        numUseful = len(plan.files)
+        for fdr in movable:
+            if (not files or freeExtents.numFree < min([sizes[file[0]] for file in files])):
+                break
+            self.planFileMove(plan, fdr)
+            numFiles = len(files)
+            files = self.retryFileDefrag(plan, files, sizes)
+            if (len(files) < numFiles):
+                numUseful = len(plan.files)
+        # Moves after the last file that got room didn't help
+        while (len(plan.files) > numUseful):
+            plan.undoMove()
+        return files
+
+    def planFullCompaction(self, files):
+        # Plan all the fragmented files with the free space compacted: the files are lifted out (their clusters, FDRs
+        # and chained FDRs count as free), every movable contiguous file slides down as far as it can, in disk order,
+        # and the lifted files go back, largest first, into the shortest free runs they fit in. This frees all the
+        # space but what unmovable objects (directories, files with errors) split off. A file that still doesn't fit
+        # stays where it is, and the plan is made again around it.
+        stuck = {}
+        while (True):
+            plan = TIDefragPlan(self, self.getFreeExtents().copy())
+            freeExtents = plan.freeExtents
+            lifted = [file for file in files if file[0] not in stuck]
+            for (fdr, clusters, chained) in lifted:
+                for (start, end) in clusters + [(fdr.au, fdr.au)] + self.getFreedAUs(chained):
+                    freeExtents.release(start, end)
+            movable = self.getMovableFiles(set([fdr for (fdr, clusters, chained) in files]))
+            movable.sort(key=lambda fdr: min([fdr.au] + [dataChain.start for dataChain in fdr.dataChainPointers]))
+            for fdr in movable:
+                self.planFileSlide(plan, fdr)
+
+            lifted.sort(key=lambda file: self.getClustersSize(file[1]), reverse=True)
+            numStuck = len(stuck)
+            for (fdr, clusters, chained) in lifted:
+                if (not self.planLiftedFile(plan, fdr, clusters, chained)):
+                    plan.skip(fdr, self.getClustersSize(clusters), ' after compaction')
+                    stuck[fdr] = plan.reasons[fdr]
+            if (len(stuck) == numStuck):
+                break
+        plan.skipped = [file[0] for file in files if file[0] in stuck]
+        plan.reasons = stuck
+        return plan
+
+    def planFileSlide(self, plan, fdr):
+        # Move a contiguous file's FDR to the lowest free AU below it, and its data to the lowest free AU below it that
+        # it can start at: that of a free run it fits in, or of the run just below it, which it then partly overlaps
+        freeExtents = plan.freeExtents
+        FDRAU = fdr.au
+        (startAU, numAUs) = (0, 0)
+        moves = []
+        taken = []
+        released = []
+        newAU = freeExtents.findRun(1, False, fdr.au)
+        if (newAU is not None):
+            moves.append((fdr.au, newAU, 1))
+            taken.append((newAU, newAU))
+            released.append((fdr.au, fdr.au))
+            freeExtents.take(newAU, newAU)
+            freeExtents.release(fdr.au, fdr.au)
+            FDRAU = newAU
+        for dataChain in fdr.dataChainPointers:
+            (startAU, numAUs) = (dataChain.start, dataChain.end - dataChain.start + 1)
+            newAU = freeExtents.findRun(numAUs, False, startAU)
+            below = freeExtents.findRunContaining(startAU - 1, startAU - 1) if (startAU > 0) else None
+            if (below is not None and (newAU is None or below < newAU)):
+                newAU = below
+            if (newAU is not None):
+                moves.append((startAU, newAU, numAUs))
+                for (start, end) in self.subtractAURanges([(newAU, newAU + numAUs - 1)], [(startAU, dataChain.end)]):
+                    taken.append((start, end))
+                    freeExtents.take(start, end)
+                for (start, end) in self.subtractAURanges([(startAU, dataChain.end)], [(newAU, newAU + numAUs - 1)]):
+                    released.append((start, end))
+                    freeExtents.release(start, end)
+                startAU = newAU
+        if (moves):
+            # The data can move into the AU the FDR left
+            plan.add(fdr, FDRAU, startAU, numAUs, moves, self.subtractAURanges(taken, released),
+                     self.subtractAURanges(released, taken), 0)
+            plan.numCompacted += 1
+
+    def planLiftedFile(self, plan, fdr, clusters, chained):
+        # Put a lifted file (see planFullCompaction) back into the shortest free run it fits in, and its FDR into the
+        # lowest free AU. Returns False if no run is long enough.
+        freeExtents = plan.freeExtents
+        numAUs = self.getClustersSize(clusters)
+        startAU = freeExtents.findRun(numAUs, True) if (numAUs > 0) else 0
+        if (startAU is None):
+            return False
+        taken = []
+        if (numAUs > 0):
+            taken.append((startAU, startAU + numAUs - 1))
+            freeExtents.take(startAU, startAU + numAUs - 1)
+        FDRAU = freeExtents.allocate(1)
+        taken.append((FDRAU, FDRAU))
+        moves = [(fdr.au, FDRAU, 1)] if (FDRAU != fdr.au) else []
+        au = startAU
+        for (start, end) in clusters:
+            if (start != au):
+                moves.append((start, au, end - start + 1))
+            au += end - start + 1
+        released = clusters + [(fdr.au, fdr.au)] + self.getFreedAUs(chained)
+        plan.add(fdr, FDRAU, startAU, numAUs, moves, taken, released, len(chained))
+        plan.lifted.add(fdr)
+        return True
+
+    def retryFileDefrag(self, plan, files, sizes):
+        # Plan the files that fit in the largest free run now, returns the others
+        freeExtents = plan.freeExtents
+        maxAUs = freeExtents.bySize[-1][0] if (freeExtents.bySize) else 0
+        return [file for file in files if (sizes[file[0]] > maxAUs or not self.planFileDefrag(plan, *file))]
+
+    def planFileMove(self, plan, fdr):
+        # Move a contiguous file's FDR and data each to the lowest free run below it that it fits in
+        freeExtents = plan.freeExtents
+        FDRAU = fdr.au
+        (startAU, numAUs) = (0, 0)
+        moves = []
+        taken = []
+        released = []
+        newAU = freeExtents.findRun(1, False, fdr.au)
+        if (newAU is not None):
+            moves.append((fdr.au, newAU, 1))
+            taken.append((newAU, newAU))
+            released.append((fdr.au, fdr.au))
+            freeExtents.take(newAU, newAU)
+            FDRAU = newAU
+        for dataChain in fdr.dataChainPointers:
+            (startAU, numAUs) = (dataChain.start, dataChain.end - dataChain.start + 1)
+            newAU = freeExtents.findRun(numAUs, False, startAU)
+            if (newAU is not None):
+                moves.append((startAU, newAU, numAUs))
+                taken.append((newAU, newAU + numAUs - 1))
+                released.append((startAU, startAU + numAUs - 1))
+                freeExtents.take(newAU, newAU + numAUs - 1)
+                startAU = newAU
+        if (moves):
+            for (start, end) in released:
+                freeExtents.release(start, end)
+            plan.add(fdr, FDRAU, startAU, numAUs, moves, taken, released, 0)
+            plan.numCompacted += 1
+
+    def planFileDefrag(self, plan, fdr, clusters, chained):
+        # Add a file to the plan, unless there is no room to make it contiguous. Returns True if it was added.
+        freeExtents = plan.freeExtents
+        numAUs = 0
+        offsets = []
+        aligned = {}
+        for (start, end) in clusters:
+            # Clusters that are in place if the file starts at start - numAUs
+            aligned.setdefault(start - numAUs, []).append(len(offsets))
+            offsets.append(numAUs)
+            numAUs += end - start + 1
+
+        # Keep the clusters that are already in place for some start AU, largest first, and fill the gaps around them
+        # with the free AUs and the AUs of the file's own clusters that move. Only if no start works is the whole
+        # file moved to a free run.
+        best = None
+        for (startAU, inPlace) in sorted(aligned.items(), key=lambda item: -sum([clusters[j][1] - clusters[j][0] + 1
+                                                                                  for j in item[1]])):
+            if (startAU < 0 or startAU + numAUs > self.totalAUs):
+                continue
+            gaps = []
+            au = startAU
+            for j in inPlace:
+                if (clusters[j][0] > au):
+                    gaps.append((au, clusters[j][0] - 1))
+                au = clusters[j][1] + 1
+            if (au < startAU + numAUs):
+                gaps.append((au, startAU + numAUs - 1))
+            numMoved = sum([end - start + 1 for (start, end) in gaps])
+            if (best is not None and numMoved >= best[1]):
+                continue
+            moved = [clusters[j] for j in range(0, len(clusters)) if j not in inPlace]
+            taken = self.subtractAURanges(gaps, moved)
+            if (all([freeExtents.findRunContaining(start, end) is not None for (start, end) in taken])):
+                best = (startAU, numMoved, inPlace, taken)
+        if (best is None and numAUs > 0):
+            startAU = freeExtents.findRun(numAUs, True)
+            if (startAU is None):
+                return False
+            best = (startAU, numAUs, [], [(startAU, startAU + numAUs - 1)])
+        elif (best is None):
+            best = (0, 0, [], [])
+
+        (startAU, numMoved, inPlace, taken) = best
+        moves = []
+        moved = []
+        for j in range(0, len(clusters)):
+            if (j not in inPlace):
+                (start, end) = clusters[j]
+                moves.append((start, startAU + offsets[j], end - start + 1))
+                moved.append((start, end))
+        released = self.subtractAURanges(moved, [(startAU, startAU + numAUs - 1)])
+        released.extend(self.getFreedAUs(chained))
+        for (start, end) in taken:
+            freeExtents.take(start, end)
+        for (start, end) in released:
+            freeExtents.release(start, end)
+        plan.add(fdr, fdr.au, startAU, numAUs, moves, taken, released, len(chained))
+        return True
+
+    def subtractAURanges(self, ranges, holes):
+        # The parts of the (startAU, endAU) ranges outside all the holes
+        parts = []
+        for (start, end) in ranges:
+            for (holeStart, holeEnd) in sorted(holes):
+                if (holeEnd < start or holeStart > end):
+                    continue
+                if (holeStart > start):
+                    parts.append((start, holeStart - 1))
+                start = max(start, holeEnd + 1)
+                if (start > end):
+                    break
+            if (start <= end):
+                parts.append((start, end))
+        return parts
+
+    def defrag(self, plan=None):
+        # Carry out a plan from planDefrag (default: a new one), then update the parse. Returns the plan.
+        self.prepareWrite()
+        if (plan is None):
+            plan = self.planDefrag()
+        elif (plan.disk is not self or plan.writeCount != self.writeCount):
+            raise Exception('Defragmentation plan is out of date')
+
+        changedSectors = set()
+        FDIRs = {}
+        lifted = {}
+        for (fdr, FDRAU, startAU, numAUs, moves, taken, released) in plan.files:
+            if (fdr in plan.lifted):
+                lifted[fdr] = (bytearray(self.getSectorOfAU(fdr.au, fdr.sectorOffset)), self.readMoves(moves))
+                self.markAUs(released, False, changedSectors)
+        for (fdr, FDRAU, startAU, numAUs, moves, taken, released) in plan.files:
+            if (fdr in lifted):
+                (sector, data) = lifted[fdr]
+            else:
+                sector = bytearray(self.getSectorOfAU(fdr.au, fdr.sectorOffset))
+                # A cluster can move into AUs another cluster of the same file leaves, so read them all first
+                data = self.readMoves(moves)
+            for i in range(0, len(moves)):
+                (fromAU, toAU, n) = moves[i]
+                self.view[toAU * self.auSize:(toAU + n) * self.auSize] = data[i]
+            sector[32:34] = self.intToWord(0)
+            sector[34:36] = self.intToWord(numAUs)
+            sector[39] &= 0xf0
+            sector[40:] = bytes(len(sector) - 40)
+            if (numAUs > 0):
+                sector[40:44] = self.intToWord(startAU) + self.intToWord(startAU + numAUs - 1)
+            self.writeSectorOfAU(FDRAU, fdr.sectorOffset, sector, changedSectors)
+            if (FDRAU != fdr.au):
+                if (fdr.fdir not in FDIRs):
+                    FDIRs[fdr.fdir] = list(fdr.fdir.FDRAUs)
+                FDIRs[fdr.fdir][fdr.fdir.FDRs.index(fdr)] = FDRAU
+            self.markAUs(taken, True, changedSectors)
+            if (fdr not in lifted):
+                self.markAUs(released, False, changedSectors)
+        for (FDIR, FDRAUs) in FDIRs.items():
+            self.writeFDIR(FDIR.dir, FDRAUs, changedSectors)
+        self.freeExtents = plan.freeExtents
+        self.commitWrite(changedSectors)
+        return plan
+
+    def readMoves(self, moves):
+        return [bytes(self.view[fromAU * self.auSize:(fromAU + n) * self.auSize]) for (fromAU, toAU, n) in moves]
+
+    def findPossibleBadAUs(self, patterns=None):
         badAUs = []
-        for au in range(0, self.totalAUs):
-            auType = self.logicalMap[au * self.sectorsPerAU]
-            if ((auType != '.') and (auType != ' ')):
-                for pattern in [0xe5e5, 0xdead, 0xd7a5]:
-                    if (self.doesAUHaveBadDataPattern(au, pattern)):
-                        badAUs.append(au)
-                        break
+        for (startAU, endAU, pattern) in self.findPossibleBadAURanges(patterns):
+            badAUs.extend(range(startAU, endAU + 1))
         return badAUs
 
+    def findPossibleBadAURanges(self, patterns=None):
+        # Returns (startAU, endAU, pattern) for runs of AUs filled with a bad data pattern, split where the pattern
+        # or the owner changes. Free and unused AUs are skipped.
+        if (patterns is None):
+            patterns = self.badDataPatterns
+        badAUs = {}
+        for pattern in patterns:
+            for au in self.findBadDataPatternAUs(pattern):
+                badAUs.setdefault(au, pattern)
+
+        ranges = []
+        lastKey = None
+        for au in sorted(badAUs):
+            sector = au * self.sectorsPerAU
+            i = self.extents.find(sector)
+            if (i >= 0):
+                key = (chr(self.extents.types[i]), self.extents.ownerIds[i], badAUs[au])
+            elif (self.testBitmap(au)):
+                key = ('?', 0, badAUs[au])
+            else:
+                key = (' ', 0, badAUs[au])
+            if ((key[0] == '.') or (key[0] == ' ')):
+                continue
+            if (ranges and key == lastKey and ranges[-1][1] == au - 1):
+                ranges[-1][1] = au
+            else:
+                ranges.append([au, au, badAUs[au]])
+            lastKey = key
+        return [tuple(r) for r in ranges]
+
+    def findBadDataPatternAUs(self, pattern):
+        # Search the image for whole AUs filled with the pattern, letting find() skip over good data
+        block = self.getBadDataPatternBlock(pattern)
+        aus = []
+        i = self.b.find(block, 0, self.totalBytes)
+        while (i >= 0):
+            if (i % self.auSize == 0):
+                aus.append(i // self.auSize)
+                i += self.auSize
+            else:
+                i = (i // self.auSize + 1) * self.auSize
+            i = self.b.find(block, i, self.totalBytes)
+        return aus
+
+    def getBadDataPatternBlock(self, pattern):
+        return bytes([pattern >> 8, pattern & 0xff]) * (self.auSize // 2)
+
     def doesAUHaveBadDataPattern(self, au, pattern):
-        start = au * self.sectorsPerAU * self.sectorSize
-        end = start + self.sectorsPerAU * self.sectorSize
-        for i in range(start, end, 2):
-            if (self.wordToInt(self.b[i:i+2]) != pattern):
-                return False
-        return True
+        return self.getAU(au) == self.getBadDataPatternBlock(pattern)
+
+    def findCandidates(self, includeInTree=False):
+        # Find AUs whose first sector looks like an FDR or DDR. A prefilter over bytes 0, 13-15, and 28-29 of every
+        # AU runs on strided views of the image, and only the AUs that pass it are fully checked.
+        def column(offset, table):
+            return int.from_bytes(bytes(self.view[offset:self.totalBytes:self.auSize]).translate(table), 'big')
+
+        mask = column(0, CANDIDATE_NAME_START) & ((column(13, MATCH_D) & column(14, MATCH_I) & column(15, MATCH_R)) |
+                                                 (column(28, MATCH_F) & column(29, MATCH_I)) |
+                                                 (column(28, MATCH_ZERO) & column(29, MATCH_ZERO)))
+        candidates = []
+        for match in re.finditer(b'\x01', mask.to_bytes(self.totalAUs, 'big')):
+            au = match.start()
+            sectorBytes = self.getSectorOfAU(au, 0)
+            if (self.isValidName(sectorBytes[0:10], True)):
+                candidate = TICandidate(self, au, sectorBytes)
+                if (includeInTree or not candidate.inTree):
+                    candidates.append(candidate)
+        return candidates
+
+    def recoverFiles(self, candidates=None):
+        # Build files from orphan FDRs, grouped by the FDIR AU they claim. Chains are followed from their first FDR;
+        # candidate FDRs that another candidate points to as its next FDR are not treated as separate files.
+        # Calling it again keeps the files already recovered and only adds new ones.
+        if (candidates is None):
+            candidates = self.findCandidates()
+        recoveredAUs = set()
+        for group in self.recovered:
+            for fdr in group.FDRs:
+                while (fdr is not None):
+                    recoveredAUs.add(fdr.au)
+                    fdr = fdr.nextFDR
+        index = {}
+        for candidate in candidates:
+            if (candidate.type == 'FDR' and not candidate.inTree and candidate.au not in recoveredAUs):
+                index[candidate.au] = candidate
+        continuations = set()
+        for candidate in index.values():
+            if (candidate.nextFDRAU in index and candidate.nextFDRAUSectorOffset == 0):
+                continuations.add(candidate.nextFDRAU)
+
+        groups = dict([(group.au, group) for group in self.recovered])
+        for au in sorted(index):
+            candidate = index[au]
+            if ((au in continuations) or (candidate.prevFDRAU in index)):
+                continue
+            if (candidate.FDIRAU not in groups):
+                groups[candidate.FDIRAU] = TIRecoveredFDIR(self, candidate.FDIRAU)
+            groups[candidate.FDIRAU].addFDR(au)
+
+        self.recovered = [groups[au] for au in sorted(groups)]
+        return self.recovered
+
+    def exportRecovered(self, dirPath):
+        dir = dirPath + '/recovered'
+        os.mkdir(dir)
+        for group in self.recovered:
+            group.export(dir)
 
-    def addGlobalError(self, obj, error):
-        self.addGlobalMessage(self.globalErrors, obj, error)
+    def getErrors(self):
+        return formatMessages([msg for msg in self.errors if msg[0] != 'remapped'], self.maxMessages)
 
-    def addGlobalWarning(self, obj, warning):
-        self.addGlobalMessage(self.globalWarnings, obj, warning)
+    # The volume's errors and warnings: objects maps each object with messages to None, in the order of their first
+    # message, and counts the messages of each code (see formatMessages).
 
-    def addGlobalMessage(self, dict, obj, msg):
-        if (obj in dict):
-            dict[obj].append(msg)
-        else:
-            dict[obj] = [msg]
+    def addGlobalMessage(self, objects, counts, obj, code):
+        objects[obj] = None
+        counts[code] = counts.get(code, 0) + 1
+
+    def removeGlobalMessage(self, objects, counts, obj, code, msgs):
+        counts[code] -= 1
+        if (not msgs):
+            del objects[obj]
+
+    def dropGlobalMessages(self, objects, counts, obj, msgs):
+        if (obj in objects):
+            del objects[obj]
+            for msg in msgs:
+                counts[msg[0]] -= 1
+
+    def getNumErrors(self):
+        return sum(self.errorCounts.values())
+
+    def getNumWarnings(self):
+        return sum(self.warningCounts.values())
 
     def printGlobalErrors(self, prefix=''):
-        self.printGlobalMessages(self.globalErrors, prefix)
+        self.printGlobalMessages(self.globalErrors, self.errorCounts, 'errors', prefix)
 
     def printGlobalWarnings(self, prefix=''):
-        self.printGlobalMessages(self.globalWarnings, prefix)
-
-    def printGlobalMessages(self, dict, prefix=''):
-        for obj in dict:
-            msgs = dict[obj]
+        self.printGlobalMessages(self.globalWarnings, self.warningCounts, 'warnings', prefix)
+
+    def iterGlobalMessages(self, objects, severity):
+        # (obj, messages) for the objects with messages, the messages of each code after the first maxMessages
+        # left out
+        shown = {}
+        for obj in objects:
+            msgs = []
+            for msg in getattr(obj, severity):
+                numShown = shown.get(msg[0], 0)
+                if (not self.maxMessages or numShown < self.maxMessages):
+                    msgs.append(msg)
+                shown[msg[0]] = numShown + 1
+            if (msgs):
+                yield (obj, msgs)
+
+    def printGlobalMessages(self, objects, counts, severity, prefix=''):
+        for (obj, msgs) in self.iterGlobalMessages(objects, severity):
             print(prefix + obj.type.ljust(6) + str(obj.sectorAddress) + '  ' + obj.fullPath)
             for msg in msgs:
-                print(prefix + '  ' + msg)
+                print(prefix + '  ' + formatMessage(msg))
+        for line in formatOmitted(counts, self.maxMessages):
+            print(prefix + line)
 
     def printVals(self, includeFiles=False, includeSubdirs=False, prefix=''):
         self.printVal(prefix + 'Volume Name:', self.name)
@@ -916,6 +3705,30 @@ class TIDisk(TIDir):
         print()
         super().printVals(includeFiles, includeSubdirs, prefix)
 
+    def getRecord(self):
+        record = super().getRecord()
+        record['record'] = 'volume'
+        record.update({'sizeBytes': self.totalBytes, 'sectors': self.totalSectors, 'totalAUs': self.totalAUs,
+                       'allocatedAUs': self.allocatedAUs, 'freeAUs': self.freeAUs,
+                       'sectorsPerTrack': self.sectorsPerTrack, 'sectorsPerAU': self.sectorsPerAU,
+                       'heads': self.numberOfHeads, 'cylinders': self.numberOfCylinders,
+                       'bufferedHeadStepping': self.bufferedHeadStepping,
+                       'writePrecompensation': self.writePrecompensation, 'DSK1EmuAU': self.DSK1Emu})
+        return record
+
+    def writeGlobalMessages(self, writer, severity, objects, counts):
+        for (obj, msgs) in self.iterGlobalMessages(objects, severity + 's'):
+            ref = obj.getRef()
+            ref['address'] = obj.sectorAddress.getRecord()
+            for msg in msgs:
+                writer.write({'record': 'diagnostic', 'severity': severity, 'object': ref, 'code': msg[0],
+                              'message': formatMessage(msg)})
+        if (self.maxMessages):
+            for code in counts:
+                if (counts[code] > self.maxMessages):
+                    writer.write({'record': 'omitted', 'severity': severity, 'code': code,
+                                  'count': counts[code] - self.maxMessages})
+
     def printSector(self, sector, prefix=''):
         owner = self.ownerMap[sector]
         print(prefix + owner.type.ljust(6) + str(owner.sectorAddress) + '  ' + owner.fullPath)
@@ -936,50 +3749,559 @@ class TIDisk(TIDir):
 # Sectors 64 and up contain FDRs, FDIRs, DDRs, and file data
 
 
-args = len(sys.argv)
-if args < 2 or args > 4:
-    print('usage: tidisk.py diskimage [badList] [exportDir]')
-    sys.exit(1)
+# Writes report records as newline-delimited JSON (one object per line, each with a 'record' key naming its kind).
+# Lines are collected and written to the (text or binary) stream in large chunks.
+
+class TIRecordWriter:
+    def __init__(self, f, bufferSize=65536):
+        self.f = f
+        self.bufferSize = bufferSize
+        self.lines = []
+        self.size = 0
+        self.encoder = json.JSONEncoder(separators=(',', ':'))
+        self.isText = isinstance(f, io.TextIOBase)
+
+    def write(self, record):
+        line = self.encoder.encode(record) + '\n'
+        self.lines.append(line)
+        self.size += len(line)
+        if (self.size >= self.bufferSize):
+            self.flush()
+
+    def flush(self):
+        if (self.lines):
+            data = ''.join(self.lines)
+            self.f.write(data if self.isText else data.encode('utf-8'))
+            self.lines = []
+            self.size = 0
+        self.f.flush()
+
+
+# Load a disk image for TIDisk
+# access=None     Read the whole image into a bytearray (writable, private copy)
+# access='read'   Memory-map the image read-only
+# access='copy'   Memory-map the image copy-on-write (writes are private and never reach the image file)
+# access='write'  Memory-map the image writable (writes go to the image file, see TIDisk.flush)
+
+MMAP_ACCESS = {
+    'read': mmap.ACCESS_READ,
+    'copy': mmap.ACCESS_COPY,
+    'write': mmap.ACCESS_WRITE,
+}
+
+def openImage(path, access=None):
+    if (access is None):
+        with open(path, 'rb') as f:
+            return bytearray(f.read())
+    if (access not in MMAP_ACCESS):
+        raise Exception('Invalid image access mode: ' + str(access))
+    with open(path, 'r+b' if access == 'write' else 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=MMAP_ACCESS[access])
+
+
+# Image of an empty volume: the VIB, the volume bitmap (sectors 1-31) and an empty root FDIR in the first AU after the
+# reserved sectors 0-63, which are allocated along with it
+
+def makeBlankImage(name, totalAUs, sectorsPerAU=4, sectorsPerTrack=32, numHeads=1):
+    sectorSize = 256
+    if (totalAUs > 31 * sectorSize * 8):
+        raise Exception('Too many AUs for the volume bitmap: ' + str(totalAUs))
+    FDIRAU = 64 // sectorsPerAU
+    b = bytearray(totalAUs * sectorsPerAU * sectorSize)
+    b[0:10] = name.encode('ascii').ljust(10)
+    b[10:12] = totalAUs.to_bytes(2, 'big')
+    b[12] = sectorsPerTrack
+    b[13:16] = b'WIN'
+    b[16:18] = (((sectorsPerAU - 1) << 12) | ((numHeads - 1) << 8)).to_bytes(2, 'big')
+    b[24:26] = FDIRAU.to_bytes(2, 'big')
+    for au in range(0, FDIRAU + 1):
+        b[sectorSize + au // 8] |= (1 << (7 - (au % 8)))
+    return b
+
+
+# Parse cache: a fully validated TIDisk is pickled next to the image (diskimage.tidisk-cache) and loaded instead of
+# parsing the image again. Parsing only reads the metadata sectors (VIB, bitmap, DDRs, FDIRs and FDRs), so the cache
+# stores their sector numbers and a short hash of each. Loading re-hashes just those sectors: if none changed the cache
+# is used as is, otherwise TIDisk.reanalyze re-parses only what owns the changed sectors, and the cache is rewritten.
+# CACHE_VERSION must be bumped whenever parsing changes what is stored on the disk objects.
+#
+# The parse also depends on the TIParseLimits and the minimum severity, so those are stored too and a cache made with
+# other settings is not used.
+#
+# Layout: magic, version, image size (8 bytes), settings (CACHE_SETTINGS), sector count (4 bytes), sectors
+# (array('I'), native byte order), sector hashes (CACHE_HASH_SIZE bytes each), pickled TIDisk
+
+CACHE_MAGIC = b'TIDISKC'
+CACHE_VERSION = 7
+CACHE_HASH_SIZE = 8
+
+# maxDepth, maxFDRChain, maxObjects, maxSeconds (-1 for no limit) and the index of the minimum severity
+CACHE_SETTINGS = struct.Struct('<iiidB')
+
+def getCacheSettings(limits, minSeverity):
+    values = [limits.maxDepth, limits.maxFDRChain, limits.maxObjects, limits.maxSeconds]
+    values = [-1 if value is None else value for value in values]
+    return CACHE_SETTINGS.pack(*(values + [SEVERITIES.index(minSeverity)]))
+
+# A cache file sits next to an image and can come from wherever the image came from, so loading it must not run
+# arbitrary code: the unpickler only resolves the disk classes below and array.array, and refuses every other global
+# (os.system, builtins.eval, ...). The containers the disk uses (dict, list, tuple, set, bytes, bytearray) have their
+# own pickle opcodes and never go through find_class. A crafted cache can still hold wrong parse results.
+CACHE_CLASSES = set([
+    'TIAURange', 'TIDir', 'TIDisk', 'TIExtentMap', 'TIFDIR', 'TIFile', 'TIFreeAU', 'TILogicalMap', 'TIOwnerMap',
+    'TIParseLimits', 'TIPathIndex', 'TIRecoveredFDIR', 'TIUnknownAU', 'TIUnusedAU', 'TIVolumeBitmapAU',
+])
+CACHE_ARRAY_NAMES = set(['array', '_array_reconstructor'])
+
+class TICacheUnpickler(pickle.Unpickler):
+    # The classes are pickled under whichever name this module had (__main__ when run as a script)
+    def find_class(self, module, name):
+        if (module in ('__main__', __name__) and name in CACHE_CLASSES):
+            return globals()[name]
+        if (module == 'array' and name in CACHE_ARRAY_NAMES):
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError('Global not allowed in a parse cache: ' + module + '.' + name)
+
+def getCachePath(path):
+    return path + '.tidisk-cache'
+
+def getSectorHashes(rawBytes, sectors, sectorSize=256):
+    view = memoryview(rawBytes)
+    hashes = bytearray()
+    for sector in sectors:
+        hashes += hashlib.blake2b(view[sector * sectorSize:(sector + 1) * sectorSize],
+                                  digest_size=CACHE_HASH_SIZE).digest()
+    return hashes
+
+def loadCachedDisk(rawBytes, cachePath, limits, minSeverity='warning'):
+    # Returns (disk, changedSectors) for the cached TIDisk of this image, or (None, None) if there is no usable cache.
+    # The disk is not yet updated for the changed sectors (see TIDisk.reanalyze).
+    try:
+        with open(cachePath, 'rb') as f:
+            if (f.read(len(CACHE_MAGIC) + 1) != CACHE_MAGIC + bytes([CACHE_VERSION])):
+                return (None, None)
+            if (int.from_bytes(f.read(8), 'little') != len(rawBytes)):
+                return (None, None)
+            if (f.read(CACHE_SETTINGS.size) != getCacheSettings(limits, minSeverity)):
+                return (None, None)
+            sectors = array.array('I')
+            sectors.frombytes(f.read(int.from_bytes(f.read(4), 'little') * sectors.itemsize))
+            oldHashes = f.read(len(sectors) * CACHE_HASH_SIZE)
+            newHashes = getSectorHashes(rawBytes, sectors)
+            changedSectors = set()
+            if (oldHashes != newHashes):
+                for i in range(0, len(sectors)):
+                    if (oldHashes[i * CACHE_HASH_SIZE:(i + 1) * CACHE_HASH_SIZE] !=
+                            newHashes[i * CACHE_HASH_SIZE:(i + 1) * CACHE_HASH_SIZE]):
+                        changedSectors.add(sectors[i])
+            disk = TICacheUnpickler(f).load()
+    except Exception:
+        return (None, None)
+    if (not isinstance(disk, TIDisk)):
+        return (None, None)
+    disk.attachImage(rawBytes)
+    return (disk, changedSectors)
+
+def saveCachedDisk(disk, cachePath):
+    # Best effort: a cache that can't be written just means the next run parses the image again
+    if (disk.lazy or not disk.validated):
+        raise Exception('Only a fully validated disk can be cached')
+    if (disk.parseStopped is not None):
+        return False
+    sectors = disk.getMetadataSectors()
+    tmpPath = cachePath + '.tmp'
+    try:
+        with open(tmpPath, 'wb') as f:
+            f.write(CACHE_MAGIC + bytes([CACHE_VERSION]))
+            f.write(len(disk.b).to_bytes(8, 'little'))
+            f.write(getCacheSettings(disk.limits, disk.minSeverity))
+            f.write(len(sectors).to_bytes(4, 'little'))
+            f.write(sectors.tobytes())
+            f.write(getSectorHashes(disk.b, sectors, disk.sectorSize))
+            pickle.dump(disk, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, cachePath)
+        return True
+    except (OSError, pickle.PicklingError, RecursionError):
+        if (os.path.exists(tmpPath)):
+            os.remove(tmpPath)
+        return False
+
+def openDisk(path, access=None, cache=False, limits=None, minSeverity='warning'):
+    rawBytes = openImage(path, access)
+    if (not cache):
+        return TIDisk(rawBytes, False, limits, minSeverity)
+    if (limits is None):
+        limits = TIParseLimits()
+    (disk, changedSectors) = loadCachedDisk(rawBytes, getCachePath(path), limits, minSeverity)
+    if (disk is not None):
+        disk.limits = limits
+    if (disk is not None and changedSectors and not disk.reanalyze(changedSectors)):
+        disk = None
+    if (disk is None):
+        disk = TIDisk(rawBytes, False, limits, minSeverity)
+        saveCachedDisk(disk, getCachePath(path))
+    elif (changedSectors):
+        saveCachedDisk(disk, getCachePath(path))
+    return disk
+
+def hasFileFilters(args):
+    return (args.types is not None or args.minSize is not None or args.maxSize is not None or
+            args.modifiedSince is not None)
+
+def parseCount(text):
+    # Argument type for --jobs and the parse limits
+    try:
+        count = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a number: ' + text)
+    if (count < 1):
+        raise argparse.ArgumentTypeError('must be at least 1: ' + text)
+    return count
+
+def parseSeconds(text):
+    try:
+        seconds = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a number: ' + text)
+    if (not seconds > 0):
+        raise argparse.ArgumentTypeError('must be more than 0: ' + text)
+    return seconds
+
+def getParseLimits(args):
+    return TIParseLimits(args.maxDepth, args.maxFDRChain, args.maxObjects, args.maxSeconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(usage='tidisk.py [options] diskimage [badList] [exportDir]\n'
+                                           '       tidisk.py --batch REPORTDIR [options] image|dir|glob ...\n'
+                                           '       tidisk.py --self-test')
+    parser.add_argument('diskimage', nargs='?')
+    parser.add_argument('badList', nargs='?', default='')
+    parser.add_argument('exportDir', nargs='?')
+    parser.add_argument('moreImages', nargs='*', help=argparse.SUPPRESS)
+    parser.add_argument('--mmap', choices=sorted(MMAP_ACCESS), dest='access',
+                        help='memory-map the image instead of reading it into memory')
+    parser.add_argument('--bad-pattern', action='append', dest='badPatterns', type=parseBadPattern,
+                        help='hex word that fills a possible bad AU (repeatable, default: ' +
+                             ', '.join([hex(p) for p in BAD_DATA_PATTERNS]) + ')')
+    parser.add_argument('--jobs', type=parseCount,
+                        help='number of threads exporting files to exportDir (default: 1), or of worker processes '
+                             'in batch mode (default: number of CPUs)')
+    parser.add_argument('--batch', metavar='REPORTDIR',
+                        help='analyze many images (files, directories or globs) in parallel, writing one report per '
+                             'image to REPORTDIR and printing a summary')
+    parser.add_argument('--text', action='store_true',
+                        help='also export DIS/VAR files as newline-delimited text (FILE.txt) to exportDir')
+    parser.add_argument('--recover', action='store_true',
+                        help='rebuild files from orphan FDRs (exported to exportDir/recovered)')
+    parser.add_argument('--format', choices=['text', 'ndjson'], default='text',
+                        help='report format (default: text)')
+    parser.add_argument('--map', choices=['compact', 'full'], default='compact',
+                        help='logical map as a scaled summary plus runs (compact, default) or one character per '
+                             'sector (full)')
+    parser.add_argument('--map-scale', type=int, dest='mapScale', metavar='N',
+                        help='AUs per character of the compact logical map (default: fit in 2048 characters)')
+    parser.add_argument('--cache', action='store_true',
+                        help='reuse the parse results saved in diskimage.tidisk-cache while the image is unchanged '
+                             '(loading a cache only restores tidisk\'s own disk objects and arrays, so a tampered '
+                             'cache cannot run arbitrary code, but it can make the report wrong)')
+    parser.add_argument('--list', metavar='PATH',
+                        help='only list one directory or file (e.g. DIR.SUBDIR, empty for the root), '
+                             'parsing just that path')
+    parser.add_argument('--find', metavar='GLOB',
+                        help='only list the full paths matching a pattern (e.g. \'SUB.*\')')
+    parser.add_argument('--type', action='append', choices=CATALOG_TYPES, dest='types',
+                        help='with --find, only list files of this type (repeatable)')
+    parser.add_argument('--min-size', type=int, dest='minSize', metavar='BYTES',
+                        help='with --find, only list files of at least BYTES (program length, else sectors '
+                             'allocated)')
+    parser.add_argument('--max-size', type=int, dest='maxSize', metavar='BYTES',
+                        help='with --find, only list files of at most BYTES')
+    parser.add_argument('--modified-since', type=parseCatalogDate, dest='modifiedSince', metavar='YY-MM-DD',
+                        help='with --find, only list files updated on or after a date')
+    parser.add_argument('--archive', metavar='FILE',
+                        help='write the tree to a tar or zip archive (- for stdout, the report then goes to stderr)')
+    parser.add_argument('--archive-format', choices=['tar', 'tgz', 'zip'], dest='archiveFormat',
+                        help='archive format (default: from the archive file name, else tar)')
+    parser.add_argument('--max-depth', type=parseCount, default=MAX_DIR_DEPTH, dest='maxDepth', metavar='N',
+                        help='parse directories at most N levels below the root (default: ' + str(MAX_DIR_DEPTH) + ')')
+    parser.add_argument('--max-fdr-chain', type=parseCount, default=MAX_FDR_CHAIN, dest='maxFDRChain', metavar='N',
+                        help='parse at most N FDRs per file (default: ' + str(MAX_FDR_CHAIN) + ')')
+    parser.add_argument('--max-objects', type=parseCount, dest='maxObjects', metavar='N',
+                        help='stop parsing after N directories and files (default: one per sector)')
+    parser.add_argument('--time-limit', type=parseSeconds, dest='maxSeconds', metavar='SECONDS',
+                        help='stop parsing an image after SECONDS (default: no limit)')
+    parser.add_argument('--min-severity', choices=SEVERITIES, default='warning', dest='minSeverity',
+                        help='only record diagnostics of this severity or worse (error: skip warnings while parsing)')
+    parser.add_argument('--max-messages', type=int, default=MAX_MESSAGES_PER_CODE, dest='maxMessages', metavar='N',
+                        help='list at most N diagnostics of each kind per object and per volume, and how many more '
+                             'there are (default: ' + str(MAX_MESSAGES_PER_CODE) + ', 0 for all)')
+    parser.add_argument('--defrag', action='store_true',
+                        help='make every file contiguous, rewriting the image in place')
+    parser.add_argument('--dry-run', action='store_true', dest='dryRun',
+                        help='with --defrag, only print the plan (AUs to move, FDRs to free)')
+    parser.add_argument('--self-test', action='store_true', dest='selfTest',
+                        help='write, delete and defragment files on a blank image in memory, checking the image after '
+                             'each step')
+    args = parser.parse_args()
+
+    if (args.selfTest):
+        return selfTest()
+    if (args.diskimage is None):
+        parser.error('the following arguments are required: diskimage')
+
+    if (args.dryRun and not args.defrag):
+        parser.error('--dry-run requires --defrag')
+    if (hasFileFilters(args) and args.find is None):
+        parser.error('--type, --min-size, --max-size and --modified-since require --find')
+    if (args.batch is not None):
+        if (args.list is not None or args.find is not None or args.archive is not None or args.defrag):
+            parser.error('--list, --find, --archive and --defrag cannot be used with --batch')
+        specs = [args.diskimage] + [spec for spec in [args.badList, args.exportDir] if spec] + args.moreImages
+        return batch(args, specs)
+    if (args.moreImages):
+        parser.error('too many arguments (use --batch for more than one image)')
+    if (args.jobs is None):
+        args.jobs = 1
+
+    if (args.archive == '-'):
+        archiveFile = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            return report(args, archiveFile)
+    elif (args.archive is not None):
+        with open(args.archive, 'wb') as archiveFile:
+            return report(args, archiveFile)
+    return report(args)
+
+
+def report(args, archiveFile=None):
+    if (args.list is not None):
+        disk = TIDisk(openImage(args.diskimage, args.access), True, getParseLimits(args), args.minSeverity)
+        disk.maxMessages = args.maxMessages
+        obj = disk.lookup(args.list)
+        if (obj is None):
+            print('Not found: ' + args.list)
+            return 1
+        elif (isinstance(obj, TIDir)):
+            obj.printTree(recursive=False)
+        else:
+            obj.printVals()
+        return 0
+
+    if (args.find is not None):
+        disk = TIDisk(openImage(args.diskimage, args.access), True, getParseLimits(args), args.minSeverity)
+        objs = disk.glob(args.find)
+        if (hasFileFilters(args)):
+            catalog = disk.getCatalog()
+            rows = catalog.select(args.types, args.minSize, args.maxSize, args.modifiedSince)
+            files = set([catalog.files[row] for row in rows])
+            objs = [obj for obj in objs if obj in files]
+        for obj in objs:
+            print(obj.type.ljust(6) + str(obj.au).rjust(6) + '  ' + obj.fullPath)
+        return 0
+
+    if (args.defrag):
+        return defrag(args)
+
+    disk = openDisk(args.diskimage, args.access, args.cache, getParseLimits(args), args.minSeverity)
+    if (args.format == 'ndjson'):
+        return writeReport(disk, args, TIRecordWriter(sys.stdout), archiveFile)
+    return printReport(disk, args, archiveFile)
+
+
+def defrag(args):
+    disk = openDisk(args.diskimage, args.access if args.dryRun else 'write', args.cache, getParseLimits(args),
+                    args.minSeverity)
+    plan = disk.planDefrag()
+    if (args.format == 'ndjson'):
+        writer = TIRecordWriter(sys.stdout)
+        writer.write(plan.getRecord())
+        writer.flush()
+    else:
+        plan.printVals()
+    if (not args.dryRun and len(plan)):
+        disk.defrag(plan)
+        disk.flush()
+    return 0
+
+
+def selfTest(totalAUs=1600, sectorsPerAU=4):
+    # Write, delete and defragment files on a blank image, parsing the image again after each step to check that it
+    # has no errors or warnings, that every file reads back as written, and that the volume bitmap matches the tree.
+    # Prints one line per step; returns 1 if any check failed.
+    failures = []
+    contents = {}
+
+    def check(disk, step):
+        parsed = TIDisk(bytearray(disk.b))
+        problems = parsed.getErrors() + parsed.getWarnings()
+        files = set([fdr.fullPath for fdr in parsed.iterFiles() if fdr.firstFDR is fdr])
+        if (files != set(contents)):
+            problems.append('files ' + str(sorted(files ^ set(contents))) + ' missing or unexpected')
+        for path in sorted(files & set(contents)):
+            fdr = parsed.lookup(path)
+            if (fdr.open().read()[0:fdr.programLength] != contents[path]):
+                problems.append(path + ': contents differ')
+        if (parsed.getFreeExtents().numFree != parsed.freeAUs):
+            problems.append('bitmap: ' + str(parsed.freeAUs) + ' free AUs, the tree leaves ' +
+                            str(parsed.getFreeExtents().numFree))
+        if (list(disk.getFreeExtents()) != list(parsed.getFreeExtents())):
+            problems.append('free extent index out of date')
+        print(step.ljust(30) + ('OK' if not problems else 'FAILED'))
+        for problem in problems:
+            print('  ' + problem)
+        failures.extend(problems)
+
+    def addFile(disk, path, size):
+        contents[path] = bytes([(i * 7 + len(contents)) & 0xff for i in range(0, size)])
+        disk.addFile(path, contents[path])
+
+    def deleteFile(disk, path):
+        del contents[path]
+        disk.deleteFile(path)
+
+    disk = TIDisk(makeBlankImage('SELFTEST', totalAUs, sectorsPerAU))
+    check(disk, 'Blank image')
+    auSize = disk.auSize
+    dirs = ['', 'DIR1.', 'DIR1.SUB.', 'DIR2.']
+    for dir in dirs[1:]:
+        disk.addDir(dir[:-1])
+    paths = [dirs[i % 4] + 'F' + str(i).zfill(3) for i in range(0, 400)]
+    for i in range(0, len(paths)):
+        addFile(disk, paths[i], 1 + (i % 3) * auSize + (i % 7) * 37)
+    addFile(disk, 'FILLER', (disk.getFreeExtents().numFree - 1) * auSize)
+    check(disk, 'Write files')
+    for path in paths[::2]:
+        deleteFile(disk, path)
+    check(disk, 'Delete every other file')
+    # Files spread over the holes, one of them over more clusters than fit in one FDR
+    for i in range(0, 8):
+        addFile(disk, 'DIR2.BIG' + str(i), (5 + i * 3) * auSize)
+    addFile(disk, 'HUGE', disk.getFreeExtents().numFree // 2 * auSize)
+    check(disk, 'Write fragmented files')
+
+    # The free space left is scattered over runs shorter than most of the fragmented files, so this needs compaction.
+    # Each pass must defragment some files or say why it can't.
+    for numPass in range(1, 3):
+        numFragmented = disk.planDefrag().numFragmented
+        plan = disk.defrag()
+        check(disk, 'Defragment (pass ' + str(numPass) + ')')
+        for fdr in plan.skipped:
+            print('  No contiguous room for ' + fdr.fullPath + ': ' + plan.reasons.get(fdr, 'no reason given'))
+            if (fdr not in plan.reasons):
+                failures.append(fdr.fullPath + ': skipped without a reason')
+        if (numFragmented and disk.planDefrag().numFragmented == numFragmented and not plan.skipped):
+            failures.append('defragment pass ' + str(numPass) + ' made no progress')
+    plan = disk.planDefrag()
+    if (plan.numFragmented):
+        failures.append('still fragmented')
+        print('Files still fragmented: ' + str(plan.numFragmented))
+    deleteFile(disk, 'FILLER')
+    check(disk, 'Delete filler')
+    return 1 if failures else 0
+
+
+def printReport(disk, args, archiveFile=None):
+    if (args.badPatterns):
+        disk.badDataPatterns = args.badPatterns
+    disk.maxMessages = args.maxMessages
+    disk.printVals(True, True)
+
+    if (args.map == 'full'):
+        print()
+        print('Logical Map:')
+        print(str(disk.logicalMap))
+    else:
+        printLogicalMap(disk, args.mapScale)
+
+    print()
+    print('Disk Tree:')
+    disk.printTree()
 
-disk = TIDisk(bytearray(open(sys.argv[1], 'rb').read()))
-disk.printVals(True, True)
+    print()
+    print('Unknown Allocated Sectors:')
+    for (mapType, ownerId, start, length) in disk.logicalMap.runs():
+        if (mapType == '?'):
+            for i in range(start, start + length):
+                disk.printSector(i, '  ')
 
-print()
-print('Logical Map:')
-print(''.join(disk.logicalMap))
+    print()
+    print('Sectors not in tree with possible FDR or DDR:')
+    candidates = disk.findCandidates()
+    for candidate in candidates:
+        print('  ' + str(candidate))
+        disk.printSector(candidate.au * disk.sectorsPerAU, '  ')
 
-print()
-print('Disk Tree:')
-disk.printTree()
+    if (args.recover):
+        print()
+        print('Recovered Files:')
+        for group in disk.recoverFiles(candidates):
+            print('  ' + group.fullPath + ':')
+            group.printFiles('    ')
 
-print()
-print('Unknown Allocated Sectors:')
-for i in range(0, disk.totalSectors):
-    if (disk.logicalMap[i] == '?'):
-        disk.printSector(i, '  ')
+    print()
+    print('ERRORS:')
+    disk.printGlobalErrors('  ')
 
-print()
-print('Sectors not in tree with possible FDR or DDR:')
-for au in range(0, disk.totalAUs):
-    sector = au * disk.sectorsPerAU
-    if (disk.logicalMap[sector] != 'F' and disk.logicalMap[sector] != 'D'):
-        sectorBytes = disk.getSector(sector)
-        if (disk.isValidName(sectorBytes[0:10], True)):
-            if (disk.bytesToString(sectorBytes[13:16]) == 'DIR' or disk.bytesToString(sectorBytes[28:30]) == 'FI' or
-                    (sectorBytes[28] == 0 and sectorBytes[29] == 0)):
-                disk.printSector(sector, '  ')
+    print()
+    print('WARNINGS:')
+    disk.printGlobalWarnings('  ')
 
-print()
-print('ERRORS:')
-disk.printGlobalErrors('  ')
 
-print()
-print('WARNINGS:')
-disk.printGlobalWarnings('  ')
+    if (args.badList != ''):
+        print()
+        print('Known Bad Sectors:')
+        for badSector in readBadList(disk, args.badList):
+            owner = disk.ownerMap[badSector.logicalSector]
+            print('  ' + str(badSector) + ' (0x' +
+                  hex(disk.wordToInt(disk.getSector(badSector.logicalSector))).lstrip('0x').zfill(4) +
+                  ') mapped to ' + owner.type.ljust(5) + str(owner.au).rjust(5) + ' ' + owner.fullPath)
+
 
+    exportErrors = runExports(disk, args, archiveFile)
+    if (exportErrors):
+        print()
+        print('Export Errors:')
+        for (fullPath, error) in exportErrors:
+            print('  ' + fullPath + ': ' + error)
 
-if (args >= 3 and sys.argv[2] != ''):
-    f = open(sys.argv[2], 'r')
+    print()
+    print('Possible Bad Sectors:')
+    for (startAU, endAU, pattern) in disk.findPossibleBadAURanges():
+        sector = startAU * disk.sectorsPerAU
+        owner = disk.ownerMap[sector]
+        addr = TISectorAddress(disk, logicalSector=sector)
+        line = ('  ' + str(addr) + ' (0x' + hex(pattern).lstrip('0x').zfill(4) +
+                ') mapped to ' + owner.type.ljust(5) + str(owner.au).rjust(5) + ' ' + owner.fullPath)
+        if (endAU > startAU):
+            line += ' [AUs ' + str(startAU) + '-' + str(endAU) + ', ' + str(endAU - startAU + 1) + ' AUs]'
+        print(line)
+
+    return 0
+
+
+def printLogicalMap(disk, ausPerChar=None, width=64):
+    # Scaled summary of the logical map followed by its runs (see TILogicalMap.runs)
+    if (ausPerChar is None):
+        ausPerChar = max(1, -(-disk.totalAUs // 2048))
+    summary = disk.logicalMap.summary(ausPerChar)
+    print()
+    print('Logical Map (1 character = ' + str(ausPerChar) + ' AU' + ('s' if ausPerChar > 1 else '') + '):')
+    for i in range(0, len(summary), width):
+        print('  ' + str(i * ausPerChar).rjust(6) + '  ' + summary[i:i+width])
+
+    print()
+    print('Logical Map Runs:')
+    for (mapType, ownerId, start, length) in disk.logicalMap.runs():
+        line = '  ' + str(start).rjust(8) + str(length).rjust(8) + '  ' + mapType
+        if (mapType != ' ' and mapType != '?'):
+            owner = disk.getOwner(mapType, ownerId, start // disk.sectorsPerAU)
+            line += '  ' + owner.type.ljust(5) + str(owner.au).rjust(6) + ' ' + owner.fullPath
+        print(line.rstrip())
+
+def readBadList(disk, path):
+    # Bad sector list as reported by the drive ('Bad sectors on cylinder C head H: S S ...')
+    f = open(path, 'r')
     badList = f.readlines()
     f.close()
     badSectors = []
@@ -990,29 +4312,210 @@ if (args >= 3 and sys.argv[2] != ''):
             head = int(s[6].split(':')[0])
             for sector in s[7:]:
                 badSectors.append(TISectorAddress(disk, cyl, head, int(sector.replace('H', ''))))
-
-    print()
-    print('Known Bad Sectors:')
-    for badSector in badSectors:
-        owner = disk.ownerMap[badSector.logicalSector]
-        print('  ' + str(badSector) + ' (0x' +
-              hex(disk.wordToInt(disk.getSector(badSector.logicalSector))).lstrip('0x').zfill(4) +
-              ') mapped to ' + owner.type.ljust(5) + str(owner.au).rjust(5) + ' ' + owner.fullPath)
-
-
-if (args >= 4):
-    disk.export(sys.argv[3])
-
-print()
-print('Possible Bad Sectors:')
-for au in disk.findPossibleBadAUs():
-    sector = au * disk.sectorsPerAU
-    owner = disk.ownerMap[sector]
-    addr = TISectorAddress(disk, logicalSector=sector)
-    print('  ' + str(addr) + ' (0x' + hex(disk.wordToInt(disk.getSector(sector))).lstrip('0x').zfill(4) +
-          ') mapped to ' + owner.type.ljust(5) + str(owner.au).rjust(5) + ' ' + owner.fullPath)
-
-
-sys.exit(0)
-
-
+    return badSectors
+
+def runExports(disk, args, archiveFile=None):
+    # Returns the (fullPath, error) list of a parallel export
+    exportErrors = []
+    if (args.exportDir is not None):
+        if (args.jobs > 1):
+            exportErrors = disk.exportParallel(args.exportDir, args.jobs)
+        else:
+            disk.export(args.exportDir)
+        if (args.recover):
+            disk.exportRecovered(args.exportDir)
+        if (args.text):
+            disk.exportText(args.exportDir)
+
+    if (archiveFile is not None):
+        archiveFormat = args.archiveFormat
+        if (archiveFormat is None):
+            archiveFormat = 'tar'
+            if (args.archive.endswith('.zip')):
+                archiveFormat = 'zip'
+            elif (args.archive.endswith('.tgz') or args.archive.endswith('.tar.gz')):
+                archiveFormat = 'tgz'
+        disk.exportArchive(archiveFile, archiveFormat)
+    return exportErrors
+
+def writeReport(disk, args, writer, archiveFile=None):
+    # Same content as printReport, as records (see TIRecordWriter)
+    if (args.badPatterns):
+        disk.badDataPatterns = args.badPatterns
+    disk.maxMessages = args.maxMessages
+    writer.write(disk.getRecord())
+    if (disk.FDIR is not None):
+        for fdr in disk.FDIR.FDRs:
+            writer.write(fdr.getRecord())
+    for dir in disk.subdirs:
+        dir.writeRecords(writer)
+
+    for (start, end, mapType, ownerId) in disk.extents:
+        owner = disk.getOwner(mapType, ownerId, start // disk.sectorsPerAU)
+        writer.write({'record': 'extent', 'start': start, 'end': end, 'mapType': mapType, 'owner': owner.getRef()})
+    for (mapType, ownerId, start, length) in disk.logicalMap.runs():
+        if (mapType == '?'):
+            writer.write({'record': 'unknown', 'start': start, 'end': start + length - 1})
+
+    candidates = disk.findCandidates()
+    for candidate in candidates:
+        writer.write(candidate.getRecord())
+
+    if (args.recover):
+        for group in disk.recoverFiles(candidates):
+            for fdr in group.FDRs:
+                record = fdr.getRecord()
+                record['recoveredAs'] = group.fullPath
+                writer.write(record)
+
+    disk.writeGlobalMessages(writer, 'error', disk.globalErrors, disk.errorCounts)
+    disk.writeGlobalMessages(writer, 'warning', disk.globalWarnings, disk.warningCounts)
+
+    if (args.badList != ''):
+        for badSector in readBadList(disk, args.badList):
+            writer.write({'record': 'knownBadSector', 'address': badSector.getRecord(),
+                          'word': disk.wordToInt(disk.getSector(badSector.logicalSector)),
+                          'owner': disk.ownerMap[badSector.logicalSector].getRef()})
+
+    for (fullPath, error) in runExports(disk, args, archiveFile):
+        writer.write({'record': 'exportError', 'path': fullPath, 'error': error})
+
+    for (startAU, endAU, pattern) in disk.findPossibleBadAURanges():
+        sector = startAU * disk.sectorsPerAU
+        writer.write({'record': 'possibleBadSectors', 'startAU': startAU, 'endAU': endAU, 'pattern': pattern,
+                      'address': TISectorAddress(disk, logicalSector=sector).getRecord(),
+                      'owner': disk.ownerMap[sector].getRef()})
+    writer.flush()
+    return 0
+
+
+# Batch mode: each image is analyzed in a worker process, with its full report written to its own file in the report
+# directory. A failing image only shows up as FAILED in the summary; images whose worker process died are retried one
+# at a time so that the image that killed the pool can be told apart from the others.
+
+def getBatchImages(specs):
+    images = []
+    for spec in specs:
+        if (os.path.isdir(spec)):
+            for (dirPath, dirNames, fileNames) in os.walk(spec):
+                dirNames.sort()
+                for fileName in sorted(fileNames):
+                    if (not fileName.endswith('.tidisk-cache')):
+                        images.append(os.path.join(dirPath, fileName))
+        elif (os.path.exists(spec)):
+            images.append(spec)
+        else:
+            images.extend(sorted(glob.glob(spec)))
+    return images
+
+def getBatchReportPaths(reportDir, images, extension='.txt'):
+    reportPaths = []
+    names = set()
+    for image in images:
+        name = os.path.basename(image)
+        n = 1
+        while (name in names):
+            n += 1
+            name = os.path.basename(image) + '.' + str(n)
+        names.add(name)
+        reportPaths.append(os.path.join(reportDir, name + extension))
+    return reportPaths
+
+def analyzeImage(task):
+    # Runs in a worker process. Returns a summary dict; 'error' is set if the image could not be analyzed.
+    (image, reportPath, args) = task
+    summary = {'image': image, 'report': reportPath, 'error': None}
+    with open(reportPath, 'w') as f:
+        with contextlib.redirect_stdout(f):
+            try:
+                disk = openDisk(image, args.access, args.cache, getParseLimits(args), args.minSeverity)
+                if (args.format == 'ndjson'):
+                    writeReport(disk, args, TIRecordWriter(f))
+                else:
+                    printReport(disk, args)
+                summary['volume'] = disk.name
+                summary['totalAUs'] = disk.totalAUs
+                summary['allocatedAUs'] = disk.allocatedAUs
+                summary['freeAUs'] = disk.freeAUs
+                summary['errors'] = disk.getNumErrors()
+                summary['warnings'] = disk.getNumWarnings()
+                summary['badAUs'] = sum([endAU - startAU + 1 for (startAU, endAU, pattern) in
+                                         disk.findPossibleBadAURanges()])
+            except Exception as e:
+                summary['error'] = type(e).__name__ + ': ' + str(e)
+                if (args.format == 'ndjson'):
+                    f.write(json.dumps({'record': 'failure', 'error': summary['error'],
+                                        'traceback': traceback.format_exc()}, separators=(',', ':')) + '\n')
+                else:
+                    traceback.print_exc(file=f)
+    return summary
+
+# A worker process that dies (killed by the OS, a crash in the interpreter) breaks the whole pool and fails every task
+# not finished yet. The pool hands tasks to its workers in order, at most workers + EXTRA_QUEUED_CALLS at a time, so
+# the image that killed it is among the first of the failed tasks: those are retried one per process to find it, and
+# the rest go to a fresh pool of the same size.
+
+def runIsolated(task):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(analyzeImage, task).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            return {'image': task[0], 'report': task[1], 'error': 'worker process died'}
+
+def runBatch(tasks, workers):
+    summaries = [None] * len(tasks)
+    pending = list(range(0, len(tasks)))
+    maxStarted = workers + getattr(concurrent.futures.process, 'EXTRA_QUEUED_CALLS', 1)
+    while (pending):
+        failed = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            futures = [executor.submit(analyzeImage, tasks[i]) for i in pending]
+            for (i, future) in zip(pending, futures):
+                try:
+                    summaries[i] = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    failed.append(i)
+        for i in failed[:maxStarted]:
+            summaries[i] = runIsolated(tasks[i])
+        pending = failed[maxStarted:]
+    return summaries
+
+def batch(args, specs):
+    images = getBatchImages(specs)
+    if (not images):
+        print('No images found: ' + ' '.join(specs))
+        return 1
+    os.makedirs(args.batch, exist_ok=True)
+    args.badList = ''
+    args.exportDir = None
+    args.recover = False
+    workers = args.jobs if args.jobs is not None else os.cpu_count()
+    reportPaths = getBatchReportPaths(args.batch, images, '.ndjson' if args.format == 'ndjson' else '.txt')
+    tasks = list(zip(images, reportPaths, [args] * len(images)))
+    summaries = runBatch(tasks, min(workers, len(tasks)))
+
+    lines = [('Image'.ljust(40) + 'Volume'.ljust(12) + 'AUs'.rjust(7) + 'Alloc'.rjust(7) + 'Free'.rjust(7) +
+              'Errors'.rjust(8) + 'Warns'.rjust(7) + 'BadAUs'.rjust(8))]
+    failed = 0
+    for summary in summaries:
+        line = summary['image'].ljust(40)
+        if (summary['error'] is not None):
+            failed += 1
+            line += 'FAILED: ' + summary['error']
+        else:
+            line += (summary['volume'].ljust(12) + str(summary['totalAUs']).rjust(7) +
+                     str(summary['allocatedAUs']).rjust(7) + str(summary['freeAUs']).rjust(7) +
+                     str(summary['errors']).rjust(8) + str(summary['warnings']).rjust(7) +
+                     str(summary['badAUs']).rjust(8))
+        lines.append(line)
+    lines.append('')
+    lines.append(str(len(summaries)) + ' images, ' + str(failed) + ' failed, reports in ' + args.batch)
+
+    with open(os.path.join(args.batch, 'summary.txt'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())